@@ -0,0 +1,189 @@
+"""
+Local fake HLS CDN for tests and benchmarks.
+
+It serves a master playlist `/master.m3u8`, a media playlist `/{variant}/index.m3u8` of each variant
+and generated segments `/{variant}/{i}.ts`, with configurable latency, bandwidth, error injection
+and range support.
+
+Usage: python -m benchmarks.cdn [port] [segments] [size]
+"""
+import asyncio
+import multiprocessing
+import random
+import sys
+from typing import Optional
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+CHUNK = 64*1024
+
+
+class FakeCDN:
+    """
+    Fake HLS CDN, started by `async with`.
+    """
+
+    def __init__(self, segments: int = 10, size: int = 1024, variants: tuple[int, ...] = (1000000,), latency: float = 0, bandwidth: Optional[float] = None, error_rate: float = 0, drop_rate: float = 0, ranges: bool = True, seed: int = 0, port: Optional[int] = None) -> None:
+        """
+        :param segments: Count of segments of each variant.
+        :param size: Bytes of each segment.
+        :param variants: Bandwidth of each variant in master playlist, named `v0`, `v1`, ...
+        :param latency: Seconds before response headers of each request.
+        :param bandwidth: Bytes/s of each response. None for unlimited.
+        :param error_rate: Probability of responding a segment with 503.
+        :param drop_rate: Probability of dropping the connection in the middle of a segment.
+        :param ranges: Determine whether support `Range` requests.
+        :param seed: Seed of generated data and injected errors.
+        :param port: Port to listen. None for a random one.
+        """
+        self.segments = segments
+        self.size = size
+        self.variants = variants
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.ranges = ranges
+        self._random = random.Random(seed)
+        # segment i is data[i:i+size], so that segments are distinct without keeping each of them
+        self._data = random.Random(seed).randbytes(size + segments)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.peers: set[tuple] = set()
+        app = web.Application()
+        app.router.add_get('/master.m3u8', self.master)
+        app.router.add_get('/{variant}/index.m3u8', self.playlist)
+        app.router.add_get('/{variant}/{index:\\d+}.ts', self.segment)
+        self.server = TestServer(app, port=port)
+
+    def content(self, index: int) -> bytes:
+        return self._data[index:index+self.size]
+
+    @property
+    def video(self) -> bytes:
+        """
+        Content of the whole video of a variant.
+        """
+        return b''.join(self.content(i) for i in range(self.segments))
+
+    def url(self, path: str = 'v0/index.m3u8') -> str:
+        return str(self.server.make_url(f'/{path}'))
+
+    async def master(self, _: web.Request) -> web.Response:
+        lines = ['#EXTM3U']
+        for i, bandwidth in enumerate(self.variants):
+            lines += [f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth}', f'v{i}/index.m3u8']
+        return web.Response(text='\n'.join(lines))
+
+    async def playlist(self, _: web.Request) -> web.Response:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+        for i in range(self.segments):
+            lines += ['#EXTINF:2.0,', f'{i}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines))
+
+    async def segment(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        self.peers.add(request.transport.get_extra_info('peername'))
+        index = int(request.match_info['index'])
+        if index >= self.segments:
+            raise web.HTTPNotFound()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            raise web.HTTPServiceUnavailable()
+        body = self.content(index)
+        start, stop = 0, len(body)
+        rng = request.headers.get('Range', '')
+        partial = self.ranges and rng.startswith('bytes=')
+        if partial:
+            first, _, last = rng[6:].partition('-')
+            start = int(first)
+            stop = min(int(last) + 1, len(body)) if last else len(body)
+            if start >= len(body):
+                raise web.HTTPRequestRangeNotSatisfiable(
+                    headers={'Content-Range': f'bytes */{len(body)}'})
+        headers = {'ETag': f'"{index}"', 'Accept-Ranges': 'bytes' if self.ranges else 'none'}
+        if partial:
+            headers['Content-Range'] = f'bytes {start}-{stop-1}/{len(body)}'
+        body = body[:stop]
+        drop = len(body) // 2 if self.drop_rate and self._random.random() < self.drop_rate else None
+        if not self.bandwidth and drop is None:
+            self.bytes_sent += len(body) - start
+            return web.Response(body=body[start:], status=206 if partial else 200, headers=headers)
+        response = web.StreamResponse(status=206 if partial else 200, headers=headers)
+        response.content_length = len(body) - start
+        await response.prepare(request)
+        end = len(body) if drop is None else max(drop, start)
+        for i in range(start, end, CHUNK):
+            chunk = body[i:min(i+CHUNK, end)]
+            if self.bandwidth:
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+            await response.write(chunk)
+            self.bytes_sent += len(chunk)
+        if drop is not None:
+            self.errors += 1
+            await asyncio.sleep(0.05)
+            request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.server.close()
+
+
+def _serve(ready, kwargs: dict):
+    async def main():
+        async with FakeCDN(**kwargs) as cdn:
+            ready.put(cdn.url(''))
+            await asyncio.Event().wait()
+    asyncio.run(main())
+
+
+class CDNProcess:
+    """
+    Run :class:`FakeCDN` in another process, so that it does not take CPU of the measured process.
+    """
+
+    def __init__(self, **kwargs) -> None:
+        """
+        :param kwargs: Arguments of :class:`FakeCDN`.
+        """
+        self.kwargs = kwargs
+        self.base_url = ''
+        self._process: Optional[multiprocessing.Process] = None
+
+    def url(self, path: str = 'v0/index.m3u8') -> str:
+        return f'{self.base_url}{path}'
+
+    def __enter__(self):
+        ready = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(ready, self.kwargs), daemon=True)
+        self._process.start()
+        self.base_url = ready.get(timeout=30)
+        return self
+
+    def __exit__(self, *_):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    port, segments, size = (args + [8080, 100, 1024*1024][len(args):])[:3]
+
+    async def main():
+        async with FakeCDN(segments, size, port=port) as cdn:
+            print(f'serving {cdn.url("master.m3u8")}')
+            await asyncio.Event().wait()
+    asyncio.run(main())
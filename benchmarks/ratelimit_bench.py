@@ -0,0 +1,57 @@
+"""
+Benchmark :class:`RateLimiter` in the chunk loop.
+
+First measure the cost of each :meth:`RateLimiter.consume` call without waiting, and the bandwidth
+it could sustain at a chunk size. Then download segments from a local aiohttp server without limiter,
+with a limiter far above the link, and with a cap, to compare throughput and accuracy.
+
+Usage: python -m benchmarks.ratelimit_bench [segments] [size] [cap MB/s]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from benchmarks.session_bench import CountingServer
+from download.asynchttp import AsyncHTTP
+from download.ratelimit import RateLimiter
+
+CHUNK = 64*1024
+
+
+async def overhead(calls: int = 200000):
+    for name, limiter in [('unlimited', RateLimiter()),
+                          ('no wait', RateLimiter(1e15, 1e15, requests=1e15))]:
+        host = await limiter.request('http://127.0.0.1/seg.ts')
+        start = time.perf_counter()
+        for _ in range(calls):
+            await limiter.consume(CHUNK, host)
+        ns = (time.perf_counter() - start) / calls * 1e9
+        print(f'{name:>10}: {ns:.0f}ns/chunk, '
+              f'{CHUNK * 8 / ns:.0f} Gbps of one core at {CHUNK // 1024}KB chunks')
+
+
+async def download(segments: int, size: int, limiter: Optional[RateLimiter]) -> float:
+    async with CountingServer(size) as server, AsyncHTTP(limiter=limiter) as client:
+        with tempfile.TemporaryDirectory() as tmp:
+            urls = [server.url(f'{i}.ts') for i in range(segments)]
+            fns = [os.path.join(tmp, f'{i}.ts') for i in range(segments)]
+            start = time.perf_counter()
+            await client.async_downloads(8, urls, fns)
+            return segments * size / (time.perf_counter() - start)
+
+
+async def bench(segments: int, size: int, cap: float):
+    await overhead()
+    for name, limiter in [('none', None), ('above link', RateLimiter(1e15, 1e15, requests=1e15)),
+                          (f'{cap:g}MB/s cap', RateLimiter(cap * 1024 * 1024, burst=0.1))]:
+        rate = await download(segments, size, limiter)
+        print(f'{name:>12}: {segments} segments, {rate / 1024 / 1024:.1f}MB/s')
+
+
+if __name__ == '__main__':
+    args = [float(a) for a in sys.argv[1:]]
+    segments, size, cap = (args + [200, 1024*1024, 50][len(args):])[:3]
+    asyncio.run(bench(int(segments), int(size), cap))
@@ -0,0 +1,86 @@
+"""
+Benchmark pooled :class:`AsyncHTTP` session against one session per url.
+
+Start a local aiohttp server, download segments from it and count how many
+TCP connections (handshakes) the server accepted. Both download each segment by
+:meth:`AsyncHTTP.async_download`, so they only differ in connection pooling.
+
+Usage: python -m benchmarks.session_bench [segments] [size] [concurrency]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from download.asynchttp import AsyncHTTP
+
+
+class CountingServer:
+    """
+    Local segment server which counts accepted connections.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.body = os.urandom(size)
+        self.peers: set[tuple] = set()
+        app = web.Application()
+        app.router.add_get('/{name}', self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.peers.add(request.transport.get_extra_info('peername'))
+        return web.Response(body=self.body)
+
+    @property
+    def connections(self) -> int:
+        return len(self.peers)
+
+    def url(self, name: str) -> str:
+        return str(self.server.make_url(f'/{name}'))
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.server.close()
+
+
+async def session_per_url(sem: int, urls: list[str], fns: list[str]):
+    """
+    Previous behaviour: open a new session for each url, by an :class:`AsyncHTTP` of its own.
+    """
+    semaphore = asyncio.Semaphore(sem)
+
+    async def one(index: int, url: str, fn: str):
+        async with AsyncHTTP() as client:
+            await client.async_download(index, semaphore, url, fn)
+    await asyncio.gather(*[one(i, u, f) for i, (u, f) in enumerate(zip(urls, fns))])
+
+
+async def pooled(sem: int, urls: list[str], fns: list[str]):
+    async with AsyncHTTP() as client:
+        await client.async_downloads(sem, urls, fns)
+
+
+async def bench(segments: int, size: int, sem: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, fn in [('session-per-url', session_per_url), ('pooled', pooled)]:
+            async with CountingServer(size) as server:
+                urls = [server.url(f'{i}.ts') for i in range(segments)]
+                fns = [os.path.join(tmp, f'{i}.ts') for i in range(segments)]
+                start = time.perf_counter()
+                await fn(sem, urls, fns)
+                elapsed = time.perf_counter() - start
+                print(f'{name:>16}: {segments} segments, {server.connections} connections, '
+                      f'{segments/elapsed:.1f} segments/s, {elapsed:.3f}s')
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    segments, size, sem = (args + [500, 64*1024, 8][len(args):])[:3]
+    asyncio.run(bench(segments, size, sem))
@@ -0,0 +1,193 @@
+"""
+Benchmark suite of the download pipeline against a local :class:`FakeCDN`.
+
+Each benchmark runs in a fresh process, so that its peak RSS and CPU time are its own,
+while the CDN runs in another process. It reports segments/s, MB/s, peak RSS and CPU usage,
+appends the results to :param:`--output` and compares them with the last run of the same parameters.
+
+Usage: python -m benchmarks.suite [--segments 200] [--size 1048576] [--latency 0] [--bandwidth B/s]
+       [--error-rate 0] [--concurrency 8] [--only name ...] [--output FILE]
+
+Results go to `m3u8-benchmarks.jsonl` in the system temp directory unless :param:`--output` is given.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from benchmarks.cdn import CDNProcess
+from download.asynchttp import AsyncHTTP
+from download.jobstore import JobStore
+from download.resume import Resume
+from m3u8_util.m3u8 import AioM3U8
+
+Params = dict[str, Any]
+
+
+async def bench_async_downloads(url: str, tmp: str, p: Params) -> Callable[[], Awaitable[Any]]:
+    urls = [f'{url}v0/{i}.ts' for i in range(p['segments'])]
+    fns = [os.path.join(tmp, f'{i}.ts') for i in range(p['segments'])]
+
+    async def run():
+        async with AsyncHTTP() as client:
+            await client.async_downloads(p['concurrency'], urls, fns, retry=5)
+    return run
+
+
+async def bench_aiom3u8(url: str, tmp: str, p: Params, stream: bool = False) -> Callable[[], Awaitable[Any]]:
+    async def run():
+        await AioM3U8.download(os.path.join(tmp, 'index.m3u8'), f'{url}v0/', os.path.join(tmp, 'out.ts'), f'{url}v0/index.m3u8',
+                               os.path.join(tmp, 'segs'), retry=5, concurrency=p['concurrency'], stream=stream)
+    return run
+
+
+async def bench_aiom3u8_stream(url: str, tmp: str, p: Params) -> Callable[[], Awaitable[Any]]:
+    return await bench_aiom3u8(url, tmp, p, True)
+
+
+async def bench_combine_segs(url: str, tmp: str, p: Params) -> Callable[[], Awaitable[Any]]:
+    md = AioM3U8(os.path.join(tmp, 'index.m3u8'), os.path.join(tmp, 'segs'),
+                 retry=5, concurrency=p['concurrency'])
+    await md.download_m3u8(f'{url}v0/index.m3u8')
+    await md.download_segs(f'{url}v0/')
+    await md.close()
+
+    async def run():
+        md.combine_segs(os.path.join(tmp, 'out.ts'))
+    return run
+
+
+async def bench_resume(url: str, tmp: str, p: Params, store: bool = False) -> Callable[[], Awaitable[Any]]:
+    async def callback(_: str) -> bool:
+        return True
+
+    async def run():
+        resume = JobStore(os.path.join(tmp, 'jobs.db')) if store else Resume(
+            *[os.path.join(tmp, fn) for fn in ['s.log', 'e.log', 'c.log']])
+        async with resume:
+            for i in range(p['segments']):
+                await resume.run(f'{url}{i}', callback)
+    return run
+
+
+async def bench_jobstore(url: str, tmp: str, p: Params) -> Callable[[], Awaitable[Any]]:
+    return await bench_resume(url, tmp, p, True)
+
+
+BENCHMARKS: dict[str, Callable[[str, str, Params], Awaitable[Callable[[], Awaitable[Any]]]]] = {
+    'async_downloads': bench_async_downloads,
+    'aiom3u8': bench_aiom3u8,
+    'aiom3u8_stream': bench_aiom3u8_stream,
+    'combine_segs': bench_combine_segs,
+    'resume': bench_resume,
+    'jobstore': bench_jobstore,
+}
+"""Name and setup of each benchmark, which returns the coroutine function to measure."""
+
+NETWORK = {'async_downloads', 'aiom3u8', 'aiom3u8_stream', 'combine_segs'}
+"""Benchmarks which transfer segments, so that MB/s is reported."""
+
+
+def _cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _measure(name: str, url: str, p: Params, results: multiprocessing.Queue):
+    async def main() -> dict[str, Any]:
+        with tempfile.TemporaryDirectory() as tmp:
+            run = await BENCHMARKS[name](url, tmp, p)
+            cpu = _cpu()
+            start = time.perf_counter()
+            await run()
+            elapsed = time.perf_counter() - start
+            cpu = _cpu() - cpu
+        size = p['segments'] * p['size'] if name in NETWORK else 0
+        return {'name': name, 'elapsed': elapsed, 'segments_per_s': p['segments'] / elapsed,
+                'mb_per_s': size / elapsed / 1024 / 1024, 'cpu_percent': cpu / elapsed * 100,
+                # KB on linux
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    results.put(asyncio.run(main()))
+
+
+def measure(name: str, url: str, p: Params) -> dict[str, Any]:
+    """
+    Run benchmark :param:`name` in a new process against CDN at :param:`url`.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(name, url, p, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ''
+
+
+def _last(output: str, p: Params) -> Optional[dict[str, Any]]:
+    if not os.path.exists(output):
+        return None
+    last = None
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            run = json.loads(line)
+            if run['params'] == p:
+                last = run
+    return last
+
+
+def run(p: Params, names: list[str], output: str, tolerance: float = 0.1) -> list[dict[str, Any]]:
+    """
+    Run :param:`names` benchmarks, save and compare results.
+
+    :param tolerance: Fraction of throughput lower than the last run to report as a regression.
+    """
+    last = _last(output, p)
+    previous = {r['name']: r for r in last['results']} if last else {}
+    cdn = {k: p[k] for k in ['segments', 'size', 'latency', 'bandwidth', 'error_rate']}
+    results = []
+    with CDNProcess(**cdn) as server:
+        for name in names:
+            r = measure(name, server.url(''), p)
+            results.append(r)
+            line = (f"{name:>16}: {r['segments_per_s']:9.1f} segments/s, {r['mb_per_s']:8.1f}MB/s, "
+                    f"{r['peak_rss_mb']:7.1f}MB peak RSS, {r['cpu_percent']:5.1f}% CPU")
+            if name in previous:
+                change = r['segments_per_s'] / previous[name]['segments_per_s'] - 1
+                line += f', {change:+.1%}'
+                if change < -tolerance:
+                    line += ' REGRESSION'
+            print(line)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'time': time.time(), 'commit': _commit(), 'params': p, 'results': results}) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the download pipeline against a local fake CDN.')
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--size', type=int, default=1024*1024, help='bytes of each segment')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before response headers')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes/s of each response')
+    parser.add_argument('--error-rate', type=float, default=0, help='probability of 503 of each segment')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(), 'm3u8-benchmarks.jsonl'),
+                        help='JSON lines file of results, outside of the repository by default')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    params = {k: getattr(args, k) for k in ['segments', 'size', 'latency', 'bandwidth', 'error_rate', 'concurrency']}
+    run(params, args.only, args.output, args.tolerance)
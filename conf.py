@@ -1,5 +1,5 @@
 import os
-from typing import Literal
+from typing import Literal, Optional
 
 CONTINUE = True
 # Determine whether continue download
@@ -15,7 +15,48 @@ TMP_DIR = os.path.join(DATA_DIR, 'tmp')
 
 MODE: Literal['aio', 'ff'] = 'aio'
 RETRY: int = 3
+STREAM: bool = False
+"""Opt-in. Write segments to video in order while downloading, only for aio mode.
+It bypasses the segment cache and per-segment resume, and mp4 output needs a second copy on disk."""
+ADAPTIVE: bool = False
+"""Opt-in. Adjust concurrency of segments by throughput, latency and errors."""
+VIDEOS: int = 4
+"""Max count of videos downloading at the same time."""
+WORKERS: int = 1
+"""Count of worker processes sharing VIDEOS, CONNECTIONS and bandwidth limits. 1 to download in this process."""
+CONNECTIONS: int = 32
+"""Max connections of all videos. Each video gets CONNECTIONS // VIDEOS as its segment concurrency."""
+BANDWIDTH: Optional[float] = None
+"""Max bytes/s of all downloads. None for unlimited."""
+HOST_BANDWIDTH: Optional[float] = None
+"""Max bytes/s of each host. None for unlimited."""
+HOSTS_BANDWIDTH: dict[str, float] = {}
+"""Max bytes/s of specified hosts, such as `{'cdn.example.com': 2*1024*1024}`."""
+REQUESTS_PER_SECOND: Optional[float] = None
+"""Max requests/s of all downloads. None for unlimited."""
+CONTAINER: Literal['ts', 'mp4'] = 'ts'
+"""Output container. mp4 is remuxed by ffmpeg with stream copy, overlapping with downloads of next videos."""
+PARTS: int = 1
+"""Split each segment of at least 16MB into up to this count of concurrent `Range` requests. 1 to disable."""
+VERIFY: bool = False
+"""Opt-in. Check MPEG-TS sync bytes of segments while downloading, and download broken ones again."""
+DIGEST: Optional[str] = None
+"""hashlib algorithm of digests of segments recorded in manifest of each video, such as `sha256`. None to disable."""
+WRITE_BUFFER: int = 1024*1024
+"""Bytes of received data to coalesce into one write of each file."""
+FSYNC: Literal['never', 'close', 'flush'] = 'never'
+"""When to fsync downloaded files: never, once when closed, or after each write."""
+MIN_FREE_SPACE: int = 0
+"""Opt-in, such as `1024*1024*1024`. Bytes to keep free on volumes of segments and videos. A video fails before downloading if its estimated size does not fit."""
 
+JOBS_DB: str = os.path.join('logs', 'jobs.db')
+"""SQLite database to record status of each video. Keys in log files of `Resume` are imported at the first time."""
+CACHE_DIR: Optional[str] = None
+"""Directory of segment cache shared by all videos, such as `os.path.join(DATA_DIR, 'cache')`. None to disable."""
+CACHE_SIZE: int = 10*1024*1024*1024
+"""Max bytes of segment cache. Least recently used segments are evicted."""
+METRICS: Optional[str] = os.path.join('logs', 'metrics.prom')
+"""File to save metrics when finished, in JSON if it ends with `.json`, otherwise in Prometheus text. None to disable metrics."""
 RS_CHECK_FN: bool = True
 """Determine whether skip download by filename when resume"""
 
@@ -1,53 +1,788 @@
 import asyncio
+import json
+import os
+import time
 import traceback
 from asyncio import Semaphore
-from typing import Any, Callable, Iterable, Optional, TypeVar, Union
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Iterable, Optional, TypeVar, Union
+from urllib.parse import urlsplit
 
-import aiofiles
 import aiohttp
 from aiohttp.client import ClientTimeout
 from al_utils.logger import Logger
 
+from download.metrics import Metrics
+from download.ratelimit import RateLimiter
+from download.retry import RetryPolicy
 from download.util import human_size
+from download.verify import Verifier, VerifyError
+from download.writer import FileWriter, FsyncPolicy, preallocate
 
 logger = Logger(__file__).logger
 
 CBT = TypeVar('CBT')
 
+META_SUFFIX = '.meta'
+"""Suffix of sidecar file of each downloaded file."""
+
+
+def _content_length(response: aiohttp.ClientResponse) -> Optional[int]:
+    """
+    Total length of the resource, from `Content-Range` or `Content-Length`.
+    None if unknown or the body is encoded, because the decoded size is different.
+    """
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    if response.status == 206:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+        return None
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+THROTTLE_STATUS = (429, 503)
+"""Status codes which mean server is overloaded."""
+
+
+def _retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    """
+    Seconds to wait from `Retry-After` header, in seconds or HTTP date.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveSemaphore:
+    """
+    Concurrency controller which grows and shrinks its limit in AIMD style.
+    It can be used in place of :class:`asyncio.Semaphore`.
+
+    Completed requests are grouped into rounds of :attr:`limit` requests. At the end of each round,
+    the limit is increased by :param:`increase` if throughput does not drop and latency stays
+    under :param:`latency_tolerance` times of the lowest seen. Errors and throttle status
+    (429, 503) decrease it by :param:`decrease` times, at most once per round, and
+    `Retry-After` pauses new requests.
+    """
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 64, increase: int = 1, decrease: float = 0.5, latency_tolerance: float = 2.0, name: str = '') -> None:
+        """
+        :param initial: Initial limit.
+        :param min_limit: Min limit.
+        :param max_limit: Max limit.
+        :param increase: Additive increase of limit each round.
+        :param decrease: Multiplicative decrease factor of limit when throttled or failed.
+        :param latency_tolerance: Stop increase when average latency is more than this times of the lowest.
+        :param name: Name in logs.
+        """
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError(
+                f'min_limit and max_limit must be 1 <= min_limit <= max_limit, but got {min_limit} {max_limit}')
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.name = name
+        self._limit = min(max(initial, min_limit), max_limit)
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._paused_until = 0.0
+        self._round_start = time.monotonic()
+        self._round_done = 0
+        self._round_bytes = 0
+        self._round_latency = 0.0
+        self._round_failed = False
+        self._last_throughput = 0.0
+        self._last_increased = False
+        self._min_latency = float('inf')
+
+    @property
+    def limit(self) -> int:
+        """Current max concurrency."""
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        """Count of acquired."""
+        return self._in_flight
+
+    def locked(self) -> bool:
+        return self._in_flight >= self._limit
+
+    async def acquire(self):
+        while True:
+            wait = self._paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            if self._in_flight < self._limit:
+                self._in_flight += 1
+                return True
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done():
+                    self._wake()
+                else:
+                    self._waiters.remove(waiter)
+                raise
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = self._limit - self._in_flight
+        while self._waiters and free > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *_):
+        self.release()
+
+    def _set_limit(self, limit: int, reason: str):
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if limit == self._limit:
+            return
+        logger.info(
+            f'{self.name} concurrency {self._limit} -> {limit}, {reason}')
+        self._limit = limit
+        self._wake()
+
+    def success(self, nbytes: int, elapsed: float):
+        """
+        Record a successful request.
+
+        :param nbytes: Received bytes.
+        :param elapsed: Seconds from request sent to body received.
+        """
+        self._min_latency = min(self._min_latency, elapsed)
+        self._round_done += 1
+        self._round_bytes += nbytes
+        self._round_latency += elapsed
+        if self._round_done >= self._limit:
+            self._end_round()
+
+    def failure(self, status: Optional[int] = None, retry_after: Optional[float] = None):
+        """
+        Record a failed request.
+
+        :param status: Response status, None if request raised.
+        :param retry_after: Seconds to pause new requests.
+        """
+        if retry_after:
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + retry_after)
+            logger.info(
+                f'{self.name} concurrency paused {retry_after:.1f}s, Retry-After of {status}')
+        if self._round_failed:
+            return
+        self._round_failed = True
+        self._last_increased = False
+        self._set_limit(int(self._limit * self.decrease),
+                        f'status {status}' if status else 'request error')
+
+    def _end_round(self):
+        elapsed = max(time.monotonic() - self._round_start, 1e-6)
+        throughput = self._round_bytes / elapsed
+        latency = self._round_latency / self._round_done
+        if self._round_failed:
+            pass
+        elif self._last_increased and throughput < self._last_throughput * 0.9:
+            self._last_increased = False
+            self._set_limit(self._limit - self.increase,
+                            f'throughput dropped {human_size(self._last_throughput)}/s -> {human_size(throughput)}/s')
+        elif latency > self._min_latency * self.latency_tolerance:
+            self._last_increased = False
+            logger.debug(
+                f'{self.name} concurrency hold {self._limit}, latency {latency:.3f}s')
+        elif self._in_flight >= self._limit - 1:
+            self._last_increased = self._limit < self.max_limit
+            self._set_limit(self._limit + self.increase,
+                            f'throughput {human_size(throughput)}/s, latency {latency:.3f}s')
+        self._last_throughput = throughput
+        self._round_start = time.monotonic()
+        self._round_done = 0
+        self._round_bytes = 0
+        self._round_latency = 0.0
+        self._round_failed = False
+
+
+def _feedback(semaphore: Any, status: Optional[int], nbytes: int = 0, elapsed: float = 0, retry_after: Optional[float] = None):
+    """
+    Report result of a request to :param:`semaphore` if it is an :class:`AdaptiveSemaphore`.
+    """
+    if not isinstance(semaphore, AdaptiveSemaphore):
+        return
+    if status is not None and status < 400:
+        semaphore.success(nbytes, elapsed)
+    elif status is None or status in THROTTLE_STATUS or status >= 500:
+        semaphore.failure(status, retry_after)
+
 
 class AsyncHTTP:
     """
     Asynchronous HTTP requests. Wrapper for :module:`aiohttp`
+
+    All requests share one long-lived :class:`aiohttp.ClientSession` with a keep-alive connector,
+    so connections (and TCP/TLS handshakes) are reused across segments and playlists.
+    Use it as an async context manager or call :meth:`close` when done.
     """
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, limit: int = 100, limit_per_host: int = 32, ttl_dns_cache: Optional[int] = 300, keepalive_timeout: float = 60, headers: Optional[dict[str, str]] = None, policy: Optional[RetryPolicy] = None, limiter: Optional[RateLimiter] = None, metrics: Optional[Metrics] = None, write_buffer: int = 1024*1024, fsync: FsyncPolicy = 'never') -> None:
+        """
+        :param limit: Max connections in the pool.
+        :param limit_per_host: Max connections to the same host.
+        :param ttl_dns_cache: Seconds to cache resolved DNS entries. None to cache forever.
+        :param keepalive_timeout: Seconds to keep an idle connection alive.
+        :param headers: Default headers of each request.
+        :param policy: Backoff, retry classification and circuit breakers shared by all requests.
+        :param limiter: Bandwidth and request rate limits shared by all requests. It can be replaced at runtime.
+        :param metrics: Record timings of request phases, bytes and retries. None to disable.
+        :param write_buffer: Bytes of received chunks to coalesce into one write of each file.
+        :param fsync: When to fsync downloaded files, see :data:`FsyncPolicy`.
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.headers = headers
+        self.policy = policy or RetryPolicy()
+        self.limiter = limiter
+        self.metrics = metrics
+        self.write_buffer = write_buffer
+        self.fsync = fsync
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Shared client session. It will be created in the running event loop when first used.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=self.ttl_dns_cache, use_dns_cache=True, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=self.headers, timeout=ClientTimeout(0),
+                trace_configs=[self.metrics.trace_config()] if self.metrics else None)
+        return self._session
+
+    async def close(self):
+        """
+        Close the shared session and all pooled connections.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
 
-    async def async_download(self, index: int, semaphore: Semaphore, url: str, file_name: str, headers: Optional[dict[str, str]] = {}, proxy: Optional[str] = None, chunk_size: int = 1024*1024, retry: int = 3):
+    async def __aexit__(self, *_):
+        await self.close()
+
+    @staticmethod
+    def meta_fn(file_name: str) -> str:
+        """
+        Sidecar file which records url, expected length and ETag of :param:`file_name`.
+        """
+        return f'{file_name}{META_SUFFIX}'
+
+    @staticmethod
+    def _load_meta(file_name: str) -> dict[str, Any]:
+        fn = AsyncHTTP.meta_fn(file_name)
+        if not os.path.exists(fn):
+            return {}
+        try:
+            with open(fn, encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            logger.warning(f'broken meta {fn}', exc_info=True)
+            return {}
+
+    @staticmethod
+    def _dump_meta(file_name: str, meta: dict[str, Any]):
+        with open(AsyncHTTP.meta_fn(file_name), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    async def read_meta(file_name: str) -> dict[str, Any]:
+        """
+        Read sidecar of :param:`file_name`. Return empty dict if not exists or broken.
+        """
+        if not os.path.exists(AsyncHTTP.meta_fn(file_name)):
+            return {}
+        return await asyncio.get_running_loop().run_in_executor(None, AsyncHTTP._load_meta, file_name)
+
+    @staticmethod
+    async def write_meta(file_name: str, meta: dict[str, Any]):
+        await asyncio.get_running_loop().run_in_executor(None, AsyncHTTP._dump_meta, file_name, meta)
+
+    @staticmethod
+    def _complete(file_name: str, meta: dict[str, Any], url: Optional[str] = None) -> bool:
+        if not meta.get('complete') or (url is not None and meta.get('url') != url):
+            return False
+        if not os.path.exists(file_name):
+            return False
+        return meta.get('length') is None or os.path.getsize(file_name) == meta['length']
+
+    @staticmethod
+    async def is_complete(file_name: str, url: Optional[str] = None) -> bool:
+        """
+        Whether :param:`file_name` has been downloaded completely from :param:`url`, checked by its sidecar.
+        """
+        return AsyncHTTP._complete(file_name, await AsyncHTTP.read_meta(file_name), url)
+
+    @staticmethod
+    def remove(file_name: str):
+        """
+        Remove :param:`file_name` and its sidecar.
+        """
+        for fn in [file_name, AsyncHTTP.meta_fn(file_name)]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    @staticmethod
+    def _preallocate(file_name: str, length: int):
+        fd = os.open(file_name, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            preallocate(fd, length)
+        finally:
+            os.close(fd)
+
+    def _failed(self, semaphore: Any, url: str, response: aiohttp.ClientResponse) -> Optional[float]:
+        """
+        Report a failed :param:`response`.
+
+        :return: Seconds of its `Retry-After`.
+        """
+        retry_after = _retry_after(
+            response) if response.status in THROTTLE_STATUS else None
+        _feedback(semaphore, response.status, retry_after=retry_after)
+        self.policy.failure(url, response.status)
+        return retry_after
+
+    async def _receive(self, url: str, response: aiohttp.ClientResponse, writer: FileWriter, verifier: Optional[Verifier], start: int, end: int, chunk_size: int, host: Optional[str]) -> float:
+        """
+        Write the body of :param:`response` in place by :param:`writer` up to inclusive :param:`end`.
+        A 206 response must not send more, the body of a 200 one is read until :param:`end` and the rest is left.
+
+        :return: Seconds of writing.
+        """
+        limiter = self.limiter
+        elapsed = 0.0
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if writer.end + len(chunk) > end + 1:
+                if response.status == 206:
+                    raise IOError(
+                        f'{url} sent more than range {start}-{end}')
+                chunk = chunk[:end + 1 - writer.end]
+            if verifier:
+                verifier.update(chunk, writer.end)
+            if limiter:
+                await limiter.consume(len(chunk), host)
+            t = time.monotonic()
+            await writer.write(chunk)
+            elapsed += time.monotonic() - t
+            if writer.end > end:
+                break
+        return elapsed
+
+    async def _download_part(self, index: int, url: str, file_name: str, verifier: Optional[Verifier], start: int, end: int, headers: Optional[dict[str, str]], proxy: Optional[str], etag: Optional[str], chunk_size: int, retry: int) -> bool:
+        """
+        Download inclusive range :param:`start` to :param:`end` of :param:`url` in place into :param:`file_name`.
+        A failed attempt is continued from the last written byte.
+
+        :return: False if server answered the whole resource instead, because it has changed.
+        """
+        client = self.session
+        pos = start
+        for i in range(retry):
+            await self.policy.acquire(url)
+            metrics = self.metrics
+            if i and metrics:
+                metrics.retry(urlsplit(url).hostname or '')
+            limiter = self.limiter
+            host = await limiter.request(url) if limiter else None
+            retry_after = None
+            try:
+                h = {**(headers or {}), 'Range': f'bytes={pos}-{end}'}
+                if etag:
+                    h['If-Range'] = etag
+                async with client.get(url=url, headers=h, proxy=proxy) as response:
+                    if response.status == 206:
+                        first = pos
+                        body, elapsed = time.monotonic(), 0.0
+                        writer = FileWriter(file_name, pos, end + 1 - pos, self.write_buffer, self.fsync)
+                        try:
+                            await writer.open()
+                            elapsed = await self._receive(url, response, writer, verifier, start, end, chunk_size, host)
+                        finally:
+                            t = time.monotonic()
+                            await writer.close()
+                            elapsed += time.monotonic() - t
+                            pos = writer.position
+                        if pos != end + 1:
+                            raise IOError(
+                                f'{url} expected range {start}-{end}, but got {start}-{pos-1}')
+                        if metrics:
+                            metrics.body(response.url.host or '', pos - first,
+                                         time.monotonic() - body, elapsed)
+                        self.policy.success(url)
+                        logger.debug(f'{index}, {url}, part {start}-{end}')
+                        return True
+                    elif response.ok:
+                        self.policy.success(url)
+                        return False
+                    else:
+                        logger.error(
+                            f'{index}, {i}, {url}, part {start}-{end}, {response.status}')
+                        retry_after = self._failed(None, url, response)
+                        if not self.policy.retryable(response.status):
+                            break
+            except Exception as ex:
+                self.policy.failure(url, exc=ex)
+                logger.error(
+                    f'{index}, {i}, {url}, part {start}-{end}', exc_info=True, stack_info=True)
+                if not self.policy.retryable(exc=ex):
+                    break
+            if i < retry - 1:
+                await self.policy.sleep(i, retry_after)
+        raise IOError(
+            f'Download failed {url} part {start}-{end} in {i+1} retries')
+
+    async def _download_parts(self, index: int, semaphore: Any, url: str, file_name: str, headers: Optional[dict[str, str]], proxy: Optional[str], meta: dict[str, Any], count: int, chunk_size: int, retry: int, verify: Optional[Callable[[], Optional[Verifier]]], response: Optional[aiohttp.ClientResponse] = None, host: Optional[str] = None) -> bool:
+        """
+        Download :param:`url` in :param:`count` ranges concurrently, written in place into preallocated :param:`file_name`.
+        Completed ranges are recorded in the sidecar, so an interrupted download only fetches the rest.
+
+        :param meta: Sidecar of the download, its `length`, `etag` and completed `parts`.
+        :param response: Response of the whole resource, whose body is read for the first range instead of requesting it.
+        :param host: Host of :param:`response` in :attr:`limiter`.
+        :return: False if it is not downloaded, because the resource has changed.
+        """
+        length, etag = meta['length'], meta['etag']
+        done = {tuple(p) for p in meta['parts']}
+        ranges = [(length * k // count, length * (k + 1) // count - 1)
+                  for k in range(count)]
+        await self.write_meta(file_name, meta)
+        lock = asyncio.Lock()
+        verifier = verify() if verify else None
+        if verifier:
+            verifier.skip(sum(end - start + 1 for start, end in ranges if (start, end) in done))
+
+        async def first(start: int, end: int) -> int:
+            """
+            Read the first range from :param:`response`, a failed one is continued by a range request.
+            """
+            writer = FileWriter(file_name, start, end + 1 - start, self.write_buffer, self.fsync)
+            try:
+                await writer.open()
+                await self._receive(url, response, writer, verifier, start, end, chunk_size, host)  # type: ignore
+            except VerifyError:
+                raise
+            except Exception:
+                logger.warning(f'{index}, {url}, part {start}-{end} failed, continue it', exc_info=True)
+            finally:
+                await writer.close()
+                # the rest of body is not read, so its connection is not reused
+                response.close()  # type: ignore
+            return writer.position
+
+        async def part(start: int, end: int) -> bool:
+            pos = await first(start, end) if response is not None and not start else start
+            if pos <= end and not await self._download_part(index, url, file_name, verifier, pos, end, headers, proxy, etag, chunk_size, retry):
+                return False
+            async with lock:
+                meta['parts'].append([start, end])
+                await self.write_meta(file_name, meta)
+            return True
+        begin = time.monotonic()
+        await asyncio.get_running_loop().run_in_executor(None, self._preallocate, file_name, length)
+        tasks = [asyncio.ensure_future(part(*r))
+                 for r in ranges if r not in done]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        if not all(results):
+            logger.warning(f'{index}, {url}, changed while downloading parts, restart')
+            self.remove(file_name)
+            return False
+        try:
+            digests = verifier.finalize(length) if verifier else {}
+        except VerifyError:
+            self.remove(file_name)
+            raise
+        meta['complete'] = True
+        await self.write_meta(file_name, {**meta, **digests})
+        _feedback(semaphore, 206, length, time.monotonic() - begin)
+        logger.info(
+            f'{index}, {url}, {human_size(length)} in {len(ranges)} parts, {len(done)} resumed')
+        return True
+
+    async def async_download(self, index: int, semaphore: Semaphore, url: str, file_name: str, headers: Optional[dict[str, str]] = {}, proxy: Optional[str] = None, chunk_size: int = 1024*1024, retry: int = 3, resume: bool = True, byte_range: Optional[tuple[int, int]] = None, parts: int = 1, part_size: int = 8*1024*1024, verify: Optional[Callable[[], Optional[Verifier]]] = None):
+        """
+        Asynchronous download :param:`url` to :param:`file_name`.
+
+        A sidecar :meth:`meta_fn` records the url, expected length and ETag. It is read only if :param:`file_name` exists,
+        and written once completed, and before partial data is left in :param:`file_name`:
+        when the body is larger than the write buffer or it continues a partial file.
+        If :param:`resume`, a completed file is skipped, and a partial file is continued with a `Range` request from its current size.
+        It restarts from zero if server ignores the range or the resource has changed.
+
+        :param resume: Determine whether resume from a partial or completed file.
+        :param byte_range: Only download this inclusive range of :param:`url`. Server must support ranges.
+        :param parts: Split a resource of at least two :param:`part_size` into up to this count of ranges,
+            which are downloaded concurrently in one slot of :param:`semaphore`, so a per-connection throttle
+            of server does not cap the download. It is split by the length of the first response, whose body is the first range,
+            if server accepts ranges. Otherwise it is downloaded by the first response alone.
+        :param part_size: Min bytes of each part.
+        :param verify: Factory of a :class:`Verifier` for each attempt, which checks each chunk while receiving.
+            Its digests are recorded in the sidecar. A file which fails verification is downloaded again from the start.
+        """
         if not retry or retry < 0:
             retry = 3
         async with semaphore:
-            async with aiohttp.ClientSession(timeout=ClientTimeout(0)) as client:
-                for i in range(retry):
-                    try:
-                        response = await client.get(
-                            url=url, headers=headers, proxy=proxy)
+            client = self.session
+            rng = list(byte_range) if byte_range else None
+            split = parts > 1 and byte_range is None
+            meta: dict[str, Any] = {}
+            # checked once, a new download has no file to resume or remove
+            exists = os.path.exists(file_name)
+            if resume and exists:
+                meta = await self.read_meta(file_name)
+                if meta.get('url') != url or meta.get('range') != rng:
+                    meta = {}
+                if meta and self._complete(file_name, meta, url):
+                    logger.info(f'{index}, {url}, skip completed')
+                    return
+            for i in range(retry):
+                await self.policy.acquire(url)
+                metrics = self.metrics
+                if i and metrics:
+                    metrics.retry(urlsplit(url).hostname or '')
+                limiter = self.limiter
+                host = await limiter.request(url) if limiter else None
+                retry_after = None
+                try:
+                    if not resume:
+                        meta = {}
+                    if i:
+                        exists = os.path.exists(file_name)
+                    count = min(parts, meta['length'] // part_size) if split and meta.get('parts') is not None else 0
+                    if count > 1 and exists and os.path.getsize(file_name) == meta['length']:
+                        # the sidecar of an interrupted download in parts gives its length, only the rest of parts is requested
+                        if await self._download_parts(index, semaphore, url, file_name, headers, proxy, meta, count, chunk_size, retry, verify):
+                            return
+                        meta = {}
+                    # a file downloaded in parts is preallocated, its size is not the downloaded bytes
+                    offset = os.path.getsize(file_name) if meta.get(
+                        'length') and meta.get('parts') is None and exists else 0
+                    h = dict(headers or {})
+                    if byte_range:
+                        h['Range'] = f'bytes={byte_range[0]+offset}-{byte_range[1]}'
+                    elif offset:
+                        h['Range'] = f'bytes={offset}-'
+                    if offset and meta.get('etag'):
+                        h['If-Range'] = meta['etag']
+                    start = time.monotonic()
+                    async with client.get(url=url, headers=h, proxy=proxy) as response:
+                        if byte_range and response.status == 200:
+                            if not offset:
+                                logger.error(
+                                    f'{index}, {url}, server does not support range {byte_range[0]}-{byte_range[1]}')
+                                break
+                            self.remove(file_name)
+                            meta = {}
+                            raise IOError(f'{url} has changed while resuming')
+                        if response.status == 416 and offset and offset == meta['length'] and not byte_range:
+                            await self.write_meta(file_name, {**meta, 'complete': True})
+                            self.policy.success(url)
+                            logger.info(f'{index}, {url}, skip completed')
+                            return
                         if response.ok:
-                            length = int(response.headers.get(
-                                'Content-Length', '0'))
-                            async with aiofiles.open(file_name, 'wb') as f:
+                            length = byte_range[1] - byte_range[0] + \
+                                1 if byte_range else _content_length(response)
+                            if response.status == 206 and offset:
+                                logger.info(
+                                    f'{index}, {url}, resume from {human_size(offset)}')
+                            else:
+                                offset = 0
+                                # unlink instead of truncate, it may be a hardlink of a cached segment
+                                if exists:
+                                    self.remove(file_name)
+                            meta = {'url': url, 'length': length, 'etag': response.headers.get(
+                                'ETag'), 'complete': False}
+                            if rng:
+                                meta['range'] = rng
+                            count = min(parts, length // part_size) if split and length and response.status == 200 \
+                                and 'bytes' in response.headers.get('Accept-Ranges', '') else 0
+                            if count > 1:
+                                meta['parts'] = []
+                                if await self._download_parts(index, semaphore, url, file_name, headers, proxy, meta, count, chunk_size, retry, verify, response, host):
+                                    self.policy.success(url)
+                                    return
+                                meta = {}
+                                raise IOError(f'{url} has changed while downloading parts')
+                            if offset:
+                                await self.write_meta(file_name, meta)
+                            recorded = bool(offset) or not length
+                            verifier = verify() if verify else None
+                            if verifier and offset:
+                                verifier.skip(offset)
+                            body, write = time.monotonic(), 0.0
+                            async with FileWriter(file_name, offset, length - offset if length else None, self.write_buffer, self.fsync) as writer:
                                 async for chunk in response.content.iter_chunked(chunk_size):
-                                    await f.write(chunk)
+                                    if verifier:
+                                        verifier.update(chunk)
+                                    if limiter:
+                                        await limiter.consume(len(chunk), host)
+                                    if metrics:
+                                        t = time.monotonic()
+                                        await writer.write(chunk)
+                                        write += time.monotonic() - t
+                                    else:
+                                        await writer.write(chunk)
+                                    if not recorded and writer.writes:
+                                        # partial data is on disk now, record what it is so that it can be resumed
+                                        recorded = True
+                                        await self.write_meta(file_name, meta)
+                            size = writer.position
+                            if length is not None and size != length:
+                                raise IOError(
+                                    f'{url} expected {length} bytes, but got {size}')
+                            digests = verifier.finalize(length) if verifier else {}
+                            await self.write_meta(file_name, {**meta, 'length': size, 'complete': True, **digests})
+                            if metrics:
+                                metrics.body(response.url.host or '', size - offset,
+                                             time.monotonic() - body, write)
+                            _feedback(semaphore, response.status, size - offset,
+                                      time.monotonic() - start)
+                            self.policy.success(url)
                             logger.info(
-                                f'{index}, {url}, {human_size(length)}')
+                                f'{index}, {url}, {human_size(size)}')
                             return
                         else:
                             logger.error(
                                 f'{index}, {i}, {url}, {response.status}')
-                    except Exception:
-                        logger.error(
-                            f'{index}, {i}, {url}', exc_info=True, stack_info=True)
-                raise IOError(f'Download failed {url} in {retry} retries')
+                            retry_after = self._failed(
+                                semaphore, url, response)
+                            if not self.policy.retryable(response.status):
+                                break
+                except Exception as ex:
+                    if isinstance(ex, VerifyError):
+                        # restart from zero instead of resuming after bad data
+                        self.remove(file_name)
+                        meta = {}
+                    _feedback(semaphore, None)
+                    self.policy.failure(url, exc=ex)
+                    logger.error(
+                        f'{index}, {i}, {url}', exc_info=True, stack_info=True)
+                    if not self.policy.retryable(exc=ex):
+                        break
+                if i < retry - 1:
+                    await self.policy.sleep(i, retry_after)
+            raise IOError(f'Download failed {url} in {i+1} retries')
+
+    async def async_read(self, index: int, semaphore: Semaphore, url: str, headers: Optional[dict[str, str]] = {}, proxy: Optional[str] = None, chunk_size: int = 1024*1024, retry: int = 3, transform: Optional[Callable[[], Any]] = None, byte_range: Optional[tuple[int, int]] = None, verify: Optional[Callable[[], Optional[Verifier]]] = None) -> bytes:
+        """
+        Asynchronous download :param:`url` into memory.
+
+        :param transform: Factory of a transformer for each attempt, such as a decryptor.
+            Each chunk is passed to its `async update(bytes) -> bytes` as soon as received, then `async finalize() -> bytes`.
+        :param byte_range: Only download this inclusive range of :param:`url`. Server must support ranges.
+        :param verify: Factory of a :class:`Verifier` for each attempt, which checks the transformed body while receiving.
+        :return: Response body, transformed if :param:`transform` is set.
+        """
+        if not retry or retry < 0:
+            retry = 3
+        if byte_range:
+            headers = {**(headers or {}),
+                       'Range': f'bytes={byte_range[0]}-{byte_range[1]}'}
+        async with semaphore:
+            client = self.session
+            for i in range(retry):
+                await self.policy.acquire(url)
+                metrics = self.metrics
+                if i and metrics:
+                    metrics.retry(urlsplit(url).hostname or '')
+                limiter = self.limiter
+                host = await limiter.request(url) if limiter else None
+                retry_after = None
+                try:
+                    start = time.monotonic()
+                    async with client.get(url=url, headers=headers, proxy=proxy) as response:
+                        if byte_range and response.status == 200:
+                            logger.error(
+                                f'{index}, {url}, server does not support range {byte_range[0]}-{byte_range[1]}')
+                            break
+                        if response.ok:
+                            data = bytearray()
+                            body = time.monotonic()
+                            t = transform() if transform else None
+                            verifier = verify() if verify else None
+                            async for chunk in response.content.iter_chunked(chunk_size):
+                                if limiter:
+                                    await limiter.consume(len(chunk), host)
+                                out = await t.update(chunk) if t else chunk
+                                if verifier:
+                                    verifier.update(out)
+                                data += out
+                            if t:
+                                out = await t.finalize()
+                                if verifier:
+                                    verifier.update(out)
+                                data += out
+                            if verifier:
+                                verifier.finalize()
+                            if metrics:
+                                metrics.body(response.url.host or '',
+                                             len(data), time.monotonic() - body)
+                            _feedback(semaphore, response.status, len(data),
+                                      time.monotonic() - start)
+                            self.policy.success(url)
+                            logger.info(
+                                f'{index}, {url}, {human_size(len(data))}')
+                            return bytes(data)
+                        else:
+                            logger.error(
+                                f'{index}, {i}, {url}, {response.status}')
+                            retry_after = self._failed(
+                                semaphore, url, response)
+                            if not self.policy.retryable(response.status):
+                                break
+                except Exception as ex:
+                    _feedback(semaphore, None)
+                    self.policy.failure(url, exc=ex)
+                    logger.error(
+                        f'{index}, {i}, {url}', exc_info=True, stack_info=True)
+                    if not self.policy.retryable(exc=ex):
+                        break
+                if i < retry - 1:
+                    await self.policy.sleep(i, retry_after)
+            raise IOError(f'Download failed {url} in {i+1} retries')
 
     async def async_get(self, index: int, semaphore: Semaphore, url: str, callback: Callable[[int, str, str], CBT], headers: Optional[dict[str, str]] = None, proxy: Optional[str] = None, retry: int = 3) -> Optional[CBT]:
         """
@@ -63,22 +798,45 @@ class AsyncHTTP:
         if not retry or retry < 0:
             retry = 3
         async with semaphore:
-            async with aiohttp.ClientSession() as client:
-                for i in range(retry):
-                    try:
-                        response = await client.get(
-                            url=url, headers=headers, proxy=proxy)
+            client = self.session
+            for i in range(retry):
+                await self.policy.acquire(url)
+                metrics = self.metrics
+                if i and metrics:
+                    metrics.retry(urlsplit(url).hostname or '')
+                limiter = self.limiter
+                host = await limiter.request(url) if limiter else None
+                retry_after = None
+                try:
+                    async with client.get(url=url, headers=headers, proxy=proxy, timeout=ClientTimeout(total=5*60)) as response:
                         if response.ok:
-                            res = callback(index, url, await response.text())
+                            body = time.monotonic()
+                            text = await response.text()
+                            if metrics:
+                                metrics.body(response.url.host or '',
+                                             len(text), time.monotonic() - body)
+                            if limiter:
+                                await limiter.consume(len(text), host)
+                            self.policy.success(url)
+                            res = callback(index, url, text)
                             logger.info(f'{index}, {url}, {res}')
                             return res
                         else:
                             logger.error(
                                 f'{index}, {i}, {url}, {response.status}')
-                    except Exception:
-                        logger.error(
-                            f'{index}, {i}, {url}', exc_info=True, stack_info=True)
-                raise IOError(f'Download failed {url} in {retry} retries')
+                            retry_after = self._failed(
+                                semaphore, url, response)
+                            if not self.policy.retryable(response.status):
+                                break
+                except Exception as ex:
+                    self.policy.failure(url, exc=ex)
+                    logger.error(
+                        f'{index}, {i}, {url}', exc_info=True, stack_info=True)
+                    if not self.policy.retryable(exc=ex):
+                        break
+                if i < retry - 1:
+                    await self.policy.sleep(i, retry_after)
+            raise IOError(f'Download failed {url} in {i+1} retries')
 
     def run(self, sem: int, callback: Callable[[int, str, str], Any], urls: Iterable[str], headers: Optional[dict[str, str]] = None, proxy: Optional[str] = None):
         """
@@ -88,7 +846,9 @@ class AsyncHTTP:
         try:
             loop.run_until_complete(self.async_gets(
                 sem, callback, urls, headers, proxy))
+            loop.run_until_complete(self.close())
         except Exception:
+            loop.run_until_complete(self.close())
             loop.close()
             logger.error('run failed', exc_info=True, stack_info=True)
             raise
@@ -105,25 +865,40 @@ class AsyncHTTP:
         tasks = [self.async_get(index, semaphore, url, callback, headers, proxy, retry) if type(url) == str  # type: ignore
                  else self.async_get(url[1], semaphore, url[0], callback, headers, proxy, retry) # type: ignore
                  for index, url in enumerate(urls)]
-        await asyncio.wait(tasks)
+        await asyncio.wait([asyncio.ensure_future(t) for t in tasks])
 
-    async def async_downloads(self, sem: int,  urls: list[str], file_names: list[str], headers: Optional[dict[str, str]] = None, proxy: Optional[str] = None, retry: int = 3):
+    async def async_downloads(self, sem: int,  urls: list[str], file_names: list[str], headers: Optional[dict[str, str]] = None, proxy: Optional[str] = None, retry: int = 3, adaptive: bool = False, min_sem: int = 1, max_sem: int = 64, callback: Optional[Callable[[int, str, str], Awaitable[Any]]] = None, byte_ranges: Optional[list[Optional[tuple[int, int]]]] = None, parts: int = 1, part_size: int = 8*1024*1024, verify: Optional[Callable[[int], Optional[Verifier]]] = None):
         """
         Asynchrounous download multiple urls
 
-        :param sem: Max concurrency count.
+        :param sem: Max concurrency count. Initial concurrency count if :param:`adaptive`.
         :param urls: Each of download url.
         :param file_names: Each of url saved file name.
         :param headers: Request headers.
         :param proxy: Request proxy.
         :param retry: Retry times if failed.
+        :param adaptive: Adjust concurrency between :param:`min_sem` and :param:`max_sem` by throughput, latency and errors. See :class:`AdaptiveSemaphore`.
+        :param callback: Invoke when each url downloaded successfully. `(index, url, file_name) -> Awaitable`
+        :param byte_ranges: Inclusive byte range of each url to download, None for the whole.
+        :param parts: Split each large url into up to this count of concurrent ranges, see :meth:`async_download`.
+        :param part_size: Min bytes of each part.
+        :param verify: Factory of a :class:`Verifier` of each url by its index, see :meth:`async_download`.
         """
         if not retry or retry < 0:
             retry = 3
         if len(urls) != len(file_names):
             raise ValueError(
                 f'urls and file_names must have same length, bug got {len(urls)} {len(file_names)}')
-        semaphore = Semaphore(sem)
-        tasks = [self.async_download(index, semaphore, url, file_names[index], headers, proxy, retry=retry)
-                 for index, url in enumerate(urls)]
-        await asyncio.wait(tasks)
+        if byte_ranges is not None and len(byte_ranges) != len(urls):
+            raise ValueError(
+                f'urls and byte_ranges must have same length, bug got {len(urls)} {len(byte_ranges)}')
+        semaphore = AdaptiveSemaphore(sem, min_sem, max_sem) if adaptive else Semaphore(sem)
+
+        async def download(index: int, url: str):
+            await self.async_download(index, semaphore, url, file_names[index], headers, proxy, retry=retry,
+                                      byte_range=byte_ranges[index] if byte_ranges else None, parts=parts, part_size=part_size,
+                                      verify=(lambda: verify(index)) if verify else None)
+            if callback:
+                await callback(index, url, file_names[index])
+        tasks = [download(index, url) for index, url in enumerate(urls)]
+        await asyncio.wait([asyncio.ensure_future(t) for t in tasks])
@@ -0,0 +1,224 @@
+import asyncio
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from typing import Any, Optional
+
+from al_utils.logger import Logger
+
+from download.asynchttp import AsyncHTTP
+from download.util import human_size
+
+logger = Logger(__file__).logger
+
+FICLONE = 0x40049409
+"""ioctl to reflink a file on Linux, supported by btrfs and xfs."""
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_used ON objects (used);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_hash ON urls (hash);
+'''
+
+
+def link(src: str, dst: str):
+    """
+    Make :param:`dst` the same content as :param:`src` without copying if possible:
+    hardlink, then reflink, then copy.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError as ex:
+        if ex.errno == errno.EEXIST:
+            raise
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+
+
+def file_hash(file_name: str, chunk_size: int = 1024*1024) -> str:
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SegmentCache:
+    """
+    On-disk cache of segments shared by all videos.
+
+    Contents are stored once by SHA-256 under `objects/`, and absolute segment URLs are mapped to them,
+    so the same URL is never fetched twice and the same content under different URLs is stored once.
+    Cached segments are materialized by hardlink (or reflink, or copy across file systems).
+    Least recently used contents are evicted when total size exceeds :param:`max_size`.
+    """
+
+    def __init__(self, cache_dir: str = './cache', max_size: int = 10*1024*1024*1024) -> None:
+        """
+        :param cache_dir: Directory of contents and the index database.
+        :param max_size: Max bytes of contents.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        """Count of new contents."""
+        self.deduped = 0
+        """Count of downloaded segments whose content has been cached under another url."""
+        self.evicted = 0
+        self._size = 0
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.open()
+        return self._conn  # type: ignore
+
+    def open(self):
+        os.makedirs(os.path.join(self.cache_dir, 'objects'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(
+            self.cache_dir, 'index.db'), isolation_level='DEFERRED')
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        self._size = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+        logger.info(f'segment cache {self.stats}')
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        """
+        Total bytes of contents.
+        """
+        self.conn
+        return self._size
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'stored': self.stored, 'deduped': self.deduped,
+                'evicted': self.evicted, 'size': self._size}
+
+    def object_fn(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def lookup(self, url: str) -> Optional[str]:
+        """
+        Cached content file of :param:`url`, None if not cached. It is marked as recently used.
+        """
+        row = self.conn.execute(
+            'SELECT hash FROM urls WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        fn = self.object_fn(row[0])
+        # commit at once, an open write transaction locks the index of other processes sharing the cache
+        with self.conn:
+            if not os.path.exists(fn):
+                self.conn.execute('DELETE FROM urls WHERE hash = ?', (row[0],))
+                self.conn.execute('DELETE FROM objects WHERE hash = ?', (row[0],))
+                return None
+            self.conn.execute(
+                'UPDATE objects SET used = ? WHERE hash = ?', (time.time(), row[0]))
+        return fn
+
+    async def materialize(self, url: str, file_name: str) -> bool:
+        """
+        Make :param:`file_name` a completed download of :param:`url` from cache, see :meth:`AsyncHTTP.is_complete`.
+
+        :return: Whether it is cached.
+        """
+        fn = self.lookup(url)
+        if fn is None:
+            self.misses += 1
+            return False
+        AsyncHTTP.remove(file_name)
+        link(fn, file_name)
+        await AsyncHTTP.write_meta(file_name, {'url': url, 'length': os.path.getsize(file_name), 'etag': None, 'complete': True})
+        self.hits += 1
+        return True
+
+    async def store(self, url: str, file_name: str, digest: Optional[str] = None):
+        """
+        Add downloaded :param:`file_name` of :param:`url` to cache.
+
+        :param digest: SHA-256 of :param:`file_name` if it has been computed while downloading.
+        """
+        if digest is None:
+            digest = await asyncio.get_running_loop().run_in_executor(None, file_hash, file_name)
+        fn = self.object_fn(digest)
+        if self.conn.execute('SELECT 1 FROM objects WHERE hash = ?', (digest,)).fetchone() and os.path.exists(fn):
+            self.deduped += 1
+            self.conn.execute(
+                'UPDATE objects SET used = ? WHERE hash = ?', (time.time(), digest))
+        else:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            if os.path.exists(fn):
+                os.remove(fn)
+            size = os.path.getsize(file_name)
+            link(file_name, fn)
+            self.conn.execute('INSERT OR REPLACE INTO objects (hash, size, used) VALUES (?, ?, ?)',
+                              (digest, size, time.time()))
+            self._size += size
+            self.stored += 1
+        self.conn.execute(
+            'INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)', (url, digest))
+        self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        """
+        Remove least recently used contents until total size is not more than :attr:`max_size`.
+        Total size is read from the index, since other processes may share the cache.
+        """
+        self._size = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        while self._size > self.max_size:
+            row = self.conn.execute(
+                'SELECT hash, size FROM objects ORDER BY used LIMIT 1').fetchone()
+            if row is None:
+                break
+            digest, size = row
+            fn = self.object_fn(digest)
+            if os.path.exists(fn):
+                os.remove(fn)
+            self.conn.execute('DELETE FROM objects WHERE hash = ?', (digest,))
+            self.conn.execute('DELETE FROM urls WHERE hash = ?', (digest,))
+            self._size -= size
+            self.evicted += 1
+            logger.debug(f'evict {digest}, {human_size(size)}')
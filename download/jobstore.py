@@ -0,0 +1,232 @@
+import os
+import sqlite3
+import time
+from typing import Awaitable, Callable, Optional
+
+from al_utils.logger import Logger
+
+from download.metrics import Metrics
+from download.resume import Resume
+
+_logger = Logger(__file__).logger
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS segments (
+    key TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (key, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+class JobStore(Resume):
+    """
+    :class:`Resume` backed by SQLite in WAL mode.
+
+    Keeps status, attempts, downloaded bytes and timestamps of each key and the downloaded segments of it,
+    with indexed lookups. Writes are committed in batches of :param:`batch_size` or every :param:`interval` seconds,
+    and on close. Keys which have been done are skipped.
+    """
+
+    def __init__(self, db: str = './logs/jobs.db', current: str = '', skips: list[str] = [], batch_size: int = 500, interval: float = 1.0, skip_done: bool = True, metrics: Optional[Metrics] = None) -> None:
+        """
+        :param db: SQLite database file.
+        :param current: Specified current key, it will override the stored value.
+        :param skips: Keys to ignore/skip download.
+        :param batch_size: Commit after this count of writes.
+        :param interval: Commit if the last commit is more than this seconds ago.
+        :param skip_done: Skip keys which have been done.
+        :param metrics: Record count and duration of jobs. None to disable.
+        """
+        super().__init__('', '', '', current, skips, metrics)
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval
+        self.skip_done = skip_done
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        self._committed = time.monotonic()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            raise RuntimeError('JobStore is not opened.')
+        return self._conn
+
+    def open(self):
+        """
+        Open database and create tables if not exist.
+        """
+        d = os.path.dirname(self.db)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._conn = sqlite3.connect(self.db, isolation_level='DEFERRED')
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # WAL commits with synchronous=NORMAL do not fsync, only checkpoints do
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def _write(self, sql: str, args: tuple = ()):
+        self.conn.execute(sql, args)
+        self._writes += 1
+        if self._writes >= self.batch_size or time.monotonic() - self._committed >= self.interval:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._writes = 0
+        self._committed = time.monotonic()
+
+    def status(self, key: str) -> Optional[str]:
+        """
+        Status of :param:`key`, None if not exists.
+        """
+        row = self.conn.execute(
+            'SELECT status FROM jobs WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def job(self, key: str) -> Optional[dict]:
+        """
+        Status, attempts, bytes, created and updated timestamp of :param:`key`.
+        """
+        row = self.conn.execute(
+            'SELECT status, attempts, bytes, created, updated FROM jobs WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        return dict(zip(['status', 'attempts', 'bytes', 'created', 'updated'], row))
+
+    def keys(self, status: str) -> list[str]:
+        """
+        Keys of :param:`status`.
+        """
+        return [r[0] for r in self.conn.execute('SELECT key FROM jobs WHERE status = ?', (status,))]
+
+    def segments(self, key: str) -> dict[int, int]:
+        """
+        Downloaded bytes of each downloaded segment index of :param:`key`, for progress and reports.
+        """
+        return dict(self.conn.execute('SELECT idx, bytes FROM segments WHERE key = ?', (key,)))
+
+    def _get_meta(self, name: str) -> Optional[str]:
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name: str, value: str):
+        self._write(
+            'INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value', (name, value))
+
+    def _set_status(self, key: str, status: str, attempt: bool = False):
+        now = time.time()
+        self._write('INSERT INTO jobs (key, status, attempts, created, updated) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET status = excluded.status, attempts = attempts + ?, updated = excluded.updated',
+                    (key, status, int(attempt), now, now, int(attempt)))
+
+    async def run(self, key: str, callback: Callable[[str], Awaitable[bool]]):
+        if self.skip_done and key not in self._skips and self.status(key) == DONE:
+            _logger.info(f"callback skipped of done key {key}")
+            if self.metrics:
+                self.metrics.inc('jobs_total', status='skipped')
+            return
+        return await super().run(key, callback)
+
+    async def _on_start(self, key: str):
+        self._set_status(key, RUNNING, True)
+
+    async def _on_success(self, key: str):
+        self._set_status(key, DONE)
+
+    async def _on_failure(self, key: str):
+        self._set_status(key, FAILED)
+
+    async def _set_current(self, cur: str):
+        self._set_meta('current', cur)
+
+    async def segment(self, key: str, index: int, nbytes: int):
+        """
+        Record the :param:`index` th segment of :param:`key`. A segment reported again, such as skipped when restarted
+        or downloaded again after a failed check, only adds the difference of its bytes to the job.
+
+        It is informational, whether a segment is downloaded on restart is decided by its file and sidecar.
+        """
+        now = time.time()
+        row = self.conn.execute(
+            'SELECT bytes FROM segments WHERE key = ? AND idx = ?', (key, index)).fetchone()
+        self._write('INSERT INTO segments (key, idx, bytes, updated) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (key, idx) DO UPDATE SET bytes = excluded.bytes, updated = excluded.updated',
+                    (key, index, nbytes, now))
+        self._write('UPDATE jobs SET bytes = bytes + ?, updated = ? WHERE key = ?',
+                    (nbytes - (row[0] if row else 0), now, key))
+
+    def import_logs(self, success_log: str = "./logs/downloaded.log", error_log: str = "./logs/errors.log", current_log: str = './logs/current.log') -> int:
+        """
+        Import keys from log files of :class:`Resume`. It only runs once for each database.
+
+        :return: Count of imported keys.
+        """
+        if self._get_meta('imported'):
+            return 0
+        count = 0
+        now = time.time()
+        for fn, status in [(error_log, FAILED), (success_log, DONE)]:
+            if not fn or not os.path.exists(fn):
+                continue
+            with open(fn, encoding='utf-8') as f:
+                keys = [(k, status, now, now) for k in (l.strip() for l in f) if k]
+            # success overrides failure of the same key
+            self.conn.executemany('INSERT INTO jobs (key, status, created, updated) VALUES (?, ?, ?, ?) '
+                                  'ON CONFLICT (key) DO UPDATE SET status = excluded.status', keys)
+            count += len(keys)
+        if current_log and os.path.exists(current_log) and not self._get_meta('current'):
+            with open(current_log, encoding='utf-8') as f:
+                current = f.read().strip()
+            if current:
+                self._set_meta('current', current)
+                self._current = self._current or current
+        self._set_meta('imported', str(now))
+        self.commit()
+        _logger.info(f'imported {count} keys to {self.db}')
+        return count
+
+    async def __aenter__(self):
+        self.open()
+        # keys left running were interrupted
+        self.conn.execute('UPDATE jobs SET status = ? WHERE status = ?',
+                          (FAILED, RUNNING))
+        if self._current:
+            self._set_meta('current', self._current)
+        else:
+            self._current = self._get_meta('current') or ''
+        self.commit()
+        return self
+
+    async def close(self):
+        if self._conn is None:
+            return
+        try:
+            self.commit()
+            self._conn.close()
+        except:
+            _logger.debug("closed failed", exc_info=True, stack_info=True)
+        self._conn = None
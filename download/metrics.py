@@ -0,0 +1,263 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Any, Iterator, Optional
+
+import aiohttp
+from al_utils.logger import Logger
+
+from download.util import human_size
+
+logger = Logger(__file__).logger
+
+_video: ContextVar[str] = ContextVar('video', default='')
+"""Video which the running task is downloading, to attribute requests to it."""
+
+Key = tuple[str, tuple[tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict[str, Any]) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """
+    Counters, gauges and timings of the download pipeline, with a summary of each video.
+
+    Components record into it only if one is passed to them, otherwise every hook is skipped
+    by a single `if metrics` check, so it costs nothing when disabled.
+    Request phases (DNS, connect, time to first byte) come from :meth:`trace_config`.
+    """
+
+    def __init__(self, prefix: str = 'm3u8') -> None:
+        """
+        :param prefix: Prefix of metric names in Prometheus text.
+        """
+        self.prefix = prefix
+        self.counters: defaultdict[Key, float] = defaultdict(float)
+        self.gauges: dict[Key, float] = {}
+        self.timings: dict[Key, list[float]] = {}
+        """`[count, sum, max]` of seconds."""
+        self.videos: dict[str, dict[str, Any]] = {}
+        """Summary of each video, see :meth:`video`."""
+
+    def inc(self, name: str, value: float = 1, **labels: Any):
+        self.counters[_key(name, labels)] += value
+
+    def gauge(self, name: str, value: float, **labels: Any):
+        self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels: Any):
+        timing = self.timings.get(_key(name, labels))
+        if timing is None:
+            self.timings[_key(name, labels)] = [1, seconds, seconds]
+            return
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    def merge(self, other: 'Metrics'):
+        """
+        Add counters, timings and video summaries of :param:`other`, such as metrics of another process.
+        Its gauges override the same ones.
+        """
+        for key, value in other.counters.items():
+            self.counters[key] += value
+        self.gauges.update(other.gauges)
+        for key, (count, total, high) in other.timings.items():
+            timing = self.timings.get(key)
+            if timing is None:
+                self.timings[key] = [count, total, high]
+                continue
+            timing[0] += count
+            timing[1] += total
+            timing[2] = max(timing[2], high)
+        self.videos.update(other.videos)
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    @contextmanager
+    def bind(self, video: str) -> Iterator[dict[str, Any]]:
+        """
+        Attribute requests and stages in this context, including tasks created in it, to :param:`video`.
+        """
+        token = _video.set(video)
+        summary = self.video(video)
+        try:
+            yield summary
+        finally:
+            summary['elapsed'] = time.monotonic() - summary['start']
+            _video.reset(token)
+
+    def video(self, name: Optional[str] = None) -> dict[str, Any]:
+        """
+        Summary of :param:`name`, defaults to the bound video, see :meth:`bind`.
+        """
+        name = _video.get() if name is None else name
+        if name not in self.videos:
+            self.videos[name] = {'segments': 0, 'bytes': 0, 'retries': 0, 'errors': 0, 'concurrency': 0,
+                                 'stages': {}, 'start': time.monotonic(), 'elapsed': 0.0}
+        return self.videos[name]
+
+    def record(self, field: str, value: float = 1):
+        """
+        Add :param:`value` to :param:`field` of the bound video. Ignored if not bound.
+        """
+        if _video.get():
+            self.video()[field] += value
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """
+        Time a stage of the bound video, such as `playlist`, `segments` or `combine`.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.observe('stage_seconds', elapsed, stage=stage)
+            if _video.get():
+                stages = self.video()['stages']
+                stages[stage] = stages.get(stage, 0) + elapsed
+
+    def body(self, host: str, nbytes: int, transfer: float, write: Optional[float] = None):
+        """
+        Record a response body of :param:`nbytes` received in :param:`transfer` seconds,
+        of which :param:`write` seconds are spent on writing to disk.
+        """
+        self.inc('bytes_total', nbytes, host=host)
+        self.observe('transfer_seconds', transfer, host=host)
+        if write is not None:
+            self.observe('write_seconds', write, host=host)
+        self.record('bytes', nbytes)
+
+    def segment(self, concurrency: Optional[int] = None):
+        """
+        Record a segment downloaded while :param:`concurrency` segments are allowed at the same time.
+        """
+        self.inc('segments_total')
+        if _video.get():
+            summary = self.video()
+            summary['segments'] += 1
+            if concurrency is not None:
+                summary['concurrency'] = concurrency
+
+    def retry(self, host: str):
+        self.inc('retries_total', host=host)
+        self.record('retries')
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """
+        Trace config of :class:`aiohttp.ClientSession` which records DNS, connect and time to first byte of each request.
+        """
+        config = aiohttp.TraceConfig()
+
+        async def on_request_start(_, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            ctx.start = time.monotonic()
+            ctx.host = params.url.host or ''
+
+        async def on_dns_start(_, ctx: SimpleNamespace, __):
+            ctx.dns = time.monotonic()
+
+        async def on_dns_end(_, ctx: SimpleNamespace, __):
+            self.observe('dns_seconds', time.monotonic() - ctx.dns, host=ctx.host)
+
+        async def on_connect_start(_, ctx: SimpleNamespace, __):
+            ctx.connect = time.monotonic()
+
+        async def on_connect_end(_, ctx: SimpleNamespace, __):
+            self.observe('connect_seconds', time.monotonic() - ctx.connect, host=ctx.host)
+
+        async def on_reuse(_, ctx: SimpleNamespace, __):
+            self.inc('connections_reused_total', host=ctx.host)
+
+        async def on_request_end(_, ctx: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+            self.observe('ttfb_seconds', time.monotonic() - ctx.start, host=ctx.host)
+            self.inc('requests_total', host=ctx.host, status=params.response.status)
+
+        async def on_request_exception(_, ctx: SimpleNamespace, __):
+            self.inc('request_errors_total', host=ctx.host)
+            self.record('errors')
+
+        config.on_request_start.append(on_request_start)
+        config.on_dns_resolvehost_start.append(on_dns_start)
+        config.on_dns_resolvehost_end.append(on_dns_end)
+        config.on_connection_create_start.append(on_connect_start)
+        config.on_connection_create_end.append(on_connect_end)
+        config.on_connection_reuseconn.append(on_reuse)
+        config.on_request_end.append(on_request_end)
+        config.on_request_exception.append(on_request_exception)
+        return config
+
+    def to_prometheus(self) -> str:
+        """
+        Metrics in Prometheus text format. Timings are summaries of count and sum, with a `_max` gauge.
+        """
+        lines: list[str] = []
+
+        def group(items, kind: str, suffix: str = ''):
+            last = None
+            for (name, labels), value in sorted(items):
+                name = f'{self.prefix}_{name}{suffix}'
+                if name != last:
+                    lines.append(f'# TYPE {name} {kind}')
+                    last = name
+                if isinstance(value, list):
+                    lines.append(f'{name}_count{_labels(labels)} {value[0]:g}')
+                    lines.append(f'{name}_sum{_labels(labels)} {value[1]:g}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {value:g}')
+        group(self.counters.items(), 'counter')
+        group(self.gauges.items(), 'gauge')
+        group(self.timings.items(), 'summary')
+        group(((k, v[2]) for k, v in self.timings.items()), 'gauge', '_max')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> dict[str, Any]:
+        def items(d, f=lambda v: v):
+            return [{'name': name, 'labels': dict(labels), 'value': f(v)} for (name, labels), v in sorted(d.items())]
+        return {'counters': items(self.counters), 'gauges': items(self.gauges),
+                'timings': items(self.timings, lambda v: {'count': v[0], 'sum': v[1], 'max': v[2]}),
+                'videos': {name: {k: v for k, v in s.items() if k != 'start'} for name, s in self.videos.items()}}
+
+    def report(self) -> str:
+        """
+        One line summary of each video.
+        """
+        lines = []
+        for name, s in self.videos.items():
+            speed = s['bytes'] / s['elapsed'] if s['elapsed'] else 0
+            stages = ', '.join(f'{k} {v:.2f}s' for k, v in s['stages'].items())
+            lines.append(f"{name}: {s['segments']} segments, {human_size(s['bytes'])} in {s['elapsed']:.2f}s "
+                         f"({human_size(speed)}/s), {s['retries']} retries, {s['errors']} errors, "
+                         f"concurrency {s['concurrency']}, {stages}")
+        return '\n'.join(lines)
+
+    def save(self, file_name: str):
+        """
+        Save metrics to :param:`file_name`, in JSON if it ends with `.json`, otherwise in Prometheus text.
+        """
+        with open(file_name, 'w', encoding='utf-8') as f:
+            if file_name.endswith('.json'):
+                json.dump(self.to_json(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+        logger.info(f'metrics saved to {file_name}')
@@ -0,0 +1,159 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Iterable, Optional, TypeVar
+
+from al_utils.logger import Logger
+
+logger = Logger(__file__).logger
+
+T = TypeVar('T')
+
+
+class Mirrors:
+    """
+    Equivalent base urls of segments, such as the same path on several CDNs.
+
+    Each fetch goes to a mirror picked randomly, weighted by its recent throughput. If it has not finished
+    after the :param:`percentile` of recent fetch durations, a hedged duplicate is sent to another mirror,
+    then the first one to finish wins and the other is cancelled. Hedges are limited to :param:`max_hedge`
+    of fetches, so it costs little extra bandwidth.
+    """
+
+    def __init__(self, base_urls: Iterable[str], percentile: float = 0.95, min_samples: int = 10, window: int = 100, max_hedge: float = 0.1, alpha: float = 0.3, seed: Optional[int] = None) -> None:
+        """
+        :param base_urls: Equivalent base urls, the first one is the primary.
+        :param percentile: Percentile of recent fetch durations to send a hedged request.
+        :param min_samples: Min count of recent fetches before hedging.
+        :param window: Count of recent fetches to calculate the percentile.
+        :param max_hedge: Max ratio of hedged requests to fetches.
+        :param alpha: Weight of the latest sample in throughput average.
+        :param seed: Seed of picking mirrors.
+        """
+        self.base_urls = list(dict.fromkeys(base_urls))
+        if not self.base_urls:
+            raise ValueError('base_urls must not be empty')
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedge = max_hedge
+        self.alpha = alpha
+        self.throughput: dict[str, Optional[float]] = {
+            u: None for u in self.base_urls}
+        """Average bytes/s of each mirror, None if not measured."""
+        self.fetches = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._durations: deque[float] = deque(maxlen=window)
+        self._random = random.Random(seed)
+
+    def pick(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        """
+        Pick a mirror weighted by throughput. Mirrors not measured yet are weighted as the fastest one, so they are tried.
+        """
+        candidates = [u for u in self.base_urls if u not in set(exclude)]
+        if not candidates:
+            return None
+        known = [t for t in self.throughput.values() if t]
+        best = max(known) if known else 1.0
+        weights = [self.throughput[u] or best for u in candidates]
+        return self._random.choices(candidates, weights)[0]
+
+    def record(self, base_url: str, nbytes: int, elapsed: float):
+        self._durations.append(elapsed)
+        rate = nbytes / max(elapsed, 1e-6)
+        old = self.throughput[base_url]
+        self.throughput[base_url] = rate if old is None else old + \
+            self.alpha * (rate - old)
+
+    def failure(self, base_url: str):
+        """
+        Halve the weight of :param:`base_url`.
+        """
+        old = self.throughput[base_url]
+        known = [t for t in self.throughput.values() if t]
+        self.throughput[base_url] = (old or (max(known) if known else 1.0)) / 2
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Seconds to wait before a hedged request, None if it should not hedge.
+        """
+        if len(self.base_urls) < 2 or len(self._durations) < self.min_samples:
+            return None
+        if self.hedges >= self.max_hedge * max(self.fetches, 1):
+            return None
+        durations = sorted(self._durations)
+        return durations[int(self.percentile * (len(durations) - 1))]
+
+    async def fetch(self, fetch: Callable[[str], Awaitable[T]], size: Callable[[T], int] = len, cleanup: Optional[Callable[[str], Any]] = None) -> T:
+        """
+        Fetch with mirrors, hedged if it is slow. If it fails on a mirror, another one is tried.
+
+        :param fetch: Fetch from a base url.
+        :param size: Bytes of a result of :param:`fetch`.
+        :param cleanup: Invoke with base url of each losing, failed or cancelled fetch.
+        :return: Result of the first successful fetch.
+        """
+        self.fetches += 1
+
+        async def timed(base_url: str) -> T:
+            start = time.monotonic()
+            try:
+                result = await fetch(base_url)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failure(base_url)
+                raise
+            self.record(base_url, size(result), time.monotonic() - start)
+            return result
+
+        primary = self.pick()
+        assert primary is not None
+        tasks: dict[asyncio.Future, str] = {
+            asyncio.ensure_future(timed(primary)): primary}
+        winner: Optional[asyncio.Future] = None
+        try:
+            delay = self.hedge_delay()
+            pending = set(tasks)
+            if delay is not None:
+                done, pending = await asyncio.wait(pending, timeout=delay)
+                secondary = self.pick(tasks.values())
+                if not done and secondary is not None:
+                    self.hedges += 1
+                    logger.debug(
+                        f'hedge {primary} with {secondary} after {delay:.3f}s')
+                    task = asyncio.ensure_future(timed(secondary))
+                    tasks[task] = secondary
+                    pending.add(task)
+                pending |= done
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if tasks[task] != primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                if not pending:
+                    other = self.pick(tasks.values())
+                    if other is None:
+                        raise next(iter(done)).exception()  # type: ignore
+                    logger.warning(f'fail over to {other}')
+                    task = asyncio.ensure_future(timed(other))
+                    tasks[task] = other
+                    pending.add(task)
+        finally:
+            losers = [t for t in tasks if not t.done()]
+            for t in losers:
+                t.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+            if cleanup:
+                for t, base_url in tasks.items():
+                    if t is not winner:
+                        cleanup(base_url)
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {'fetches': self.fetches, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins,
+                'throughput': dict(self.throughput)}
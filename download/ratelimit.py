@@ -0,0 +1,184 @@
+import asyncio
+import time
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+from al_utils.logger import Logger
+
+logger = Logger(__file__).logger
+
+WAKEUP = 0.1
+"""Max seconds of each sleep while paying back, so that waiting consumers notice changed rates soon."""
+
+
+async def _pay(delay: float, version: Callable[[], int]):
+    """
+    Sleep :param:`delay` seconds, or until :param:`version` changes.
+    """
+    current = version()
+    end = time.monotonic() + delay
+    while True:
+        remain = end - time.monotonic()
+        if remain <= 0 or version() != current:
+            return
+        await asyncio.sleep(min(remain, WAKEUP))
+
+
+class TokenBucket:
+    """
+    Token bucket of :param:`rate` tokens per second, holding up to :param:`burst` seconds of tokens.
+
+    Tokens are taken first and paid back by sleeping, so a consumer never waits for the bucket to fill
+    and the hot path is a few float operations without locks.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: float = 1.0, name: str = '') -> None:
+        """
+        :param rate: Tokens per second. None for unlimited.
+        :param burst: Seconds of tokens which can be taken at once after idle.
+        :param name: Name in logs.
+        """
+        self.burst = burst
+        self.name = name
+        self._rate: Optional[float] = None
+        self.version = 0
+        """Increased when rate changes."""
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.rate = rate
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: Optional[float]):
+        """
+        Change rate at runtime. The debt is cleared and waiting consumers are woken up soon.
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError(f'rate must be positive or None, but got {rate}')
+        self._rate = rate
+        self.version += 1
+        self._tokens = rate * self.burst if rate else 0.0
+        self._updated = time.monotonic()
+        logger.info(f'{self.name} rate {rate}')
+
+    def delay(self, tokens: float) -> float:
+        """
+        Take :param:`tokens` and return seconds to wait before using them.
+        """
+        rate = self._rate
+        if rate is None:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated)
+                           * rate, rate * self.burst) - tokens
+        self._updated = now
+        return -self._tokens / rate if self._tokens < 0 else 0.0
+
+    async def consume(self, tokens: float = 1):
+        """
+        Take :param:`tokens`, waiting if the bucket is in debt.
+        """
+        delay = self.delay(tokens)
+        if delay > 0:
+            await _pay(delay, lambda: self.version)
+
+
+class RateLimiter:
+    """
+    Bandwidth and request rate limits shared by all downloads of an :class:`download.asynchttp.AsyncHTTP`.
+
+    It has a global bytes/s cap, a bytes/s cap of each host, and a global requests/s cap.
+    All of them can be changed at runtime.
+    """
+
+    def __init__(self, bandwidth: Optional[float] = None, host_bandwidth: Optional[float] = None, hosts: Optional[dict[str, float]] = None, requests: Optional[float] = None, burst: float = 1.0) -> None:
+        """
+        :param bandwidth: Max bytes/s of all downloads. None for unlimited.
+        :param host_bandwidth: Max bytes/s of each host not in :param:`hosts`. None for unlimited.
+        :param hosts: Max bytes/s of specified hosts, such as `{'cdn.example.com': 1024*1024}`.
+        :param requests: Max requests/s of all downloads. None for unlimited.
+        :param burst: Seconds of bandwidth or requests which can be used at once after idle.
+        """
+        self.burst = burst
+        self._bandwidth = TokenBucket(bandwidth, burst, 'bandwidth')
+        self._requests = TokenBucket(requests, burst, 'requests')
+        self._host_bandwidth = host_bandwidth
+        self._hosts: dict[str, Optional[float]] = dict(hosts or {})
+        self._host_buckets: dict[str, TokenBucket] = {}
+
+    @property
+    def bandwidth(self) -> Optional[float]:
+        return self._bandwidth.rate
+
+    @bandwidth.setter
+    def bandwidth(self, rate: Optional[float]):
+        self._bandwidth.rate = rate
+
+    @property
+    def requests(self) -> Optional[float]:
+        return self._requests.rate
+
+    @requests.setter
+    def requests(self, rate: Optional[float]):
+        self._requests.rate = rate
+
+    @property
+    def host_bandwidth(self) -> Optional[float]:
+        return self._host_bandwidth
+
+    @host_bandwidth.setter
+    def host_bandwidth(self, rate: Optional[float]):
+        self._host_bandwidth = rate
+        for host, bucket in self._host_buckets.items():
+            if host not in self._hosts:
+                bucket.rate = rate
+
+    @property
+    def hosts(self) -> dict[str, Optional[float]]:
+        """Max bytes/s of specified hosts."""
+        return dict(self._hosts)
+
+    def set_host(self, host: str, rate: Optional[float]):
+        """
+        Set max bytes/s of :param:`host`. None for unlimited.
+        """
+        self._hosts[host] = rate
+        if host in self._host_buckets:
+            self._host_buckets[host].rate = rate
+
+    def host(self, url: str) -> Optional[TokenBucket]:
+        """
+        Bucket of the host of :param:`url`. None if the host is unlimited, so that callers can skip it.
+        """
+        host = urlsplit(url).netloc
+        if host not in self._host_buckets:
+            if host not in self._hosts and self._host_bandwidth is None:
+                return None
+            self._host_buckets[host] = TokenBucket(
+                self._hosts.get(host, self._host_bandwidth), self.burst, host)
+        return self._host_buckets[host]
+
+    async def request(self, url: str) -> Optional[TokenBucket]:
+        """
+        Wait until a request to :param:`url` is allowed.
+
+        :return: Bucket of its host to pass to :meth:`consume`.
+        """
+        await self._requests.consume()
+        return self.host(url)
+
+    async def consume(self, nbytes: int, host: Optional[TokenBucket] = None):
+        """
+        Account :param:`nbytes` received, and wait if it exceeds bandwidth.
+
+        :param host: Bucket returned by :meth:`request`.
+        """
+        delay = self._bandwidth.delay(nbytes)
+        if host is not None:
+            delay = max(delay, host.delay(nbytes))
+        if delay > 0:
+            bandwidth = self._bandwidth
+            await _pay(delay, lambda: bandwidth.version + (host.version if host else 0))
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+from typing import Optional
+
+import aiofiles
+from al_utils.logger import Logger
+
+from download.util import human_size
+from download.writer import FileWriter, FsyncPolicy
+
+logger = Logger(__file__).logger
+
+
+class ReorderWriter:
+    """
+    Write indexed chunks which arrive out of order to one output file in index order.
+
+    Chunks after a gap are kept in a bounded memory buffer, and spilled to :param:`spill_dir`
+    when the buffer is full. The output grows as soon as the next expected index is ready.
+
+    The output is written by :class:`FileWriter`. Written position is recorded in a sidecar :meth:`progress_fn`
+    each time it is flushed, and when closed, until closed successfully, so an interrupted output can be continued from :attr:`next`.
+    """
+
+    def __init__(self, output: str, spill_dir: str, max_buffer: int = 64*1024*1024, total: Optional[int] = None, start: int = 0, resume: bool = False, write_buffer: int = 1024*1024, fsync: FsyncPolicy = 'never', length: Optional[int] = None) -> None:
+        """
+        :param output: File to write.
+        :param spill_dir: Directory to save chunks which cannot be kept in memory.
+        :param max_buffer: Max bytes of chunks kept in memory.
+        :param total: Expected chunks count. If set, check all of them are written when closed.
+        :param start: First index.
+        :param resume: Continue an interrupted output from its sidecar.
+        :param write_buffer: Bytes of in order chunks to coalesce into one write.
+        :param fsync: When to fsync the output, see :data:`FsyncPolicy`.
+        :param length: Expected bytes of the output to reserve. None if unknown.
+        """
+        self.output = output
+        self.spill_dir = spill_dir
+        self.max_buffer = max_buffer
+        self.total = total
+        self._next = start
+        self._buffer: dict[int, bytes] = {}
+        self._buffered = 0
+        self._spilled: dict[int, str] = {}
+        self._lock = asyncio.Lock()
+        self.resume = resume
+        self.write_buffer = write_buffer
+        self.fsync = fsync
+        self.length = length
+        self.written = 0
+        """Bytes written to output."""
+        self.spills = 0
+        """Count of chunks spilled to disk."""
+
+    @staticmethod
+    def progress_fn(output: str) -> str:
+        """
+        Sidecar file which records written chunks of an unfinished :param:`output`.
+        """
+        return f'{output}.progress'
+
+    @staticmethod
+    def is_partial(output: str) -> bool:
+        """
+        Whether :param:`output` is unfinished.
+        """
+        return os.path.exists(ReorderWriter.progress_fn(output))
+
+    @property
+    def next(self) -> int:
+        """Next expected index."""
+        return self._next
+
+    @property
+    def buffered(self) -> int:
+        """Bytes kept in memory."""
+        return self._buffered
+
+    async def put(self, index: int, data: bytes):
+        """
+        Add chunk of :param:`index`. It is written immediately if all chunks before it have been written.
+        """
+        async with self._lock:
+            if index < self._next or index in self._buffer or index in self._spilled:
+                raise ValueError(f'chunk {index} has been put.')
+            if index == self._next:
+                await self._write(data)
+                await self._drain()
+            elif self._buffered + len(data) > self.max_buffer:
+                fn = self._spill_fn(index)
+                async with aiofiles.open(fn, 'wb') as f:
+                    await f.write(data)
+                self._spilled[index] = fn
+                self.spills += 1
+            else:
+                self._buffer[index] = data
+                self._buffered += len(data)
+
+    async def _write(self, data: bytes):
+        flushes = self._f.writes
+        await self._f.write(data)
+        self.written += len(data)
+        self._next += 1
+        # a flush writes all buffered chunks, so the sidecar is consistent with the file
+        if self._f.writes != flushes:
+            await self._save()
+
+    async def _drain(self):
+        while True:
+            if self._next in self._buffer:
+                data = self._buffer.pop(self._next)
+                self._buffered -= len(data)
+                await self._write(data)
+            elif self._next in self._spilled:
+                fn = self._spilled.pop(self._next)
+                async with aiofiles.open(fn, 'rb') as f:
+                    await self._write(await f.read())
+                os.remove(fn)
+            else:
+                return
+
+    def _spill_fn(self, index: int) -> str:
+        return os.path.join(self.spill_dir, f'{os.path.basename(self.output)}.{index}.part')
+
+    async def _save(self):
+        """
+        Record written chunks. It is called when nothing is buffered in the writer.
+        """
+        fn = self.progress_fn(self.output)
+        async with aiofiles.open(f'{fn}.tmp', 'w', encoding='utf-8') as f:
+            await f.write(json.dumps({'next': self._next, 'written': self.written, 'total': self.total}))
+        os.replace(f'{fn}.tmp', fn)
+
+    async def _load(self) -> bool:
+        fn = self.progress_fn(self.output)
+        if not os.path.exists(fn) or not os.path.exists(self.output):
+            return False
+        try:
+            async with aiofiles.open(fn, encoding='utf-8') as f:
+                progress = json.loads(await f.read())
+        except Exception:
+            logger.warning(f'broken progress {fn}', exc_info=True)
+            return False
+        if progress.get('total') != self.total or os.path.getsize(self.output) < progress['written']:
+            return False
+        self._next = progress['next']
+        self.written = progress['written']
+        return True
+
+    async def __aenter__(self):
+        resumed = self.resume and await self._load()
+        if resumed:
+            os.truncate(self.output, self.written)
+            logger.info(
+                f'{self.output}, resume from {self._next}, {human_size(self.written)}')
+        elif os.path.exists(self.output):
+            os.truncate(self.output, 0)
+        length = self.length - self.written if self.length else None
+        self._f = FileWriter(self.output, self.written, length, self.write_buffer, self.fsync)
+        await self._f.open()
+        if not resumed:
+            await self._save()
+        return self
+
+    async def __aexit__(self, exc_type, *_):
+        await self.close(exc_type is None)
+
+    async def close(self, check: bool = True):
+        """
+        Close output file and remove spilled chunks.
+
+        :param check: Raise :class:`IOError` if some chunks are missing.
+        """
+        try:
+            await self._f.close()
+            # everything buffered has been written
+            await self._save()
+        finally:
+            pending = sorted([*self._buffer.keys(), *self._spilled.keys()])
+            for fn in self._spilled.values():
+                os.remove(fn)
+            self._buffer.clear()
+            self._spilled.clear()
+            self._buffered = 0
+        logger.info(
+            f'{self.output}, {human_size(self.written)}, {self.spills} spilled')
+        if not check:
+            return
+        if pending:
+            raise IOError(
+                f'{self.output} missing chunk {self._next} before {pending}')
+        if self.total is not None and self._next != self.total:
+            raise IOError(
+                f'{self.output} expected {self.total} chunks, but got {self._next}')
+        os.remove(self.progress_fn(self.output))
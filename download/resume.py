@@ -1,28 +1,47 @@
+import asyncio
 import os
-from typing import Awaitable, Callable
+import time
+from typing import Awaitable, Callable, Optional
 
 import aiofiles
 from al_utils.logger import Logger
 
+from download.metrics import Metrics
+
 _logger = Logger(__file__).logger
 
 
 class Resume:
-    def __init__(self, success_log: str = "./logs/downloaded.log", error_log: str = "./logs/errors.log", current_log: str = './logs/current.log', current: str = '', skips: list[str] = []) -> None:
+    """
+    Record success, failure and current of keys in log files.
+
+    Subclasses store them elsewhere by overriding :meth:`_on_start`, :meth:`_on_success`,
+    :meth:`_on_failure`, :meth:`_set_current`, :meth:`__aenter__` and :meth:`close`.
+    """
+
+    def __init__(self, success_log: str = "./logs/downloaded.log", error_log: str = "./logs/errors.log", current_log: str = './logs/current.log', current: str = '', skips: list[str] = [], metrics: Optional[Metrics] = None) -> None:
         """
         :param success_log: File to log successed download keys.
         :param error_log: File to log failed download keys. The values will be ignored if :param:`current_log` or :param:`current` is empty.
         :param current_log: File to log the last success downloaded key.
         :param current: Specified current key, it will override the value in :param:`current_log`.
         :param skips: Keys to ignore/skip download.
+        :param metrics: Record count and duration of jobs. None to disable.
         """
+        self.metrics = metrics
         self._suc = success_log
         self._err = error_log
         self._cur = current_log
         self._current = current
         self._failed: set[str] = set()
         self._bp: bool = False
-        self._skips = skips
+        self._skips = set(skips)
+        # keys in the order of run, to track current when callbacks finish out of order
+        self._keys: dict[int, str] = {}
+        self._finished: dict[int, bool] = {}
+        self._seq = 0
+        self._mark = 0
+        self._lock = asyncio.Lock()
 
     async def _set_current(self, cur: str):
         async with aiofiles.open(self._cur, 'w', encoding='utf-8') as f:
@@ -44,6 +63,8 @@ class Resume:
     async def run(self, key: str, callback: Callable[[str], Awaitable[bool]]):
         if key in self._skips:
             _logger.info(f"callback skipped by user of key {key}")
+            if self.metrics:
+                self.metrics.inc('jobs_total', status='skipped')
             return
         if self._bp or key in self._failed or key:
             return await self._run(key, callback)
@@ -58,19 +79,66 @@ class Resume:
         return
 
     async def _run(self, key: str, callback: Callable[[str], Awaitable[bool]]):
+        seq = self._seq
+        self._seq += 1
+        self._keys[seq] = key
+        await self._on_start(key)
+        start = time.monotonic()
         try:
             ret = await callback(key)
             if ret:
-                await self._set_current(key)
                 _logger.info(f"callback successfully of key {key}")
-                await self._sf.write(key)
+                self._record('done', start)
+                await self._on_success(key)
+                await self._finish(seq, True)
                 return
             raise RuntimeError(f"Callback failed of key {key}")
         except:
             _logger.error(
                 f"callback failed of key {key}", exc_info=True, stack_info=True)
+            self._record('failed', start)
             self._failed.add(key)
-            await self._ff.write(key)
+            await self._on_failure(key)
+            await self._finish(seq, False)
+
+    def _record(self, status: str, start: float):
+        if self.metrics:
+            self.metrics.inc('jobs_total', status=status)
+            self.metrics.observe(
+                'job_seconds', time.monotonic() - start, status=status)
+
+    async def _on_start(self, key: str):
+        pass
+
+    async def _on_success(self, key: str):
+        await self._sf.write(f'{key}\n')
+
+    async def _on_failure(self, key: str):
+        await self._ff.write(f'{key}\n')
+
+    async def segment(self, key: str, index: int, nbytes: int):
+        """
+        Record the :param:`index` th segment of :param:`key` has been downloaded. Not recorded in log files.
+        """
+        pass
+
+    async def _finish(self, seq: int, ok: bool):
+        """
+        Mark the :param:`seq` th key finished. Current is the last successful key
+        which all keys run before it have finished, so that it is correct when run concurrently.
+        """
+        self._finished[seq] = ok
+        current = None
+        while self._mark in self._finished:
+            key = self._keys.pop(self._mark)
+            if self._finished.pop(self._mark):
+                current = key
+            self._mark += 1
+        if current is not None and current != self._current:
+            self._current = current
+            async with self._lock:
+                # keys finished while waiting may have moved current, so write the latest one
+                await self._set_current(self._current)
 
     async def __aenter__(self):
         if self._current:
@@ -0,0 +1,190 @@
+import asyncio
+import errno
+import random
+import time
+from collections import deque
+from typing import Iterable, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+from al_utils.logger import Logger
+
+logger = Logger(__file__).logger
+
+RETRY_STATUS = (408, 425, 429, 500, 502, 503, 504)
+"""Status codes which are worth retrying."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one host.
+
+    It opens when error rate of the last :param:`window` requests reaches :param:`threshold`,
+    then all requests wait :param:`cooldown` seconds. After that, one probe request is let through:
+    the breaker closes if it succeeds, or opens again with doubled cooldown (up to :param:`max_cooldown`).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str = '', threshold: float = 0.5, window: int = 20, min_requests: int = 5, cooldown: float = 5.0, max_cooldown: float = 60.0) -> None:
+        """
+        :param name: Name in logs, such as host.
+        :param threshold: Error rate to open.
+        :param window: Count of recent requests to calculate error rate.
+        :param min_requests: Min count of recent requests before open.
+        :param cooldown: Seconds to wait before probe.
+        :param max_cooldown: Max seconds to wait before probe.
+        """
+        self.name = name
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self._results: deque[bool] = deque(maxlen=window)
+        self._wait = cooldown
+        self._opened_at = 0.0
+        self._probe_at: Optional[float] = None
+        self._closed = asyncio.Event()
+        self._closed.set()
+
+    async def acquire(self):
+        """
+        Wait until requests are allowed.
+        """
+        while self.state != self.CLOSED:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                wait = self._opened_at + self._wait - now
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                self.state = self.HALF_OPEN
+            # let one probe through, or another one if it has not reported for a long time
+            if self._probe_at is None or now - self._probe_at > self.max_cooldown:
+                self._probe_at = now
+                logger.info(f'{self.name} circuit half-open, probing')
+                return
+            try:
+                await asyncio.wait_for(self._closed.wait(), self._wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def record(self, ok: bool):
+        """
+        Record result of a request.
+        """
+        if self.state == self.HALF_OPEN and self._probe_at is not None:
+            self._probe_at = None
+            if ok:
+                self._close()
+            else:
+                self._open(min(self._wait * 2, self.max_cooldown))
+            return
+        if self.state != self.CLOSED:
+            return
+        self._results.append(ok)
+        if len(self._results) >= self.min_requests and self._results.count(False) / len(self._results) >= self.threshold:
+            self._open(self.cooldown)
+
+    def _open(self, wait: float):
+        self.state = self.OPEN
+        self._wait = wait
+        self._opened_at = time.monotonic()
+        self._closed.clear()
+        logger.warning(
+            f'{self.name} circuit open, pause {wait:.1f}s, {self._results.count(False)}/{len(self._results)} failed')
+
+    def _close(self):
+        self.state = self.CLOSED
+        self._wait = self.cooldown
+        self._results.clear()
+        self._closed.set()
+        logger.info(f'{self.name} circuit closed')
+
+
+class RetryPolicy:
+    """
+    Shared retry policy: exponential backoff with full jitter, retry classification and
+    a :class:`CircuitBreaker` per host.
+    """
+
+    def __init__(self, base: float = 0.5, cap: float = 30.0, jitter: bool = True, retry_status: Iterable[int] = RETRY_STATUS, breaker: bool = True, threshold: float = 0.5, window: int = 20, min_requests: int = 5, cooldown: float = 5.0, max_cooldown: float = 60.0) -> None:
+        """
+        :param base: Backoff seconds of the first retry.
+        :param cap: Max backoff seconds.
+        :param jitter: Randomize backoff in `[0, backoff]` to avoid retry storms.
+        :param retry_status: Status codes to retry. Other failed status codes fail immediately.
+        :param breaker: Enable circuit breaker per host.
+        :param threshold: Error rate to open circuit breaker, see :class:`CircuitBreaker`.
+        :param window: Count of recent requests to calculate error rate.
+        :param min_requests: Min count of recent requests before open.
+        :param cooldown: Seconds to wait before probe.
+        :param max_cooldown: Max seconds to wait before probe.
+        """
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.retry_status = set(retry_status)
+        self.breaker = breaker
+        self._breaker_args = dict(threshold=threshold, window=window, min_requests=min_requests,
+                                  cooldown=cooldown, max_cooldown=max_cooldown)
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def retryable(self, status: Optional[int] = None, exc: Optional[BaseException] = None) -> bool:
+        """
+        Whether a failed request is worth retrying.
+
+        :param status: Response status.
+        :param exc: Raised exception.
+        """
+        if exc is not None:
+            if isinstance(exc, OSError) and exc.errno in (errno.ENOSPC, errno.EDQUOT):
+                # local disk is full, it fails again on any host
+                return False
+            if isinstance(exc, aiohttp.ClientResponseError):
+                return exc.status in self.retry_status
+            return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+        return status is None or status in self.retry_status
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Seconds to wait before retry after :param:`attempt` (based on zero) failed.
+        """
+        delay = min(self.cap, self.base * 2 ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    async def sleep(self, attempt: int, retry_after: Optional[float] = None):
+        """
+        Wait before retry, at least `Retry-After` seconds if given.
+        """
+        delay = max(self.backoff(attempt), retry_after or 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def get_breaker(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker(host, **self._breaker_args)
+        return self._breakers[host]
+
+    async def acquire(self, url: str):
+        """
+        Wait until host of :param:`url` is allowed by its circuit breaker.
+        """
+        if self.breaker:
+            await self.get_breaker(url).acquire()
+
+    def success(self, url: str):
+        if self.breaker:
+            self.get_breaker(url).record(True)
+
+    def failure(self, url: str, status: Optional[int] = None, exc: Optional[BaseException] = None):
+        """
+        Record a failed request. Only retryable failures count towards the circuit breaker,
+        others mean the host is responsive.
+        """
+        if self.breaker:
+            self.get_breaker(url).record(not self.retryable(status, exc))
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+import aiofiles
+from al_utils.logger import Logger
+
+logger = Logger(__file__).logger
+
+TS_PACKET = 188
+"""Bytes of each MPEG-TS packet."""
+SYNC_BYTE = 0x47
+"""First byte of each MPEG-TS packet."""
+
+
+class VerifyError(IOError):
+    """
+    Received data is not the expected content, such as a truncated segment or an error page served with 200.
+    It is worth downloading again from the start.
+    """
+
+
+class Verifier:
+    """
+    Incremental check of one download while receiving it, so it costs no extra pass over the data.
+
+    It checks that each MPEG-TS packet starts with the sync byte if :param:`ts`, the total length when finalized,
+    and computes a digest if :param:`algorithm` is set.
+    """
+
+    def __init__(self, ts: bool = False, algorithm: Optional[str] = None, name: str = '') -> None:
+        """
+        :param ts: Check MPEG-TS sync byte of each 188-byte packet.
+        :param algorithm: Name of :module:`hashlib` algorithm of digest, such as `sha256`. None to disable.
+        :param name: Name in errors.
+        """
+        self.ts = ts
+        self.algorithm = algorithm
+        self.name = name
+        self.size = 0
+        """Bytes received."""
+        self._hash = hashlib.new(algorithm) if algorithm else None
+
+    def update(self, chunk: bytes, offset: Optional[int] = None):
+        """
+        Check :param:`chunk` at :param:`offset` of the download, right after the previous chunk if None.
+        The digest is dropped if chunks do not arrive in order, such as a resumed or split download.
+
+        :raise VerifyError: If a packet does not start with the sync byte.
+        """
+        if offset is None:
+            offset = self.size
+        if self._hash is not None:
+            if offset == self.size:
+                self._hash.update(chunk)
+            else:
+                logger.debug(f'{self.name}, not received in order, skip {self.algorithm}')
+                self._hash = None
+        if self.ts:
+            first = -offset % TS_PACKET
+            syncs = chunk[first::TS_PACKET]
+            if syncs.count(SYNC_BYTE) != len(syncs):
+                bad = next(i for i, b in enumerate(syncs) if b != SYNC_BYTE)
+                raise VerifyError(
+                    f'{self.name} is not MPEG-TS, no sync byte at {offset + first + bad * TS_PACKET}')
+        self.size += len(chunk)
+
+    def skip(self, nbytes: int):
+        """
+        Count :param:`nbytes` received before, such as the resumed part of a download. The digest is dropped.
+        """
+        self.size += nbytes
+        self._hash = None
+
+    def finalize(self, length: Optional[int] = None) -> dict[str, Any]:
+        """
+        Check the whole download.
+
+        :param length: Expected bytes. None if unknown.
+        :return: Digest in `{algorithm: hex}`, empty if it is disabled or dropped.
+        :raise VerifyError: If it is not :param:`length` bytes, or not whole MPEG-TS packets.
+        """
+        if length is not None and self.size != length:
+            raise VerifyError(
+                f'{self.name} expected {length} bytes, but got {self.size}')
+        if self.ts and self.size % TS_PACKET:
+            raise VerifyError(
+                f'{self.name} is truncated, {self.size} bytes is not whole MPEG-TS packets')
+        return {self.algorithm: self._hash.hexdigest()} if self._hash is not None else {}
+
+
+class Manifest:
+    """
+    Sizes and digests of downloaded files of a video, keyed by name,
+    so that later runs can validate them by size without reading them again.
+    """
+
+    def __init__(self, file_name: str) -> None:
+        """
+        :param file_name: JSON file of manifest. It is loaded if exists.
+        """
+        self.file_name = file_name
+        self.entries: dict[str, dict[str, Any]] = {}
+        if os.path.exists(file_name):
+            try:
+                with open(file_name, encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception:
+                logger.warning(f'broken manifest {file_name}', exc_info=True)
+
+    def add(self, name: str, size: int, **digests: str):
+        """
+        Record :param:`name` of :param:`size` bytes and its digests, such as `sha256=...`.
+        """
+        self.entries[name] = {'size': size, **digests}
+
+    def get(self, name: str) -> Optional[dict[str, Any]]:
+        return self.entries.get(name)
+
+    def check(self, name: str, file_name: str) -> bool:
+        """
+        Whether :param:`file_name` exists and has the recorded size of :param:`name`. True if it is not recorded.
+        """
+        if not os.path.exists(file_name):
+            return False
+        entry = self.entries.get(name)
+        return entry is None or os.path.getsize(file_name) == entry['size']
+
+    async def save(self):
+        """
+        Write manifest atomically.
+        """
+        async with aiofiles.open(f'{self.file_name}.tmp', 'w', encoding='utf-8') as f:
+            await f.write(json.dumps(self.entries, indent=1))
+        os.replace(f'{self.file_name}.tmp', self.file_name)
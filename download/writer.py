@@ -0,0 +1,199 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+from concurrent.futures import Executor
+from typing import Literal, Optional
+
+from al_utils.logger import Logger
+
+from download.util import human_size
+
+logger = Logger(__file__).logger
+
+FsyncPolicy = Literal['never', 'close', 'flush']
+"""When to fsync a written file: never, once when closed, or after each flush."""
+
+FALLOC_FL_KEEP_SIZE = 1
+"""Flag of fallocate(2) to reserve blocks without changing file size."""
+
+_libc = None
+
+
+def _fallocate():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (OSError, AttributeError, TypeError):
+            _libc = False
+    return _libc.fallocate if _libc else None
+
+
+def reserve(fd: int, offset: int, length: int) -> bool:
+    """
+    Reserve blocks of :param:`length` bytes from :param:`offset` of file :param:`fd` without changing its size,
+    so it is written contiguously and a resumed download still knows its size.
+
+    :return: Whether it is supported by the platform and file system.
+    """
+    fallocate = _fallocate()
+    if fallocate is None or length <= 0:
+        return False
+    return fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+def preallocate(fd: int, length: int):
+    """
+    Resize file :param:`fd` to :param:`length` bytes and reserve its blocks if supported,
+    so that parts can be written at any offset without fragmentation.
+    """
+    if os.fstat(fd).st_size == length:
+        return
+    os.ftruncate(fd, length)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except OSError:
+            # not supported by file system, the file is sparse
+            pass
+
+
+def pwrite(fd: int, data: bytes, offset: int):
+    """
+    Write all of :param:`data` at :param:`offset` of file :param:`fd`.
+    """
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+def check_free_space(path: str, need: int = 0, reserve: int = 0):
+    """
+    Fail fast if the volume of :param:`path` cannot hold :param:`need` more bytes and still keep :param:`reserve` bytes free.
+
+    :raise IOError: `ENOSPC` if there is not enough free space.
+    """
+    free = shutil.disk_usage(path).free
+    if free < need + reserve:
+        raise IOError(errno.ENOSPC,
+                      f'{path} has {human_size(free)} free, but needs {human_size(need)} and keeps {human_size(reserve)}')
+
+
+class FileWriter:
+    """
+    Sequential writer of one file from an offset.
+
+    Chunks are coalesced in memory and written by one executor call each :param:`buffer_size` bytes,
+    instead of one thread hop per chunk. Blocks of the expected length are reserved when opened.
+    Buffered data is flushed when closed, even if the download failed, so it can be resumed from :attr:`position`.
+    """
+
+    def __init__(self, file_name: str, offset: int = 0, length: Optional[int] = None, buffer_size: int = 1024*1024, fsync: FsyncPolicy = 'never', executor: Optional[Executor] = None) -> None:
+        """
+        :param file_name: File to write. It is created if not exists, and never truncated.
+        :param offset: Position of the first byte.
+        :param length: Expected bytes to write, to reserve blocks. None if unknown.
+        :param buffer_size: Bytes to coalesce before a write.
+        :param fsync: When to fsync, see :data:`FsyncPolicy`.
+        :param executor: Executor of blocking writes. None for the default executor of event loop.
+        """
+        self.file_name = file_name
+        self.length = length
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.executor = executor
+        self.writes = 0
+        """Count of writes."""
+        self._position = offset
+        self._buffer = bytearray()
+        self._fd: Optional[int] = None
+        self._pending: Optional[asyncio.Future] = None
+
+    @property
+    def position(self) -> int:
+        """Position after the last written byte."""
+        return self._position
+
+    @property
+    def end(self) -> int:
+        """Position after the last byte, including buffered ones."""
+        return self._position + len(self._buffer)
+
+    def _open(self) -> int:
+        fd = os.open(self.file_name, os.O_WRONLY | os.O_CREAT, 0o644)
+        if self.length:
+            reserve(fd, self._position, self.length)
+        return fd
+
+    async def _run(self, fn, *args):
+        self._pending = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        return await self._pending
+
+    async def open(self):
+        self._fd = await self._run(self._open)
+
+    async def write(self, chunk: bytes):
+        self._buffer += chunk
+        if len(self._buffer) >= self.buffer_size:
+            await self.flush()
+
+    def _write(self, data: bytes, offset: int):
+        pwrite(self._fd, data, offset)  # type: ignore
+        if self.fsync == 'flush':
+            os.fsync(self._fd)  # type: ignore
+
+    async def flush(self):
+        """
+        Write buffered data.
+        """
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        await self._run(self._write, data, self._position)
+        self._position += len(data)
+        self.writes += 1
+
+    def _close(self, data: bytes, offset: int):
+        try:
+            if data:
+                self._write(data, offset)
+            if self.fsync != 'never':
+                os.fsync(self._fd)  # type: ignore
+        finally:
+            os.close(self._fd)  # type: ignore
+
+    async def close(self):
+        """
+        Flush and close in one executor call. The file is closed even if flush failed.
+        """
+        if self._fd is None:
+            return
+        data = b''
+        try:
+            # a cancelled write may still run in executor, it must finish before the descriptor is closed and reused
+            if self._pending is not None and not self._pending.done():
+                await asyncio.wait([self._pending])
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        finally:
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self._close, data, self._position)
+            finally:
+                self._fd = None
+        if data:
+            self._position += len(data)
+            self.writes += 1
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
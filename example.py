@@ -9,19 +9,24 @@ from al_utils.logger import Logger
 
 from conf import *
 from download.asynchttp import AsyncHTTP
-from download.resume import Resume
-from m3u8_util.m3u8 import download
+from download.cache import SegmentCache
+from download.jobstore import JobStore
+from download.metrics import Metrics
+from download.ratelimit import RateLimiter
+from m3u8_util.batch import BatchDownloader
+from m3u8_util.shard import ShardedDownloader
 
 FILE: str = os.path.join(DATA_DIR, "index.csv")
 
 logger = Logger(__file__).logger
 
 
-async def get_m3u8_url(url: str, headers: dict[str, str] = {}):
+async def get_m3u8_url(url: str, headers: dict[str, str] = {}, asynchttp: Optional[AsyncHTTP] = None):
     """
     get m3u8 link from url page.
 
     :param url: page url.
+    :param asynchttp: Shared http client. If None, a temporary one is used.
     """
     def parse_link(html: str) -> Optional[str]:
         p = re.compile(r'var player_aaaa=.*?"url":"(.*?)",', re.S)
@@ -30,36 +35,54 @@ async def get_m3u8_url(url: str, headers: dict[str, str] = {}):
             link = links[0].replace('\\', '')
             return link
 
-    return await AsyncHTTP().async_get(0, asyncio.Semaphore(1), url, lambda _, __, t: parse_link(t), headers)
+    if asynchttp is not None:
+        return await asynchttp.async_get(0, asyncio.Semaphore(1), url, lambda _, __, t: parse_link(t), headers)
+    async with AsyncHTTP() as client:
+        return await client.async_get(0, asyncio.Semaphore(1), url, lambda _, __, t: parse_link(t), headers)
 
 
 async def main():
     BASE_URL = "https://91md.me"
 
-    async def callback(link: str, name: str, rs_check_fn:bool):
-        try:
-            url = await get_m3u8_url(link)
-            if not url:
-                raise ValueError(f"cannot get m3u8 url from {link}")
-            fn,d = await download(url, name, M3U8_FILE_DIR, TMP_DIR, M3U8_VIDEO_DIR, HEADERS, MODE, not rs_check_fn)
-            if d:
-                logger.info(
-                    f'download video {name} successfully to {fn} from {url}')
-                ColoredConsole.success(
-                    f"Download successfully of {name} to {fn} from {link}")
-            else:
-                ColoredConsole.debug(f"Skip download {name} from {url}, file {fn} exists")
-            return True
-        except:
+    def on_done(name: str, link: str, result):
+        if isinstance(result, BaseException):
             ColoredConsole.error(f"Download failed of {name} from {link}.")
-            raise
+            return
+        fn, d = result
+        if d:
+            logger.info(f'download video {name} successfully to {fn} from {link}')
+            ColoredConsole.success(
+                f"Download successfully of {name} to {fn} from {link}")
+        else:
+            ColoredConsole.debug(f"Skip download {name} from {link}, file {fn} exists")
+
     with open(FILE, "r", newline="", encoding="utf-8") as f:
         rows = csv.reader(f)
         next(rows)
-        async with Resume() as resume:
-            for name, _, link in rows:
-                link = f"{BASE_URL}{link}"
-                await resume.run(link, lambda _: callback(link, name, RS_CHECK_FN))
+        jobs = ((name, f"{BASE_URL}{link}") for name, _, link in rows)
+        limiter = RateLimiter(BANDWIDTH, HOST_BANDWIDTH, HOSTS_BANDWIDTH, REQUESTS_PER_SECOND)
+        metrics = Metrics() if METRICS else None
+        cache = SegmentCache(CACHE_DIR, CACHE_SIZE) if CACHE_DIR else None
+        options = dict(m3u8_dir=M3U8_FILE_DIR, tmp_dir=TMP_DIR, videos_dir=M3U8_VIDEO_DIR, headers=HEADERS, mode=MODE, override=not RS_CHECK_FN, retry=RETRY, stream=STREAM,
+                       adaptive=ADAPTIVE, container=CONTAINER, cache=cache, parts=PARTS, verify=VERIFY, digest=DIGEST, min_free=MIN_FREE_SPACE)
+        if WORKERS > 1:
+            # the index is sharded across worker processes, only this process records jobs
+            async with ShardedDownloader(WORKERS, VIDEOS, CONNECTIONS, resolve=get_m3u8_url, limiter=limiter, metrics=metrics,
+                                         http=dict(write_buffer=WRITE_BUFFER, fsync=FSYNC), **options) as shards, JobStore(JOBS_DB, metrics=metrics) as resume:
+                resume.import_logs()
+                await shards.run(jobs, resume, on_done)
+        else:
+            asynchttp = AsyncHTTP(limit=CONNECTIONS, limit_per_host=CONNECTIONS, limiter=limiter,
+                                  metrics=metrics, write_buffer=WRITE_BUFFER, fsync=FSYNC)
+            async with asynchttp, BatchDownloader(VIDEOS, asynchttp=asynchttp, **options) as batch, JobStore(JOBS_DB, metrics=metrics) as resume:
+                resume.import_logs()
+                batch.resolve = lambda link: get_m3u8_url(link, asynchttp=batch.asynchttp)
+                await batch.run(jobs, resume, on_done)
+        if cache:
+            cache.close()
+        if metrics:
+            logger.info(f'summary of videos:\n{metrics.report()}')
+            metrics.save(METRICS)
 
 if __name__ == "__main__":
     m = main()
@@ -0,0 +1,185 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from al_utils.logger import Logger
+
+from download.asynchttp import AsyncHTTP
+from download.metrics import Metrics
+from download.ratelimit import RateLimiter
+from download.resume import Resume
+from m3u8_util.m3u8 import download
+
+logger = Logger(__file__).logger
+
+
+class JobRunner:
+    """
+    Run download jobs in order, at most :attr:`videos` of them at the same time, and record them in :class:`Resume`.
+
+    Subclasses download one job by :meth:`_download`, which releases its slot by the given callback.
+    """
+
+    def __init__(self, videos: int) -> None:
+        """
+        :param videos: Max count of videos downloading at the same time.
+        """
+        if videos < 1:
+            raise ValueError(f'videos must be positive, but got {videos}')
+        self.videos = videos
+        self.results: dict[str, tuple[str, bool]] = {}
+        """Saved filename and whether downloaded of each succeeded job, see :func:`m3u8_util.m3u8.download`."""
+        self.errors: dict[str, BaseException] = {}
+        """Exception of each failed job."""
+
+    async def _download(self, name: str, url: str, resume: Optional[Resume], release: Callable[[], Any]) -> tuple[str, bool]:
+        """
+        Download one job of :meth:`run`, and invoke :param:`release` once it does not need its slot, such as before muxing.
+        """
+        raise NotImplementedError
+
+    def _finished(self, name: str, status: str):
+        """
+        Invoked when a job is `done`, `failed`, or `skipped` by :class:`Resume`.
+        """
+        pass
+
+    async def _job(self, name: str, url: str, resume: Optional[Resume], on_done: Optional[Callable[[str, str, Any], Any]], release: Callable[[], Any]):
+        called = False
+
+        async def callback(_: str) -> bool:
+            nonlocal called
+            called = True
+            try:
+                self.results[name] = await self._download(name, url, resume, release)
+            except Exception as ex:
+                self.errors[name] = ex
+                self._finished(name, 'failed')
+                if on_done:
+                    on_done(name, url, ex)
+                raise
+            self._finished(name, 'done')
+            if on_done:
+                on_done(name, url, self.results[name])
+            return True
+        try:
+            if resume is not None:
+                await resume.run(url, callback)
+                return
+            try:
+                await callback(url)
+            except Exception:
+                logger.error(
+                    f'download failed of {name} from {url}', exc_info=True, stack_info=True)
+        finally:
+            if not called:
+                self._finished(name, 'skipped')
+            release()
+
+    async def run(self, jobs: Iterable[tuple[str, str]], resume: Optional[Resume] = None, on_done: Optional[Callable[[str, str, Any], Any]] = None):
+        """
+        Run all :param:`jobs`. Jobs are taken lazily in order, so it could be a large iterator.
+
+        :param jobs: `(name, url)` of each video.
+        :param resume: Track success, failure and current of jobs by url. Current only moves when all jobs before it finished.
+        :param on_done: Invoke when each job finished, `(name, url, result or exception) -> Any`.
+        """
+        slots = asyncio.Semaphore(self.videos)
+        tasks: set[asyncio.Future] = set()
+
+        def slot():
+            released = False
+
+            def release():
+                nonlocal released
+                if not released:
+                    released = True
+                    slots.release()
+            return release
+        try:
+            for name, url in jobs:
+                await slots.acquire()
+                task = asyncio.ensure_future(
+                    self._job(name, url, resume, on_done, slot()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+
+class BatchDownloader(JobRunner):
+    """
+    Download multiple videos concurrently.
+
+    At most :param:`videos` jobs download at the same time, so page resolving, playlist and segments
+    of different videos overlap. A job leaves its slot once its segments are downloaded, so combining and
+    remuxing overlap with downloads of the next videos, bounded by the ffmpeg process pool. All of them share one :class:`AsyncHTTP` whose connection pool is the
+    global budget, and each video gets an equal share of it as its segment concurrency.
+    """
+
+    def __init__(self, videos: int = 4, connections: int = 32, concurrency: Optional[int] = None, resolve: Optional[Callable[[str], Awaitable[Optional[str]]]] = None, asynchttp: Optional[AsyncHTTP] = None, limiter: Optional[RateLimiter] = None, metrics: Optional[Metrics] = None, **kwargs) -> None:
+        """
+        :param videos: Max count of videos downloading at the same time.
+        :param connections: Max connections of all videos. Ignored if :param:`asynchttp` is set.
+        :param concurrency: Segment concurrency of each video. Defaults to `connections // videos`.
+        :param resolve: Get m3u8 url from url of a job, such as parsing a page. None if url of jobs are m3u8 urls.
+        :param asynchttp: Shared http client. If None, a private one is created and closed by :meth:`close`.
+        :param limiter: Bandwidth and request rate limits of all videos. Ignored if :param:`asynchttp` is set.
+        :param metrics: Record timings of requests and a summary of each video. Ignored if :param:`asynchttp` is set.
+        :param kwargs: Extra arguments of :func:`m3u8_util.m3u8.download`, such as `m3u8_dir`, `tmp_dir`, `videos_dir`, `headers`, `mode`.
+        """
+        super().__init__(videos)
+        self._own_http = asynchttp is None
+        self.asynchttp = asynchttp or AsyncHTTP(
+            limit=connections, limit_per_host=connections, limiter=limiter, metrics=metrics)
+        budget = self.asynchttp.limit or connections
+        self.concurrency = concurrency or max(1, budget // videos)
+        self.resolve = resolve
+        self.kwargs = kwargs
+
+    async def download(self, name: str, url: str, resume: Optional[Resume] = None, on_downloaded: Optional[Callable[[], Any]] = None) -> tuple[str, bool]:
+        """
+        Download one job.
+
+        :param name: Video name.
+        :param url: Page url if :attr:`resolve` is set, otherwise m3u8 url.
+        :param resume: Record downloaded segments of :param:`url`.
+        :param on_downloaded: Invoke when segments are downloaded, before muxing.
+        """
+        m3u8_url = await self.resolve(url) if self.resolve else url
+        if not m3u8_url:
+            raise ValueError(f"cannot get m3u8 url from {url}")
+        kwargs = {'concurrency': self.concurrency, **self.kwargs}
+        if resume is not None:
+            kwargs['on_segment'] = lambda index, nbytes: resume.segment(
+                url, index, nbytes)
+        return await download(m3u8_url, name, asynchttp=self.asynchttp, on_downloaded=on_downloaded, **kwargs)
+
+    async def _download(self, name: str, url: str, resume: Optional[Resume], release: Callable[[], Any]) -> tuple[str, bool]:
+        return await self.download(name, url, resume, release)
+
+    async def run(self, jobs: Iterable[tuple[str, str]], resume: Optional[Resume] = None, on_done: Optional[Callable[[str, str, Any], Any]] = None):
+        """
+        Run all :param:`jobs`, see :meth:`JobRunner.run`.
+        """
+        await super().run(jobs, resume, on_done)
+        logger.info(
+            f'batch finished, {len(self.results)} succeeded, {len(self.errors)} failed')
+        if self.kwargs.get('cache'):
+            logger.info(f"segment cache {self.kwargs['cache'].stats}")
+
+    async def close(self):
+        """
+        Close the http client if it is created by this instance.
+        """
+        if self._own_http:
+            await self.asynchttp.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
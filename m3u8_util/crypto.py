@@ -0,0 +1,103 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Optional
+
+import m3u8
+from al_utils.logger import Logger
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from download.asynchttp import AsyncHTTP
+
+logger = Logger(__file__).logger
+
+
+def segment_iv(key: m3u8.Key, sequence: int) -> bytes:
+    """
+    IV of a segment. It is the `IV` attribute of :param:`key` if present,
+    otherwise media :param:`sequence` number of the segment as a 16 bytes big-endian integer.
+    """
+    if key.iv:
+        iv = key.iv[2:] if key.iv.lower().startswith('0x') else key.iv
+        return bytes.fromhex(iv.rjust(32, '0'))
+    return sequence.to_bytes(16, 'big')
+
+
+class Decryptor:
+    """
+    Streaming AES-128-CBC decryptor of one segment. PKCS7 padding is removed in :meth:`finalize`.
+    """
+
+    def __init__(self, key: bytes, iv: bytes) -> None:
+        if len(key) != 16:
+            raise ValueError(f'AES-128 key must be 16 bytes, but got {len(key)}')
+        self._decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        self._unpadder = padding.PKCS7(128).unpadder()
+
+    def update(self, data: bytes) -> bytes:
+        return self._unpadder.update(self._decryptor.update(data))
+
+    def finalize(self) -> bytes:
+        return self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
+
+
+class AsyncDecryptor:
+    """
+    :class:`Decryptor` which runs in :param:`executor`, so that it never blocks the event loop.
+    """
+
+    def __init__(self, key: bytes, iv: bytes, executor: Optional[Executor] = None) -> None:
+        """
+        :param executor: Executor to decrypt. None for the default executor of event loop.
+        """
+        self._decryptor = Decryptor(key, iv)
+        self.executor = executor
+
+    async def update(self, data: bytes) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._decryptor.update, data)
+
+    async def finalize(self) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._decryptor.finalize)
+
+
+class KeyCache:
+    """
+    Keys of a playlist by absolute key uri. Each key is fetched once even if requested concurrently.
+    """
+
+    def __init__(self, asynchttp: AsyncHTTP, headers: Optional[dict[str, str]] = None, retry: int = 3) -> None:
+        self.asynchttp = asynchttp
+        self.headers = headers
+        self.retry = retry
+        self._keys: dict[str, asyncio.Future] = {}
+
+    async def _fetch(self, uri: str) -> bytes:
+        key = await self.asynchttp.async_read(0, asyncio.Semaphore(1), uri, self.headers, retry=self.retry)
+        if len(key) != 16:
+            raise ValueError(
+                f'AES-128 key must be 16 bytes, but got {len(key)} from {uri}')
+        return key
+
+    async def get(self, uri: str) -> bytes:
+        """
+        Get key of :param:`uri`, fetch it if not cached.
+        """
+        if uri not in self._keys:
+            self._keys[uri] = asyncio.ensure_future(self._fetch(uri))
+        future = self._keys[uri]
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            # fetch again next time
+            if self._keys.get(uri) is future:
+                del self._keys[uri]
+            raise
+
+    def cached(self, uri: str) -> bytes:
+        """
+        Get key of :param:`uri` which has been fetched.
+        """
+        future = self._keys.get(uri)
+        if future is None or not future.done():
+            raise KeyError(f'key {uri} has not been fetched.')
+        return future.result()
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import time
+import weakref
+from collections import deque
+from typing import Any, AsyncIterable, Callable, Optional
+
+from al_utils.logger import Logger
+
+logger = Logger(__file__).logger
+
+_PROGRESS_INT = ('frame', 'total_size', 'out_time_us', 'out_time_ms', 'dup_frames', 'drop_frames')
+
+
+def parse_progress(block: dict[str, str], elapsed: float) -> dict[str, Any]:
+    """
+    Parse one block of ffmpeg `-progress` output.
+
+    :param block: `key=value` pairs of the block, ended with `progress`.
+    :param elapsed: Seconds since ffmpeg started.
+    :return: Values of :param:`block` with int fields converted, plus `elapsed` and `throughput` in bytes/s.
+    """
+    progress: dict[str, Any] = dict(block)
+    for k in _PROGRESS_INT:
+        v = block.get(k, '')
+        progress[k] = int(v) if v.lstrip('-').isdigit() else None
+    progress['elapsed'] = elapsed
+    size = progress['total_size']
+    progress['throughput'] = size / elapsed if size and elapsed > 0 else 0.0
+    return progress
+
+
+class FFmpegPool:
+    """
+    Run ffmpeg processes with `asyncio.create_subprocess_exec`, at most :param:`workers` at the same time.
+    """
+
+    _defaults: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, FFmpegPool]' = weakref.WeakKeyDictionary()
+
+    def __init__(self, workers: Optional[int] = None, ffmpeg: str = 'ffmpeg', terminate_timeout: float = 5.0) -> None:
+        """
+        :param workers: Max count of ffmpeg processes. Defaults to count of cpu cores.
+        :param ffmpeg: ffmpeg executable.
+        :param terminate_timeout: Seconds to wait ffmpeg exits after terminated when cancelled, then kill it.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.ffmpeg = ffmpeg
+        self.terminate_timeout = terminate_timeout
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self.running = 0
+        """Count of running processes."""
+
+    @classmethod
+    def default(cls) -> 'FFmpegPool':
+        """
+        Pool shared in the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in cls._defaults:
+            cls._defaults[loop] = cls()
+        return cls._defaults[loop]
+
+    async def run(self, *args: str, on_progress: Optional[Callable[[dict[str, Any]], Any]] = None, stdin: Optional[AsyncIterable[bytes]] = None) -> tuple[int, str]:
+        """
+        Run ffmpeg with :param:`args`. It waits if there are :attr:`workers` processes running.
+        The process is terminated if cancelled.
+
+        :param args: Arguments of ffmpeg.
+        :param on_progress: Invoke with parsed `-progress` of each update, see :func:`parse_progress`.
+        :param stdin: Data piped to ffmpeg, read it with input `pipe:0`.
+        :return: Return code and the last lines of stderr.
+        """
+        async with self._semaphore:
+            command = [self.ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error',
+                       '-progress', 'pipe:1', '-nostats', *args]
+            logger.debug(command)
+            start = time.monotonic()
+            process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL if stdin is None else asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            self.running += 1
+            errors: deque[str] = deque(maxlen=20)
+
+            async def read_progress():
+                block: dict[str, str] = {}
+                async for line in process.stdout:  # type: ignore
+                    k, _, v = line.decode(errors='replace').strip().partition('=')
+                    if not k:
+                        continue
+                    block[k] = v
+                    if k == 'progress':
+                        if on_progress:
+                            on_progress(parse_progress(
+                                block, time.monotonic() - start))
+                        block = {}
+
+            async def read_errors():
+                async for line in process.stderr:  # type: ignore
+                    errors.append(line.decode(errors='replace').rstrip())
+
+            async def write_input():
+                if stdin is None:
+                    return
+                try:
+                    async for chunk in stdin:
+                        process.stdin.write(chunk)  # type: ignore
+                        await process.stdin.drain()  # type: ignore
+                except (BrokenPipeError, ConnectionResetError):
+                    # ffmpeg exits early, its return code tells why
+                    logger.warning(f'ffmpeg {process.pid} closed input')
+                finally:
+                    process.stdin.close()  # type: ignore
+            try:
+                await asyncio.gather(read_progress(), read_errors(), write_input())
+                code = await process.wait()
+            except BaseException:
+                await self._terminate(process)
+                raise
+            finally:
+                self.running -= 1
+            return code, '\n'.join(errors)
+
+    async def _terminate(self, process: asyncio.subprocess.Process):
+        if process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), self.terminate_timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+        logger.warning(f'ffmpeg {process.pid} terminated')
@@ -1,32 +1,71 @@
 import asyncio
 import os
-import re
-import subprocess
-from typing import Literal
+from contextlib import nullcontext
+import time
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, ContextManager, Iterable, Iterator, Literal, Optional, Union
+from urllib.parse import unquote, urljoin, urlsplit
 
+import aiofiles
 import m3u8
 from al_utils.async_util import async_wrap
 from al_utils.logger import Logger
 from tqdm import tqdm
 
-from download.asynchttp import AsyncHTTP
+from download.asynchttp import AdaptiveSemaphore, AsyncHTTP
+from download.cache import SegmentCache
+from download.mirror import Mirrors
+from download.reorder import ReorderWriter
+from download.retry import RetryPolicy
 from download.util import format_fn
+from download.verify import Manifest, Verifier
+from download.writer import check_free_space
+from m3u8_util.crypto import AsyncDecryptor, Decryptor, KeyCache, segment_iv
+from m3u8_util.ffmpeg import FFmpegPool
+from m3u8_util.mux import Muxer, get_muxer, read_chunks
+from m3u8_util.variant import VariantPolicy, rendition_ext, select_renditions, select_variant
 
 logger = Logger(__file__).logger
 
 
-async def download(url: str, name: str, m3u8_dir="./m3u8", tmp_dir="./tmp", videos_dir: str = "./videos", headers: dict[str, str] = {}, mode: Literal['aio', 'ff'] = 'aio', override: bool = True, retry: int = 3):
+async def download(url: str, name: str, m3u8_dir="./m3u8", tmp_dir="./tmp", videos_dir: str = "./videos", headers: dict[str, str] = {}, mode: Literal['aio', 'ff'] = 'aio', override: bool = True, retry: int = 3, asynchttp: Optional[AsyncHTTP] = None, stream: bool = False, concurrency: int = 4, adaptive: bool = False, policy: Optional[RetryPolicy] = None, on_segment: Optional[Callable[[int, int], Awaitable[Any]]] = None, live: bool = False, duration: Optional[float] = None, variant: VariantPolicy = 'max_bandwidth', max_height: Optional[int] = None, max_bandwidth: Optional[int] = None, renditions: Iterable[str] = ('AUDIO', 'SUBTITLES'), languages: Optional[Iterable[str]] = None, ffpool: Optional[FFmpegPool] = None, container: Union[str, Muxer] = 'ts', on_downloaded: Optional[Callable[[], Any]] = None, cache: Optional[SegmentCache] = None, mirrors: Iterable[str] = (), parts: int = 1, verify: bool = False, digest: Optional[str] = None, min_free: int = 0):
     """
     download m3u8 video from url path.
 
+    If :param:`url` is a master playlist in aio mode, a variant stream is selected by :param:`variant`,
+    and its separate audio and subtitle renditions are downloaded concurrently to `{name}.{type}.{language}`.
+
     :param url: page url.
     :param name: video name.
     :param m3u8_dir: directory to save m3u8 files.
-    :param tmp_dir: directory to save segments.
+    :param tmp_dir: directory to save segments, in a sub directory of each video.
     :param videos_dir: directory to save output videos.
     :param mode: download mode.
     :param override: determine whether re-download if file has exists.
     :param retry: retry times when network error.
+    :param asynchttp: Shared http client to reuse pooled connections across videos.
+    :param stream: Write segments to output in order while downloading instead of combining them from :param:`tmp_dir` at last.
+    :param concurrency: Max concurrency of segments. Initial concurrency if :param:`adaptive`.
+    :param adaptive: Adjust concurrency of segments by throughput, latency and errors.
+    :param policy: Backoff and circuit breakers between retries. Defaults to the one of :param:`asynchttp`.
+    :param on_segment: Invoke when each segment downloaded in aio mode. `(index, bytes) -> Awaitable`
+    :param live: Capture a live or event playlist in aio mode until `#EXT-X-ENDLIST` or :param:`duration`.
+    :param duration: Max seconds to capture if :param:`live`.
+    :param variant: Policy to select variant stream of master playlist, see :func:`m3u8_util.variant.select_variant`.
+    :param max_height: Max height of resolution for `max_resolution` policy.
+    :param max_bandwidth: Bandwidth budget in bits/s for `bandwidth` policy.
+    :param renditions: Types of renditions to download.
+    :param languages: Languages of renditions to download. None for the default one of each type.
+    :param ffpool: Bounds count of ffmpeg processes in ff mode and of remuxing, shared across videos.
+    :param container: Output container of the video, see :data:`m3u8_util.mux.MUXERS`. Renditions keep the container of their segments, see :func:`m3u8_util.variant.rendition_ext`.
+    :param on_downloaded: Invoke once when all segments are downloaded in aio mode, before muxing.
+    :param cache: Segment cache shared across videos in aio mode. Not used if :param:`stream` or :param:`live`.
+    :param mirrors: Base urls of segments on other mirrors, equivalent to the base url of media playlist in aio mode.
+    :param parts: Split each large segment into up to this count of concurrent ranges in aio mode.
+    :param verify: Check MPEG-TS sync bytes of segments while receiving in aio mode. Broken segments are downloaded again.
+    :param digest: :module:`hashlib` algorithm of digests of segments recorded in manifest in aio mode, such as `sha256`.
+    :param min_free: Bytes to keep free on volumes of segments and output. In aio mode, it also fails before downloading segments
+        if the estimated size of video does not fit, see :meth:`AioM3U8.check_space`.
     :return: First item is saved filename. Second item is whether download(True: download, False: skip)
     """
     [AioM3U8.check_dir(d) for d in [m3u8_dir, tmp_dir, videos_dir]]
@@ -34,18 +73,90 @@ async def download(url: str, name: str, m3u8_dir="./m3u8", tmp_dir="./tmp", vide
         raise ValueError(f"m3u8 url must be set.")
     m3u8_fn = os.path.join(m3u8_dir, name+".m3u8")
     m3u8_fn = format_fn(m3u8_fn)
-    output_fn = os.path.join(videos_dir, name+".ts")
-    if os.path.exists(output_fn) and not override:
-        logger.info(f'Skip download {name} from {url} because {output_fn} exists and not override.')
-        return output_fn, False
-    if mode == 'aio':
-        base_url = re.findall(r'(h.*/).*m3u8', url)[0]
-        await AioM3U8.download(m3u8_fn, base_url, output_fn, url, tmp_dir, headers, retry=retry)
-    elif mode == 'ff':
-        async_wrap(FFM3U8.download(url, output_fn, headers, True, retry))
+    muxer = get_muxer(container, ffpool)
+    output_fn = os.path.join(videos_dir, name+muxer.ext)
+    if os.path.exists(output_fn) and not override and not ReorderWriter.is_partial(output_fn):
+        if Manifest(AioM3U8.manifest_fn(m3u8_fn)).check(os.path.basename(output_fn), output_fn):
+            logger.info(f'Skip download {name} from {url} because {output_fn} exists and not override.')
+            return output_fn, False
+        logger.warning(f'{output_fn} does not match its manifest, download it again.')
+    if policy is None and asynchttp is not None:
+        policy = asynchttp.policy
+    metrics = asynchttp.metrics if asynchttp is not None else None
+    with metrics.bind(name) if metrics else nullcontext():
+        if mode == 'aio':
+            own_http = asynchttp is None
+            if asynchttp is None:
+                asynchttp = AsyncHTTP(policy=policy)
+            kwargs = dict(stream=stream, retry=retry, asynchttp=asynchttp, concurrency=concurrency, adaptive=adaptive,
+                          policy=policy, on_segment=on_segment, live=live, duration=duration, cache=cache, mirrors=mirrors, parts=parts, verify=verify, digest=digest, min_free=min_free)
+            if on_downloaded:
+                remaining = 1
+
+                def downloaded():
+                    nonlocal remaining
+                    remaining -= 1
+                    if not remaining:
+                        on_downloaded()
+                kwargs['on_downloaded'] = downloaded
+            try:
+                text = (await asynchttp.async_read(0, asyncio.Semaphore(1), url, headers, retry=retry)).decode()
+                playlist = await asyncio.get_running_loop().run_in_executor(None, m3u8.loads, text)
+                if not playlist.is_variant:
+                    await _download_aio(url, name, m3u8_fn, output_fn, tmp_dir, headers, text, muxer=muxer, playlist=playlist, **kwargs)
+                    return output_fn, True
+                selected = select_variant(
+                    playlist, variant, max_height, max_bandwidth)
+                logger.info(
+                    f'{url}, select variant {selected.uri}, {selected.stream_info.bandwidth}, {selected.stream_info.resolution}')
+                jobs = [_download_aio(urljoin(url, selected.uri), name,
+                                      m3u8_fn, output_fn, tmp_dir, headers, muxer=muxer, bandwidth=selected.stream_info.bandwidth, **kwargs)]
+
+                async def rendition(media: m3u8.Media):
+                    n = f'{name}.{media.type.lower()}.{media.language or media.name or media.group_id}'
+                    media_url = urljoin(url, media.uri)
+                    # output container follows segments of the rendition, which are not remuxed
+                    text = (await asynchttp.async_read(0, asyncio.Semaphore(1), media_url, headers, retry=retry)).decode()  # type: ignore
+                    media_playlist = await asyncio.get_running_loop().run_in_executor(None, m3u8.loads, text)
+                    ext = rendition_ext(media.type, media_playlist)
+                    await _download_aio(media_url, n, format_fn(os.path.join(m3u8_dir, n+'.m3u8')), os.path.join(videos_dir, n+ext), tmp_dir, headers,
+                                        text, playlist=media_playlist, **{**kwargs, 'on_segment': None, 'mirrors': ()})
+                for media in select_renditions(selected, renditions, languages):
+                    jobs.append(rendition(media))
+                if on_downloaded:
+                    remaining = len(jobs)
+                await asyncio.gather(*jobs)
+            finally:
+                if own_http:
+                    await asynchttp.close()
+        elif mode == 'ff':
+            if min_free:
+                check_free_space(videos_dir, reserve=min_free)
+            await FFM3U8.download(url, output_fn, headers, True, retry, *muxer.options, policy=policy, pool=ffpool)
     return output_fn, True
 
 
+async def _download_aio(url: str, name: str, m3u8_fn: str, output_fn: str, tmp_dir: str, headers: dict[str, str], text: Optional[str] = None, live: bool = False, **kwargs):
+    """
+    Download media playlist :param:`url` in aio mode.
+
+    :param text: Content of media playlist if it has been fetched.
+    """
+    # directory of the playlist, relative segment uris are resolved against it
+    base_url = urljoin(url, '.')
+    # segments of different videos may have same names
+    seg_dir = format_fn(os.path.join(tmp_dir, name))
+    m3u8_url = url
+    if text is not None and not live:
+        AioM3U8.check_dir(os.path.dirname(m3u8_fn))
+        async with aiofiles.open(m3u8_fn, 'w', encoding='utf-8') as f:
+            await f.write(text)
+        m3u8_url = ''
+    await AioM3U8.download(m3u8_fn, base_url, output_fn, m3u8_url, seg_dir, headers, live=live, **kwargs)
+    if not os.listdir(seg_dir):
+        os.rmdir(seg_dir)
+
+
 class FFM3U8:
     """
     Download m3u8 video via ffmpeg
@@ -55,7 +166,7 @@ class FFM3U8:
     """
 
     @staticmethod
-    def download(url: str, output: str, headers: dict[str, str] = {}, override: bool = True, retry: int = 3, *options: str):
+    async def download(url: str, output: str, headers: dict[str, str] = {}, override: bool = True, retry: int = 3, *options: str, policy: Optional[RetryPolicy] = None, pool: Optional[FFmpegPool] = None, on_progress: Optional[Callable[[dict[str, Any]], Any]] = None):
         """
         download m3u8 url to :param:`output`
 
@@ -63,38 +174,90 @@ class FFM3U8:
         :param output: saved video file name.
         :param override: Determine whether override :param:`output` if exists.
         :param retry: Retry times.
-        :param options: extra arguments when invoke ffmpeg.
+        :param options: extra output arguments when invoke ffmpeg.
+        :param policy: Backoff between retries.
+        :param pool: Bounds count of running ffmpeg processes. Defaults to the one shared in the running loop.
+        :param on_progress: Invoke with ffmpeg progress, see :func:`m3u8_util.ffmpeg.parse_progress`.
         """
         if not url or not url.strip() or not url.lower().startswith('http'):
             raise ValueError("url must starts with http or https.")
         if not output:
             raise ValueError("please specified a output file name.")
+        args: list[str] = []
         if headers:
-            h = "\\r\\n".join([f"{k}:{v}" for k, v in headers.items()])
-            options = (*options, '-headers', h)
-        if override:
-            options = (*options, '-y')
-        else:
-            options = (*options, '-n')
+            args += ['-headers', ''.join(f'{k}: {v}\r\n' for k, v in headers.items())]
+        args += ['-i', url, '-c', 'copy', *options, '-y' if override else '-n', output]
+        policy = policy or RetryPolicy(breaker=False)
+        pool = pool or FFmpegPool.default()
         for i in range(retry):
-            command = f"ffmpeg -i {url} -c copy {' '.join(options)} {output}"
-            logger.debug(command)
-            with subprocess.Popen(command) as p:
-                pass
-            if p.returncode != 0:
-                logger.error(f'{url}, {i}, {p.returncode}')
+            if i:
+                await policy.sleep(i - 1)
+            code, errors = await pool.run(*args, on_progress=on_progress)
+            if code != 0:
+                logger.error(f'{url}, {i}, {code}, {errors}')
                 continue
-            logger.info(f'{url}, {p.returncode}')
+            logger.info(f'{url}, {code}')
             return output
         raise IOError(f'Download failed {url} in {retry} retries')
 
 
+def byte_ranges(segments: Iterable[m3u8.Segment]) -> list[Optional[tuple[int, int]]]:
+    """
+    Inclusive byte range of each segment by `EXT-X-BYTERANGE`, None if it is the whole resource.
+    A range without offset starts after the previous range of the same uri.
+    """
+    ranges: list[Optional[tuple[int, int]]] = []
+    ends: dict[str, int] = {}
+    for seg in segments:
+        if not seg.byterange:
+            ranges.append(None)
+            continue
+        length, _, offset = seg.byterange.partition('@')
+        start = int(offset) if offset else ends.get(seg.uri, 0)
+        ranges.append((start, start + int(length) - 1))
+        ends[seg.uri] = start + int(length)
+    return ranges
+
+
+def init_sections(segments: Iterable[m3u8.Segment]) -> dict[int, tuple[str, Optional[tuple[int, int]]]]:
+    """
+    `EXT-X-MAP` initialization section of fMP4 segments in `(uri, inclusive byte range)`, by the index of the first
+    segment it applies to. It has to be written before that segment, and again whenever it changes.
+    """
+    inits: dict[int, tuple[str, Optional[tuple[int, int]]]] = {}
+    last = None
+    for index, seg in enumerate(segments):
+        current = init_section(seg)
+        if current and current != last:
+            inits[index] = current
+        last = current
+    return inits
+
+
+def init_section(seg: m3u8.Segment) -> Optional[tuple[str, Optional[tuple[int, int]]]]:
+    """
+    `EXT-X-MAP` of :param:`seg` in `(uri, inclusive byte range)`, None if it has none.
+    """
+    init = seg.init_section
+    if init is None:
+        return None
+    if not init.byterange:
+        return (init.uri, None)
+    length, _, offset = init.byterange.partition('@')
+    start = int(offset or 0)
+    return (init.uri, (start, start + int(length) - 1))
+
+
+NOT_TS = ('.aac', '.ac3', '.ec3', '.mp3', '.m4a', '.m4s', '.m4v', '.mp4', '.vtt', '.webvtt')
+"""Extensions of segments which are not MPEG-TS."""
+
+
 class AioM3U8:
     """
     Download m3u8 video via aiohttp
     """
 
-    def __init__(self, m3u8_filename: str,  tmp_dir: str = 'tmp', headers: dict[str, str] = {}, retry: int = 3) -> None:
+    def __init__(self, m3u8_filename: str,  tmp_dir: str = 'tmp', headers: dict[str, str] = {}, retry: int = 3, asynchttp: Optional[AsyncHTTP] = None, concurrency: int = 4, adaptive: bool = False, max_concurrency: int = 32, policy: Optional[RetryPolicy] = None, on_segment: Optional[Callable[[int, int], Awaitable[Any]]] = None, executor: Optional[Executor] = None, cache: Optional[SegmentCache] = None, mirrors: Iterable[str] = (), hedge: float = 0.95, parts: int = 1, part_size: int = 8*1024*1024, coalesce: int = 16*1024*1024, verify: bool = False, digest: Optional[str] = None, playlist: Optional[m3u8.M3U8] = None) -> None:
         """
         Create a :class:`M3U8` instance to download m3u8.
 
@@ -103,43 +266,691 @@ class AioM3U8:
         :param tmp_dir: Directory to save segments.
         :param headers: Request headers.
         :param retry: Retry times.
+        :param asynchttp: Shared http client. If None, a private one is created and closed by :meth:`close`.
+        :param concurrency: Max concurrency of segments. Initial concurrency if :param:`adaptive`.
+        :param adaptive: Adjust concurrency of segments up to :param:`max_concurrency`, see :class:`AdaptiveSemaphore`.
+        :param max_concurrency: Max concurrency of segments if :param:`adaptive`.
+        :param policy: Backoff and circuit breakers between retries. Only used when :param:`asynchttp` is None, otherwise its own policy is used.
+        :param on_segment: Invoke when each segment downloaded. `(index, bytes) -> Awaitable`
+        :param executor: Executor to decrypt AES-128 segments. None for the default executor of event loop.
+        :param cache: Segment cache consulted before downloading segments by :meth:`download_segs`.
+        :param mirrors: Base urls equivalent to the base url of segments. Segments are spread across them by throughput,
+            and slow ones are hedged on another mirror, see :class:`download.mirror.Mirrors`. Not used if live.
+        :param hedge: Percentile of recent segment durations to send a hedged request.
+        :param parts: Split each large segment into up to this count of concurrent ranges, see :meth:`AsyncHTTP.async_download`.
+        :param part_size: Min bytes of each part.
+        :param coalesce: Max bytes of adjacent `EXT-X-BYTERANGE` segments of one uri to download in one request.
+        :param verify: Check MPEG-TS sync bytes of segments while receiving, see :meth:`verifier`.
+        :param digest: :module:`hashlib` algorithm to compute digest of segments while receiving, such as `sha256`.
+            Digests are recorded in sidecars and :attr:`manifest`. None to disable.
+        :param playlist: Parsed :param:`m3u8_filename` if it has been parsed, see :meth:`load_playlist`.
         """
         self.check_dir(tmp_dir)
-        self.asynchttp = AsyncHTTP()
+        self._own_http = asynchttp is None
+        self.asynchttp = asynchttp or AsyncHTTP(policy=policy)
         self.tmp_dir = tmp_dir
         self.headers = headers
         self.m3u8_filename = m3u8_filename
         self.retry = retry if retry or retry > 0 else 3
+        self.concurrency = concurrency
+        self.adaptive = adaptive
+        self.max_concurrency = max_concurrency
+        self.on_segment = on_segment
+        self.executor = executor
+        self.cache = cache
+        self.mirrors = list(mirrors)
+        self.hedge = hedge
+        self.parts = parts
+        self.part_size = part_size
+        self.coalesce = coalesce
+        self.verify = verify
+        self.digest = digest
+        self.manifest = Manifest(self.manifest_fn(m3u8_filename))
+        self._playlist = playlist
+        self._layouts: Optional[tuple[m3u8.M3U8, Any]] = None
+        self.keys = KeyCache(self.asynchttp, headers, self.retry)
+
+    @staticmethod
+    def manifest_fn(m3u8_filename: str) -> str:
+        """
+        Manifest of sizes and digests of segments and output of :param:`m3u8_filename`, see :class:`Manifest`.
+        """
+        return f'{os.path.splitext(m3u8_filename)[0]}.manifest.json'
+
+    def verifier(self, seg: m3u8.Segment, decrypted: bool = False) -> Optional[Callable[[], Verifier]]:
+        """
+        Factory of verifier of :param:`seg`, None if nothing to verify.
+        MPEG-TS is checked if :attr:`verify`, unless it is fMP4, not a video, or still encrypted.
+
+        :param decrypted: Whether it verifies decrypted data.
+        """
+        ts = self.verify and seg.init_section is None and os.path.splitext(seg.uri.split('?')[0])[1].lower() not in NOT_TS \
+            and (decrypted or self._key(seg.key) is None)
+        if not ts and not self.digest:
+            return None
+        return lambda: Verifier(ts, self.digest, seg.uri)
+
+    def semaphore(self) -> Union[asyncio.Semaphore, AdaptiveSemaphore]:
+        """
+        Create concurrency controller of segments.
+        """
+        if self.adaptive:
+            return AdaptiveSemaphore(self.concurrency, 1, self.max_concurrency, name=os.path.basename(self.m3u8_filename))
+        return asyncio.Semaphore(self.concurrency)
+
+    def _stage(self, stage: str) -> ContextManager:
+        """
+        Time :param:`stage` if metrics of :attr:`asynchttp` is enabled.
+        """
+        metrics = self.asynchttp.metrics
+        return metrics.stage(stage) if metrics else nullcontext()
+
+    def _segment(self, semaphore: Union[asyncio.Semaphore, AdaptiveSemaphore, None] = None):
+        metrics = self.asynchttp.metrics
+        if metrics:
+            metrics.segment(semaphore.limit if isinstance(
+                semaphore, AdaptiveSemaphore) else self.concurrency)
+
+    @staticmethod
+    def _key(key: Optional[m3u8.Key]) -> Optional[m3u8.Key]:
+        """
+        Return :param:`key` if segment is encrypted.
+
+        :raise ValueError: If it is encrypted by other methods than AES-128, such as SAMPLE-AES.
+        """
+        if key is None or not key.method or key.method == 'NONE':
+            return None
+        if key.method != 'AES-128':
+            raise ValueError(
+                f'{key.method} encryption is not supported in aio mode, try ff mode.')
+        return key
+
+    async def decryptor(self, key: Optional[m3u8.Key], sequence: int, base_url: str) -> Optional[Callable[[], AsyncDecryptor]]:
+        """
+        Factory of decryptor of a segment, None if not encrypted.
+
+        :param key: Key of the segment.
+        :param sequence: Media sequence number of the segment.
+        :param base_url: Base URL to resolve relative key uri.
+        """
+        key = self._key(key)
+        if key is None:
+            return None
+        k = await self.keys.get(urljoin(base_url, key.uri))
+        iv = segment_iv(key, sequence)
+        return lambda: AsyncDecryptor(k, iv, self.executor)
+
+    async def fetch_keys(self, base_url: str):
+        """
+        Fetch keys of all encrypted segments, so that :meth:`combine_segs` can decrypt them.
+        """
+        playlist = await self.load_playlist()
+        uris = {urljoin(base_url, k.uri)
+                for k in (self._key(seg.key) for seg in playlist.segments) if k}
+        await asyncio.gather(*[self.keys.get(uri) for uri in uris])
 
     async def download_m3u8(self, url: str):
-        await self.asynchttp.async_download(0, asyncio.Semaphore(1), url, self.m3u8_filename, self.headers, retry=self.retry)
+        """
+        Fetch playlist :param:`url` by the shared client, save it to :attr:`m3u8_filename` and parse it.
+        """
+        text = (await self.asynchttp.async_read(0, asyncio.Semaphore(1), url, self.headers, retry=self.retry)).decode()
+        async with aiofiles.open(self.m3u8_filename, 'w', encoding='utf-8') as f:
+            await f.write(text)
+        self._playlist = await self._parse(text)
+
+    async def _parse(self, text: str) -> m3u8.M3U8:
+        """
+        Parse playlist :param:`text` in :attr:`executor`, so a playlist of many segments does not block the loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, m3u8.loads, text)
+
+    async def load_playlist(self) -> m3u8.M3U8:
+        """
+        Parsed :attr:`m3u8_filename`. It is parsed off the loop once and cached on this instance.
+        """
+        if self._playlist is None:
+            async with aiofiles.open(self.m3u8_filename, encoding='utf-8') as f:
+                text = await f.read()
+            self._playlist = await self._parse(text)
+        return self._playlist
+
+    def _loaded(self) -> m3u8.M3U8:
+        """
+        Like :meth:`load_playlist`, for methods which run in an executor.
+        """
+        if self._playlist is None:
+            self._playlist = m3u8.load(self.m3u8_filename)
+        return self._playlist
+
+    @staticmethod
+    def seg_url(base_url: str, uri: str) -> str:
+        """
+        Resolve segment :param:`uri` against :param:`base_url`, such as the directory of the playlist.
+        Absolute uris and query strings are kept.
+        """
+        return urljoin(base_url, uri)
+
+    @staticmethod
+    def _name(uri: str) -> str:
+        """
+        Local file name of segment :param:`uri`, the last part of its path.
+        """
+        return unquote(os.path.basename(urlsplit(uri).path)) or 'segment'
+
+    def _layout(self, playlist: m3u8.M3U8) -> tuple[list[tuple[str, str, Optional[tuple[int, int]], list[int]]], list[tuple[str, int, Optional[int]]], dict[int, tuple[str, int, Optional[int]]]]:
+        """
+        Map segments of :param:`playlist` and their initialization sections to downloads in `self.tmp_dir`.
+
+        A segment without `EXT-X-BYTERANGE` is downloaded to the name of its uri, see :meth:`_name`. Adjacent byte ranges
+        of one uri are coalesced into one download of up to :attr:`coalesce` bytes, named with its first offset.
+        A name used by another uri, such as `seg.ts?n=1` and `seg.ts?n=2`, is prefixed with the segment index.
+        Initialization sections are laid out the same way, see :func:`init_sections`.
+        It is cached for the same :param:`playlist`.
+
+        :return: Each download in `(uri, file name, byte range, segment indexes)`,
+            each segment in `(file name, offset, length)`, where length is None for the whole file,
+            and each initialization section in the same form by the index of the segment it is written before.
+        """
+        if self._layouts is not None and self._layouts[0] is playlist:
+            return self._layouts[1]
+        downloads: list[tuple[str, str, Optional[tuple[int, int]], list[int]]] = []
+        pieces: list[tuple[str, int, Optional[int]]] = []
+        names: dict[str, str] = {}
+
+        def file_name(index: int, uri: str, suffix: str = '') -> str:
+            name = self._name(uri) + suffix
+            if names.setdefault(name, uri) != uri:
+                name = f'{index}.{name}'
+                names[name] = uri
+            return os.path.join(self.tmp_dir, name)
+        inits: dict[int, tuple[str, int, Optional[int]]] = {}
+        sections = init_sections(playlist.segments)
+        seen: dict[tuple[str, Optional[tuple[int, int]]], tuple[str, int, Optional[int]]] = {}
+
+        def add(index: int, uri: str, rng: Optional[tuple[int, int]], segments: list[int]) -> tuple[str, int, Optional[int]]:
+            if rng is None:
+                fn = file_name(index, uri)
+                downloads.append((uri, fn, None, segments))
+                return (fn, 0, None)
+            start, end = rng
+            last = downloads[-1] if downloads else None
+            if last and last[0] == uri and last[2] and last[2][1] + 1 == start and end - last[2][0] < self.coalesce:
+                downloads[-1] = (uri, last[1], (last[2][0], end), last[3] + segments)
+                return (last[1], start - last[2][0], end - start + 1)
+            fn = file_name(index, uri, f'.{start}')
+            downloads.append((uri, fn, rng, segments))
+            return (fn, 0, end - start + 1)
+        for index, (seg, rng) in enumerate(zip(playlist.segments, byte_ranges(playlist.segments))):
+            if index in sections:
+                # a section switched back to is downloaded once
+                section = sections[index]
+                if section not in seen:
+                    seen[section] = add(index, *section, [])
+                inits[index] = seen[section]
+            pieces.append(add(index, seg.uri, rng, [index]))
+        self._layouts = (playlist, (downloads, pieces, inits))
+        return self._layouts[1]
+
+    @staticmethod
+    def estimate_size(playlist: m3u8.M3U8, bandwidth: Optional[int] = None) -> Optional[int]:
+        """
+        Estimate bytes of segments of :param:`playlist`, exactly if all of them have `EXT-X-BYTERANGE`,
+        otherwise by their duration and :param:`bandwidth` in bits/s.
+
+        :return: None if it is unknown.
+        """
+        ranges = byte_ranges(playlist.segments)
+        if ranges and all(ranges):
+            return sum(end - start + 1 for start, end in ranges)  # type: ignore
+        if bandwidth:
+            return int(sum(seg.duration or 0 for seg in playlist.segments) * bandwidth / 8)
+        return None
+
+    async def check_space(self, output: str, bandwidth: Optional[int] = None, reserve: int = 0, stream: bool = False, remux: bool = False):
+        """
+        Fail fast before downloading segments if volumes of :attr:`tmp_dir` or :param:`output` cannot hold the video
+        of estimated size, see :meth:`estimate_size`, and still keep :param:`reserve` bytes free.
+        Segments which have been downloaded are not counted. A volume holding both only needs room for the larger one,
+        because each segment is removed once combined into :param:`output`.
+
+        :param stream: Segments are written to :param:`output` directly, without :attr:`tmp_dir`.
+        :param remux: Segments are kept until :param:`output` is remuxed, so a volume holding both needs room for both.
+        :raise IOError: `ENOSPC` if there is not enough free space.
+        """
+        playlist = await self.load_playlist()
+        size = self.estimate_size(playlist, bandwidth) or 0
+        if not size and not reserve:
+            return
+        downloads, *_ = self._layout(playlist)
+
+        def check():
+            paths = [(os.path.dirname(os.path.abspath(output)), size)]
+            if not stream:
+                done = sum(os.path.getsize(fn) for _, fn, *_ in downloads if os.path.exists(fn))
+                paths.append((self.tmp_dir, max(0, size - done)))
+            needs: dict[int, tuple[str, int]] = {}
+            for path, need in paths:
+                dev = os.stat(path).st_dev
+                if dev not in needs:
+                    needs[dev] = (path, need)
+                elif remux:
+                    needs[dev] = (path, needs[dev][1] + need)
+                elif needs[dev][1] < need:
+                    needs[dev] = (path, need)
+            for path, need in needs.values():
+                check_free_space(path, need, reserve)
+        await asyncio.get_running_loop().run_in_executor(self.executor, check)
+
+    @staticmethod
+    def _cache_key(url: str, byte_range: Optional[tuple[int, int]]) -> str:
+        return f'{url}#bytes={byte_range[0]}-{byte_range[1]}' if byte_range else url
 
     async def download_segs(self, base_url: str):
         """
-        download m3u8 segment videos with :param:`base_url` to `self.tmp_dir`
+        download m3u8 segment videos with :param:`base_url` to `self.tmp_dir`.
+        Completed segments are skipped and partial segments are resumed.
+        Segments in :attr:`cache` are linked instead of downloaded, and downloaded ones are added to it.
+        Adjacent `EXT-X-BYTERANGE` segments are downloaded together, see :meth:`_layout`.
+
+        Segments which are missing or broken by :meth:`check_segs` afterwards are downloaded again once.
+        Sizes and digests of segments are recorded in :attr:`manifest`.
+
+        :raise IOError: If some segments still fail.
+        """
+        try:
+            await self._download_segs(base_url)
+            bad = await self.check_segs()
+            if bad:
+                logger.warning(
+                    f'{self.m3u8_filename}, {len(bad)} segments missing or broken, download them again')
+                await self._download_segs(base_url, bad)
+                bad = await self.check_segs()
+                if bad:
+                    raise IOError(
+                        f'{self.m3u8_filename}, {len(bad)} segments failed, such as {self._layout(await self.load_playlist())[0][bad[0]][0]}')
+        finally:
+            await self.manifest.save()
+
+    async def check_segs(self) -> list[int]:
+        """
+        Check downloaded segments without reading them: each one must be completed by its sidecar
+        and have its size in :attr:`manifest`.
+
+        :return: Indexes of downloads of :meth:`_layout` which are missing or broken.
+        """
+        downloads, *_ = self._layout(await self.load_playlist())
+        bad = []
+        for n, (_, fn, _, _) in enumerate(downloads):
+            if not await AsyncHTTP.is_complete(fn) or not self.manifest.check(os.path.relpath(fn, self.tmp_dir), fn):
+                bad.append(n)
+        return bad
+
+    async def _download_segs(self, base_url: str, indexes: Optional[list[int]] = None):
+        """
+        Download :param:`indexes` of downloads of :meth:`_layout`, all if None.
+        """
+        playlist = await self.load_playlist()
+        downloads, pieces, _ = self._layout(playlist)
+        urls = [self.seg_url(base_url, uri) for uri, *_ in downloads]
+        fns = [fn for _, fn, *_ in downloads]
+        ranges = [rng for _, _, rng, _ in downloads]
+        pending = list(range(len(downloads))) if indexes is None else list(indexes)
+        if indexes is not None:
+            for n in pending:
+                AsyncHTTP.remove(fns[n])
+
+        async def downloaded(n: int, meta: dict[str, Any]):
+            self.manifest.add(os.path.relpath(fns[n], self.tmp_dir), os.path.getsize(fns[n]),
+                              **({self.digest: meta[self.digest]} if self.digest and self.digest in meta else {}))
+            for i in downloads[n][3]:
+                self._segment()
+                if self.on_segment:
+                    length = pieces[i][2]
+                    await self.on_segment(i, os.path.getsize(fns[n]) if length is None else length)
+        if self.cache:
+            hits, misses = [], []
+            for n in pending:
+                (hits if await self.cache.materialize(self._cache_key(urls[n], ranges[n]), fns[n]) else misses).append(n)
+            pending = misses
+            logger.info(
+                f'{self.m3u8_filename}, {len(hits)} downloads cached, {len(pending)} to download')
+            metrics = self.asynchttp.metrics
+            if metrics:
+                metrics.inc('cache_hits_total', len(hits))
+                metrics.inc('cache_misses_total', len(pending))
+            for n in hits:
+                await downloaded(n, {})
+
+        async def callback(index: int, url: str, fn: str):
+            n = pending[index]
+            # the sidecar is only read for digests
+            meta = await AsyncHTTP.read_meta(fn) if self.cache or self.digest else {}
+            if self.cache:
+                await self.cache.store(self._cache_key(url, ranges[n]), fn, meta.get('sha256'))
+            await downloaded(n, meta)
+        if pending and self.mirrors:
+            await self._download_mirrored(base_url, playlist, downloads, pending, callback)
+        elif pending:
+            verifiers = [self.verifier(playlist.segments[downloads[n][3][0]]) if downloads[n][3] else None for n in pending]
+            await self.asynchttp.async_downloads(self.concurrency, [urls[n] for n in pending], [fns[n] for n in pending], self.headers, retry=self.retry, adaptive=self.adaptive, max_sem=self.max_concurrency, callback=callback,
+                                                 byte_ranges=[ranges[n] for n in pending], parts=self.parts, part_size=self.part_size,
+                                                 verify=lambda index: verifiers[index]() if verifiers[index] else None)
+
+    def _sections(self, base_url: str, semaphore: Union[asyncio.Semaphore, AdaptiveSemaphore]) -> Callable[[str, Optional[tuple[int, int]]], Awaitable[bytes]]:
+        """
+        Read initialization sections by `(uri, byte range)` to be written before their segments,
+        each one is requested once however many segments it is written before.
         """
-        playlist = m3u8.load(self.m3u8_filename)
-        urls = [f'{base_url}{seg}' for seg in playlist.files]
-        fns = [f'{os.path.join(self.tmp_dir,seg)}' for seg in playlist.files]
-        await self.asynchttp.async_downloads(4, urls, fns, self.headers, retry=self.retry)
+        reads: dict[tuple[str, Optional[tuple[int, int]]], asyncio.Future] = {}
 
-    def combine_segs(self, output: str):
+        async def read(uri: str, rng: Optional[tuple[int, int]]) -> bytes:
+            if (uri, rng) not in reads:
+                reads[(uri, rng)] = asyncio.ensure_future(self.asynchttp.async_read(
+                    0, semaphore, self.seg_url(base_url, uri), self.headers, retry=self.retry, byte_range=rng))
+            # shared by segments, one of them cancelled does not cancel the others
+            return await asyncio.shield(reads[(uri, rng)])
+        return read
+
+    def _mirrors(self, base_url: str) -> Optional[Mirrors]:
+        return Mirrors([base_url, *self.mirrors], self.hedge) if self.mirrors else None
+
+    def _gate(self) -> asyncio.Semaphore:
+        """
+        Bounds segments which have picked a mirror, so that each one is picked with throughput of the finished ones
+        instead of all at once. Hedged requests still take their own slots of :meth:`semaphore`.
+        """
+        return asyncio.Semaphore(self.max_concurrency if self.adaptive else self.concurrency)
+
+    async def _download_mirrored(self, base_url: str, playlist: m3u8.M3U8, downloads: list[tuple[str, str, Optional[tuple[int, int]], list[int]]], pending: list[int], callback: Callable[[int, str, str], Awaitable[Any]]):
+        """
+        Download :param:`pending` of :param:`downloads` from :param:`base_url` and :attr:`mirrors`, see :class:`Mirrors`.
+        Each mirror downloads to its own partial file, and the winner is renamed to the segment file.
+        A segment failed on all mirrors is skipped like :meth:`AsyncHTTP.async_downloads` does, it is left to :meth:`check_segs`.
+        """
+        mirrors = self._mirrors(base_url)
+        assert mirrors is not None
+        semaphore = self.semaphore()
+        gate = self._gate()
+
+        async def fetch(n: int, index: int):
+            uri, fn, rng, segments = downloads[index]
+            verify = self.verifier(playlist.segments[segments[0]]) if segments else None
+            meta = await AsyncHTTP.read_meta(fn)
+            if meta.get('url') in {self.seg_url(b, uri) for b in mirrors.base_urls} and meta.get('range') == (list(rng) if rng else None) \
+                    and await AsyncHTTP.is_complete(fn, meta['url']):
+                logger.info(f'{index}, {meta["url"]}, skip completed')
+            else:
+                def part(b: str) -> str:
+                    return f'{fn}.{mirrors.base_urls.index(b)}'
+
+                async def one(b: str) -> str:
+                    await self.asynchttp.async_download(index, semaphore, self.seg_url(b, uri), part(b), self.headers, retry=self.retry,
+                                                        byte_range=rng, parts=self.parts, part_size=self.part_size, verify=verify)
+                    return part(b)
+                try:
+                    async with gate:
+                        winner = await mirrors.fetch(one, os.path.getsize, lambda b: AsyncHTTP.remove(part(b)))
+                except Exception:
+                    logger.error(f'{index}, {uri}, failed on all mirrors', exc_info=True)
+                    return
+                AsyncHTTP.remove(fn)
+                os.replace(winner, fn)
+                os.replace(AsyncHTTP.meta_fn(winner), AsyncHTTP.meta_fn(fn))
+            await callback(n, self.seg_url(base_url, uri), fn)
+        tasks = [asyncio.ensure_future(fetch(n, i)) for n, i in enumerate(pending)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            logger.info(f'{self.m3u8_filename}, mirrors {mirrors.stats}')
+
+    async def close(self):
+        """
+        Close the http client if it is created by this instance.
+        """
+        if self._own_http:
+            await self.asynchttp.close()
+
+    async def stream_segs(self, base_url: str, output: str, buffer_size: int = 64*1024*1024, bandwidth: Optional[int] = None):
+        """
+        download m3u8 segment videos with :param:`base_url` and write them to :param:`output` in playlist order while downloading.
+
+        Segments after a missing one are buffered in memory up to :param:`buffer_size` bytes, then spilled to `self.tmp_dir`.
+        An interrupted :param:`output` is continued from the first unwritten segment.
+        AES-128 encrypted segments are decrypted chunk by chunk while receiving, and verified after decryption.
+        Each `EXT-X-BYTERANGE` segment is requested by its own range, they are not coalesced.
+        Initialization sections of fMP4 segments are written before them, see :func:`init_sections`.
+
+        :param buffer_size: Max bytes of out of order segments kept in memory.
+        :param bandwidth: Bits/s of the stream to estimate the size of :param:`output` to reserve, see :meth:`estimate_size`.
+        """
+        playlist = await self.load_playlist()
+        urls = [self.seg_url(base_url, seg.uri) for seg in playlist.segments]
+        ranges = byte_ranges(playlist.segments)
+        semaphore = self.semaphore()
+        sections = init_sections(playlist.segments)
+        section = self._sections(base_url, semaphore)
+        mirrors = self._mirrors(base_url)
+        gate = self._gate()
+        sequence = playlist.media_sequence or 0
+        async with ReorderWriter(output, self.tmp_dir, buffer_size, len(urls), resume=True, write_buffer=self.asynchttp.write_buffer,
+                                 fsync=self.asynchttp.fsync, length=self.estimate_size(playlist, bandwidth)) as writer:
+            async def fetch(index: int, url: str):
+                transform = await self.decryptor(playlist.segments[index].key, sequence + index, base_url)
+                verify = self.verifier(playlist.segments[index], decrypted=True)
+                if mirrors:
+                    uri = playlist.segments[index].uri
+                    async with gate:
+                        data = await mirrors.fetch(lambda b: self.asynchttp.async_read(index, semaphore, self.seg_url(b, uri), self.headers, retry=self.retry, transform=transform, byte_range=ranges[index], verify=verify))
+                else:
+                    data = await self.asynchttp.async_read(index, semaphore, url, self.headers, retry=self.retry, transform=transform, byte_range=ranges[index], verify=verify)
+                if index in sections:
+                    data = await section(*sections[index]) + data
+                await writer.put(index, data)
+                self._segment(semaphore)
+                if self.on_segment:
+                    await self.on_segment(index, len(data))
+            tasks = [asyncio.ensure_future(fetch(i, url))
+                     for i, url in enumerate(urls) if i >= writer.next]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+    async def live_segs(self, m3u8_url: str, base_url: str, output: str, duration: Optional[float] = None, poll: Optional[float] = None, buffer_size: int = 64*1024*1024):
+        """
+        Capture a live or event playlist from :param:`m3u8_url` to :param:`output`.
+
+        The playlist is reloaded every target duration (half of it if nothing changed), and only segments
+        with new media sequence numbers are downloaded and written to :param:`output` in order.
+        It stops at `#EXT-X-ENDLIST` or after :param:`duration` seconds. Failed segments are skipped.
+        Initialization sections of fMP4 segments are written before the first segment captured of each one.
+
+        :param duration: Max seconds to capture. None to capture until the end of playlist.
+        :param poll: Seconds between reloads. Defaults to target duration of the playlist.
+        :param buffer_size: Max bytes of out of order segments kept in memory.
+        """
+        semaphore = self.semaphore()
+        section = self._sections(base_url, semaphore)
+        last_section = None
+        start = time.monotonic()
+        last_seq = -1
+        count = 0
+        tasks: set[asyncio.Future] = set()
+        text = ''
+        async with ReorderWriter(output, self.tmp_dir, buffer_size, write_buffer=self.asynchttp.write_buffer, fsync=self.asynchttp.fsync) as writer:
+            async def fetch(index: int, url: str, key: Optional[m3u8.Key], sequence: int, init: Optional[tuple[str, Optional[tuple[int, int]]]]):
+                head = b''
+                try:
+                    if init:
+                        head = await section(*init)
+                    transform = await self.decryptor(key, sequence, base_url)
+                    data = await self.asynchttp.async_read(index, semaphore, url, self.headers, retry=self.retry, transform=transform)
+                except Exception:
+                    logger.error(
+                        f'skip live segment {index}, {url}', exc_info=True)
+                    data = b''
+                # the initialization section is written even if the segment is skipped, the next ones need it
+                await writer.put(index, head + data)
+                if data:
+                    self._segment(semaphore)
+                if self.on_segment and data:
+                    await self.on_segment(index, len(data))
+            try:
+                while True:
+                    reload = time.monotonic()
+                    text = (await self.asynchttp.async_read(0, asyncio.Semaphore(1), m3u8_url, self.headers, retry=self.retry)).decode()
+                    playlist = await self._parse(text)
+                    first = playlist.media_sequence or 0
+                    if 0 <= last_seq < first - 1:
+                        logger.warning(
+                            f'{m3u8_url} missed segments {last_seq+1} to {first-1}')
+                    new = 0
+                    for i, seg in enumerate(playlist.segments):
+                        if first + i <= last_seq:
+                            continue
+                        last_seq = first + i
+                        init = init_section(seg)
+                        task = asyncio.ensure_future(
+                            fetch(count, self.seg_url(base_url, seg.uri), seg.key, last_seq, init if init != last_section else None))
+                        last_section = init
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                        count += 1
+                        new += 1
+                    logger.debug(
+                        f'{m3u8_url}, reload {time.monotonic()-reload:.3f}s, {new} new segments, last {last_seq}')
+                    if playlist.is_endlist:
+                        break
+                    remain = float('inf') if duration is None else duration - \
+                        (time.monotonic() - start)
+                    if remain <= 0:
+                        break
+                    target = playlist.target_duration or 1
+                    wait = poll if poll is not None else target if new else target / 2
+                    await asyncio.sleep(min(remain, max(0, wait - (time.monotonic() - reload))))
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        if text:
+            async with aiofiles.open(self.m3u8_filename, 'w', encoding='utf-8') as f:
+                await f.write(text)
+        logger.info(f'{m3u8_url}, captured {count} segments to {output}')
+
+    @staticmethod
+    def _read_piece(f: BinaryIO, offset: int, length: Optional[int], chunk_size: int) -> Iterator[bytes]:
+        """
+        Read :param:`length` bytes from :param:`offset` of :param:`f` in chunks, to the end if None.
+        """
+        f.seek(offset)
+        remain = length
+        while remain is None or remain > 0:
+            content = f.read(chunk_size if remain is None else min(chunk_size, remain))
+            if not content:
+                break
+            if remain is not None:
+                remain -= len(content)
+            yield content
+        if remain:
+            raise IOError(f'{f.name} is truncated, {remain} bytes missing')
+
+    def combine_segs(self, output: str, base_url: str = '', chunk_size: int = 1024*1024):
         """
         combine m3u8 segment videos from :param:`segs_folder` to :param:`output`
+
+        AES-128 encrypted segments are decrypted with keys fetched by :meth:`fetch_keys`.
+        Initialization sections of fMP4 segments are written before them, see :func:`init_sections`.
+        Segments are removed after combined, unless any of them is missing.
+        It blocks, so run it in an executor in event loop.
+
+        :param base_url: Base URL to resolve relative key uri.
         """
-        playlist = m3u8.load(self.m3u8_filename)
+        playlist = self._loaded()
+        _, pieces, inits = self._layout(playlist)
+        last: dict[str, int] = {}
+        for index, (fn, *_) in enumerate(pieces):
+            if index in inits:
+                last[inits[index][0]] = index
+            last[fn] = index
+        # check before any segment is removed, so a missing one does not waste the others
+        missing = [fn for fn in last if not os.path.exists(fn)]
+        if missing:
+            raise IOError(
+                f'{self.m3u8_filename}, {len(missing)} segments missing, such as {missing[0]}')
+        sequence = playlist.media_sequence or 0
         with open(output, 'wb') as video:
-            with tqdm(playlist.files) as bar:
-                for seg in bar:
-                    bar.set_description(f"Combining {seg}")
-                    segpath = os.path.join(self.tmp_dir, seg)
+            with tqdm(playlist.segments) as bar:
+                for index, seg in enumerate(bar):
+                    bar.set_description(f"Combining {seg.uri}")
+                    segpath, offset, length = pieces[index]
+                    init = inits.get(index)
+                    if init:
+                        with open(init[0], 'rb') as temp:
+                            for content in self._read_piece(temp, init[1], init[2], chunk_size):
+                                video.write(content)
+                    key = self._key(seg.key)
+                    decryptor = Decryptor(self.keys.cached(urljoin(base_url, key.uri)), segment_iv(
+                        key, sequence + index)) if key else None
                     with open(segpath, 'rb') as temp:
-                        content = temp.read()
-                        video.write(content)
-                    os.remove(segpath)
+                        for content in self._read_piece(temp, offset, length, chunk_size):
+                            video.write(decryptor.update(content)
+                                        if decryptor else content)
+                    if decryptor:
+                        video.write(decryptor.finalize())
+                    for fn in {segpath, init[0] if init else segpath}:
+                        if last[fn] == index:
+                            AsyncHTTP.remove(fn)
+
+    async def iter_segs(self, base_url: str = '', chunk_size: int = 1024*1024) -> AsyncIterator[bytes]:
+        """
+        Read downloaded segments in order as one stream, like :meth:`combine_segs` but without writing it.
+
+        Segments are kept, so that they are not downloaded again if the consumer fails,
+        call :meth:`remove_segs` once it succeeded.
+
+        :param base_url: Base URL to resolve relative key uri.
+        """
+        playlist = await self.load_playlist()
+        downloads, pieces, inits = self._layout(playlist)
+        missing = [fn for _, fn, *_ in downloads if not os.path.exists(fn)]
+        if missing:
+            raise IOError(
+                f'{self.m3u8_filename}, {len(missing)} segments missing, such as {missing[0]}')
+        sequence = playlist.media_sequence or 0
+        for index, seg in enumerate(playlist.segments):
+            segpath, offset, length = pieces[index]
+            init = inits.get(index)
+            if init:
+                async for chunk in read_chunks(init[0], chunk_size, init[1], init[2]):
+                    yield chunk
+            key = self._key(seg.key)
+            decryptor = AsyncDecryptor(self.keys.cached(urljoin(base_url, key.uri)), segment_iv(
+                key, sequence + index), self.executor) if key else None
+            async for chunk in read_chunks(segpath, chunk_size, offset, length):
+                yield await decryptor.update(chunk) if decryptor else chunk
+            if decryptor:
+                yield await decryptor.finalize()
+
+    async def remove_segs(self):
+        """
+        Remove downloaded segments and their sidecars.
+        """
+        downloads, *_ = self._layout(await self.load_playlist())
+        for _, fn, *_ in downloads:
+            AsyncHTTP.remove(fn)
 
     @staticmethod
-    async def download(m3u8_fn: str, base_url: str, output_fn: str, m3u8_url: str = '', tmp_dir: str = 'tmp', headers: dict[str, str] = {}, *args, **kwargs):
+    async def download(m3u8_fn: str, base_url: str, output_fn: str, m3u8_url: str = '', tmp_dir: str = 'tmp', headers: dict[str, str] = {}, *args, stream: bool = False, live: bool = False, duration: Optional[float] = None, muxer: Optional[Muxer] = None, on_downloaded: Optional[Callable[[], Any]] = None, bandwidth: Optional[int] = None, min_free: int = 0, **kwargs):
         """
         download m3u8 file to :param:``output``.
 
@@ -148,17 +959,62 @@ class AioM3U8:
         :output_fn: File path to save video file.
         :param m3u8_url: If not empty, will download it to :param:``m3u8_fn``.
         :tmp_dir: Temperate direcctory to save segments.
+        :param stream: Write segments to :param:`output_fn` in order while downloading, see :meth:`stream_segs`.
+        :param live: Capture a live or event playlist from :param:`m3u8_url` until it ends or :param:`duration`, see :meth:`live_segs`.
+        :param duration: Max seconds to capture if :param:`live`.
+        :param muxer: Output container. The segments are piped to it, except in :param:`stream` or :param:`live` mode,
+            which writes a `.ts` beside :param:`output_fn` first. Defaults to `.ts` passthrough.
+        :param on_downloaded: Invoke when all segments are downloaded, before they are combined or muxed.
+        :param bandwidth: Bits/s of the stream to estimate its size, see :meth:`check_space`. Not checked if :param:`live`.
+        :param min_free: Bytes to keep free on volumes of segments and output. 0 to check only the estimated size.
         :param *args *kwargs: Extra arguments to init :class:`M3U8`.
         """
         AioM3U8.check_dir(tmp_dir)
         md = AioM3U8(m3u8_fn, tmp_dir, headers, *args, **kwargs)
-        if m3u8_url:
-            AioM3U8.check_dir(os.path.dirname(m3u8_fn))
-            await md.download_m3u8(m3u8_url)
-            logger.info(
-                f"successfully download m3u8 file {m3u8_fn} from {m3u8_url}.")
-        await md.download_segs(base_url)
-        md.combine_segs(output_fn)
+        passthrough = muxer is None or type(muxer) is Muxer
+        ts_fn = output_fn if passthrough else os.path.splitext(output_fn)[0] + Muxer.ext
+        try:
+            if live:
+                if not m3u8_url:
+                    raise ValueError('m3u8_url must be set to capture live playlist.')
+                AioM3U8.check_dir(os.path.dirname(m3u8_fn))
+                with md._stage('segments'):
+                    await md.live_segs(m3u8_url, base_url, ts_fn, duration)
+            else:
+                if m3u8_url:
+                    AioM3U8.check_dir(os.path.dirname(m3u8_fn))
+                    with md._stage('playlist'):
+                        await md.download_m3u8(m3u8_url)
+                    logger.info(
+                        f"successfully download m3u8 file {m3u8_fn} from {m3u8_url}.")
+                await md.check_space(output_fn, bandwidth, min_free, stream, not passthrough)
+                if stream:
+                    with md._stage('segments'):
+                        await md.stream_segs(base_url, ts_fn, bandwidth=bandwidth)
+                else:
+                    with md._stage('segments'):
+                        await md.download_segs(base_url)
+                    with md._stage('keys'):
+                        await md.fetch_keys(base_url)
+        finally:
+            await md.close()
+        if on_downloaded:
+            on_downloaded()
+        if live or stream:
+            if not passthrough:
+                with md._stage('mux'):
+                    await muxer.mux(read_chunks(ts_fn), output_fn)  # type: ignore
+                os.remove(ts_fn)
+        elif passthrough:
+            with md._stage('combine'):
+                await async_wrap(md.combine_segs)(output_fn, base_url, executor=md.executor)
+        else:
+            with md._stage('mux'):
+                await muxer.mux(md.iter_segs(base_url), output_fn)  # type: ignore
+            # only after remuxed, a failed remux is retried without downloading again
+            await md.remove_segs()
+        md.manifest.add(os.path.basename(output_fn), os.path.getsize(output_fn))
+        await md.manifest.save()
 
     @staticmethod
     def check_dir(dir: str, create: bool = True, throw: bool = True) -> bool:
@@ -0,0 +1,108 @@
+from typing import AsyncIterable, AsyncIterator, Optional, Union
+
+import aiofiles
+from al_utils.logger import Logger
+
+from m3u8_util.ffmpeg import FFmpegPool
+
+logger = Logger(__file__).logger
+
+
+class Muxer:
+    """
+    Write the ordered MPEG-TS stream of segments to an output container.
+
+    This one is the `.ts` passthrough, which writes the stream as it is.
+    """
+
+    container = 'ts'
+    ext = '.ts'
+    options: tuple[str, ...] = ()
+    """Extra output arguments of ffmpeg to write this container, used in ff mode."""
+
+    async def mux(self, chunks: AsyncIterable[bytes], output: str) -> str:
+        """
+        Write :param:`chunks` to :param:`output`.
+
+        :param chunks: MPEG-TS stream in order.
+        :return: :param:`output`
+        """
+        async with aiofiles.open(output, 'wb') as f:
+            async for chunk in chunks:
+                await f.write(chunk)
+        return output
+
+
+class FFmpegMuxer(Muxer):
+    """
+    Remux the MPEG-TS stream piped to ffmpeg with stream copy, without re-encoding.
+    """
+
+    container = ''
+    ext = ''
+    options = ('-map', '0:v?', '-map', '0:a?')
+
+    def __init__(self, pool: Optional[FFmpegPool] = None) -> None:
+        """
+        :param pool: Bounds count of ffmpeg processes. Defaults to the one shared in the running loop.
+        """
+        self.pool = pool
+
+    async def mux(self, chunks: AsyncIterable[bytes], output: str) -> str:
+        pool = self.pool or FFmpegPool.default()
+        code, errors = await pool.run('-f', 'mpegts', '-i', 'pipe:0', '-c', 'copy', *self.options, '-y', output, stdin=chunks)
+        if code != 0:
+            raise IOError(f'Remux {output} to {self.container} failed, {code}, {errors}')
+        logger.info(f'remuxed {output}')
+        return output
+
+
+class MP4Muxer(FFmpegMuxer):
+    """
+    MP4 with the index at the front, so that it can be played while loading.
+    """
+
+    container = 'mp4'
+    ext = '.mp4'
+    options = (*FFmpegMuxer.options, '-movflags', '+faststart')
+
+
+async def read_chunks(file_name: str, chunk_size: int = 1024*1024, offset: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Read :param:`file_name` chunk by chunk.
+
+    :param offset: Position to start reading.
+    :param length: Bytes to read. None to read to the end.
+    """
+    async with aiofiles.open(file_name, 'rb') as f:
+        if offset:
+            await f.seek(offset)
+        remain = length
+        while remain is None or remain > 0:
+            chunk = await f.read(chunk_size if remain is None else min(chunk_size, remain))
+            if not chunk:
+                break
+            if remain is not None:
+                remain -= len(chunk)
+            yield chunk
+        if remain:
+            raise IOError(f'{file_name} is truncated, {remain} bytes missing')
+
+
+MUXERS: dict[str, type[Muxer]] = {'ts': Muxer, 'mp4': MP4Muxer}
+
+
+def get_muxer(container: Union[str, Muxer], pool: Optional[FFmpegPool] = None) -> Muxer:
+    """
+    Get muxer of :param:`container`.
+
+    :param container: Name in :data:`MUXERS` or a :class:`Muxer`.
+    :param pool: Process pool of ffmpeg muxers.
+    """
+    if isinstance(container, Muxer):
+        return container
+    if container not in MUXERS:
+        raise ValueError(
+            f'container must be one of {list(MUXERS)}, but got {container}')
+    cls = MUXERS[container]
+    return cls(pool) if issubclass(cls, FFmpegMuxer) else cls()
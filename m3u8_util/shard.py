@@ -0,0 +1,374 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from al_utils.logger import Logger
+
+from download.asynchttp import AsyncHTTP
+from download.metrics import Metrics
+from download.ratelimit import RateLimiter
+from download.resume import Resume
+from download.util import human_size
+from m3u8_util.batch import BatchDownloader, JobRunner
+
+logger = Logger(__file__).logger
+
+POLL = 1.0
+"""Max seconds to block on a queue, so that exited processes are noticed."""
+
+
+def _share(limiter: RateLimiter, limits: RateLimiter, share: float):
+    """
+    Set rates of :param:`limiter` to :param:`share` of global :param:`limits`.
+    """
+    def part(rate: Optional[float]) -> Optional[float]:
+        return rate * share if rate else None
+    # changing a rate clears its bucket, so only set changed ones
+    if limiter.bandwidth != part(limits.bandwidth):
+        limiter.bandwidth = part(limits.bandwidth)
+    if limiter.requests != part(limits.requests):
+        limiter.requests = part(limits.requests)
+    if limiter.host_bandwidth != part(limits.host_bandwidth):
+        limiter.host_bandwidth = part(limits.host_bandwidth)
+    hosts = limiter.hosts
+    for host, rate in limits.hosts.items():
+        if hosts.get(host) != part(rate):
+            limiter.set_host(host, part(rate))
+
+
+class _Progress(Resume):
+    """
+    Forward downloaded segments of a worker to the coordinator, which records them in its own :class:`Resume`.
+    """
+
+    def __init__(self, events: Any) -> None:
+        super().__init__('', '', '')
+        self.events = events
+
+    async def segment(self, key: str, index: int, nbytes: int):
+        self.events.put(('segment', key, index, nbytes))
+
+
+def _work(worker: int, commands: Any, events: Any, logs: Any, options: dict[str, Any]):
+    """
+    Entry of a worker process. Its logs are sent to the coordinator instead of written to the shared log files.
+    """
+    logging.getLogger().handlers = [QueueHandler(logs)]
+    try:
+        asyncio.run(_serve(worker, commands, events, **options))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve(worker: int, commands: Any, events: Any, videos: int, concurrency: int, limits: Optional[RateLimiter], metrics: bool, resolve: Optional[Callable[..., Awaitable[Optional[str]]]], http: dict[str, Any], kwargs: dict[str, Any]):
+    """
+    Run jobs sent by the coordinator in one event loop until it is stopped.
+    """
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    limiter = RateLimiter(burst=limits.burst) if limits else None
+    m = Metrics() if metrics else None
+    tasks: set[asyncio.Future] = set()
+
+    def receive():
+        while True:
+            try:
+                return commands.get(timeout=POLL)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    return ('stop',)
+    async with AsyncHTTP(limit=concurrency * videos, limit_per_host=concurrency * videos, limiter=limiter, metrics=m, **http) as asynchttp:
+        batch = BatchDownloader(videos, concurrency=concurrency, asynchttp=asynchttp, **kwargs)
+        if resolve:
+            batch.resolve = lambda url: resolve(url, asynchttp=asynchttp)  # type: ignore
+
+        async def job(seq: int, name: str, url: str):
+            try:
+                result = await batch.download(name, url, _Progress(events), lambda: events.put(('released', worker, seq)))
+            except Exception as ex:
+                logger.error(f'worker {worker}, download failed of {name} from {url}', exc_info=True)
+                events.put(('done', worker, seq, None, f'{type(ex).__name__}: {ex}'))
+                return
+            events.put(('done', worker, seq, result, None))
+        while True:
+            command = await loop.run_in_executor(None, receive)
+            if command[0] == 'stop':
+                break
+            if command[0] == 'limits':
+                if limiter and limits:
+                    _share(limiter, limits, command[1])
+                continue
+            task = asyncio.ensure_future(job(*command[1:]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if kwargs.get('cache'):
+        kwargs['cache'].close()
+    if m:
+        events.put(('metrics', worker, m))
+
+
+class ShardedDownloader(JobRunner):
+    """
+    Download multiple videos across worker processes, each with its own event loop and :class:`AsyncHTTP` pool,
+    so that TLS, parsing, hashing and logging are not bound to one CPU.
+
+    This process is the coordinator. It takes jobs in order and hands each to the least loaded worker,
+    holding at most :param:`videos` of them at the same time as :class:`BatchDownloader` does. Bandwidth and request rate
+    limits are split among workers by their share of running videos, and updated when it changes.
+    Only the coordinator records jobs in :class:`Resume`, workers send their downloaded segments to it,
+    so resume semantics are the same as a single process and log files are written by one process.
+    Logs of workers are forwarded to the handlers of this process as well.
+    """
+
+    def __init__(self, workers: int = 2, videos: int = 4, connections: int = 32, concurrency: Optional[int] = None, resolve: Optional[Callable[..., Awaitable[Optional[str]]]] = None, limiter: Optional[RateLimiter] = None, metrics: Optional[Metrics] = None, http: Optional[dict[str, Any]] = None, interval: float = 5.0, on_progress: Optional[Callable[[dict[str, Any]], Any]] = None, **kwargs) -> None:
+        """
+        :param workers: Count of worker processes.
+        :param videos: Max count of videos downloading at the same time of all workers.
+        :param connections: Max connections of all workers.
+        :param concurrency: Segment concurrency of each video. Defaults to `connections // videos`.
+        :param resolve: Get m3u8 url from url of a job in workers, called as `resolve(url, asynchttp=...)` with the
+            client of the worker, such as :func:`example.get_m3u8_url`. It must be a module level function.
+        :param limiter: Global bandwidth and request rate limits, split among workers.
+        :param metrics: Merge metrics of workers into it when closed. None to disable metrics in workers.
+        :param http: Extra arguments of :class:`AsyncHTTP` of each worker, such as `write_buffer`, `headers`.
+        :param interval: Seconds between progress reports.
+        :param on_progress: Invoke with merged progress every :param:`interval` seconds, see :attr:`progress`.
+        :param kwargs: Extra arguments of :func:`m3u8_util.m3u8.download`, which are pickled to workers.
+            A :class:`SegmentCache` must not be opened in this process, each worker opens its own connection.
+        """
+        if workers < 1:
+            raise ValueError(f'workers must be positive, but got {workers}')
+        super().__init__(videos)
+        self.workers = workers
+        self.concurrency = concurrency or max(1, connections // videos)
+        self.limiter = limiter
+        self.metrics = metrics
+        self.interval = interval
+        self.on_progress = on_progress
+        self._options = dict(videos=math.ceil(videos / workers), concurrency=self.concurrency, limits=limiter,
+                             metrics=metrics is not None, resolve=resolve, http=http or {}, kwargs=kwargs)
+        self.progress: dict[str, Any] = {'done': 0, 'failed': 0, 'skipped': 0, 'running': 0, 'segments': 0, 'bytes': 0}
+        """Merged progress of all workers: count of done, failed, skipped and running jobs, downloaded segments and bytes."""
+        self._ctx = multiprocessing.get_context('spawn')
+        self._procs: list[Any] = []
+        self._commands: list[Any] = []
+        self._events: Any = None
+        self._listener: Optional[QueueListener] = None
+        self._reader: Optional[asyncio.Future] = None
+        self._closing = False
+        self._seq = 0
+        self._futures: dict[int, asyncio.Future] = {}
+        self._releases: dict[int, Callable[[], Any]] = {}
+        self._pending: list[set[int]] = []
+        self._active: list[int] = []
+        self._shares: list[Optional[float]] = []
+        self._resume: Optional[Resume] = None
+        self._reported = (time.monotonic(), 0)
+
+    def start(self):
+        """
+        Start worker processes. It is called by :meth:`run` if not started.
+        """
+        if self._procs:
+            return
+        self._events = self._ctx.Queue()
+        logs = self._ctx.Queue()
+        self._listener = QueueListener(logs, *logging.getLogger().handlers, respect_handler_level=True)
+        self._listener.start()
+        for worker in range(self.workers):
+            commands = self._ctx.Queue()
+            proc = self._ctx.Process(target=_work, args=(worker, commands, self._events, logs, self._options),
+                                     name=f'm3u8-worker-{worker}', daemon=True)
+            proc.start()
+            self._procs.append(proc)
+            self._commands.append(commands)
+            self._pending.append(set())
+            self._active.append(0)
+            self._shares.append(None)
+        self._reader = asyncio.ensure_future(self._read())
+        logger.info(f'started {self.workers} workers, {self._options["videos"]} videos of each')
+
+    def _receive(self) -> Optional[tuple]:
+        try:
+            return self._events.get(timeout=min(POLL, self.interval))
+        except queue.Empty:
+            return None
+
+    async def _read(self):
+        """
+        Handle events of workers until all of them exited after closed.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await loop.run_in_executor(None, self._receive)
+            if event is not None:
+                await self._handle(*event)
+                continue
+            self._check_workers()
+            self._report()
+            if self._closing and not any(p.is_alive() for p in self._procs):
+                # events sent right before workers exited
+                while not self._events.empty():
+                    await self._handle(*self._events.get())
+                return
+
+    async def _handle(self, kind: str, *args):
+        if kind == 'segment':
+            key, index, nbytes = args
+            self.progress['segments'] += 1
+            self.progress['bytes'] += nbytes
+            if self._resume is not None:
+                await self._resume.segment(key, index, nbytes)
+        elif kind == 'released':
+            self._release(args[1])
+        elif kind == 'done':
+            worker, seq, result, error = args
+            self._pending[worker].discard(seq)
+            self._release(seq)
+            future = self._futures.pop(seq, None)
+            if future is None or future.done():
+                return
+            if error is None:
+                future.set_result(tuple(result))
+            else:
+                future.set_exception(RuntimeError(f'worker {worker}, {error}'))
+        elif kind == 'metrics':
+            if self.metrics is not None:
+                self.metrics.merge(args[1])
+        if time.monotonic() - self._reported[0] >= self.interval:
+            self._report()
+
+    def _check_workers(self):
+        """
+        Fail jobs of workers which exited unexpectedly.
+        """
+        for worker, proc in enumerate(self._procs):
+            if proc.is_alive() or not self._pending[worker]:
+                continue
+            logger.error(f'worker {worker} exited with {proc.exitcode}, fail its {len(self._pending[worker])} jobs')
+            for seq in self._pending[worker]:
+                self._release(seq)
+                future = self._futures.pop(seq, None)
+                if future and not future.done():
+                    future.set_exception(RuntimeError(f'worker {worker} exited with {proc.exitcode}'))
+            self._pending[worker].clear()
+
+    def _report(self):
+        start, last = self._reported
+        now = time.monotonic()
+        if now - start < self.interval:
+            return
+        p = self.progress
+        self._reported = (now, p['bytes'])
+        if p['bytes'] == last and not p['running']:
+            return
+        logger.info(f"{p['done']} done, {p['failed']} failed, {p['skipped']} skipped, {p['running']} running, "
+                    f"{p['segments']} segments, {human_size(p['bytes'])} ({human_size((p['bytes'] - last) / (now - start))}/s)")
+        if self.on_progress:
+            self.on_progress(dict(p))
+
+    def _rebalance(self):
+        """
+        Send each busy worker its share of global limits, by its share of running videos.
+        """
+        total = sum(self._active)
+        if not self.limiter or not total:
+            return
+        for worker, active in enumerate(self._active):
+            share = active / total
+            if active and share != self._shares[worker]:
+                self._shares[worker] = share
+                self._commands[worker].put(('limits', share))
+
+    def _release(self, seq: int):
+        release = self._releases.pop(seq, None)
+        if release:
+            release()
+
+    async def download(self, name: str, url: str, on_downloaded: Optional[Callable[[], Any]] = None) -> tuple[str, bool]:
+        """
+        Download one job in the least loaded worker.
+
+        :param name: Video name.
+        :param url: Page url if `resolve` is set, otherwise m3u8 url.
+        :param on_downloaded: Invoke when segments are downloaded, before muxing.
+        """
+        alive = [w for w, p in enumerate(self._procs) if p.is_alive()]
+        if not alive:
+            raise RuntimeError('no worker is running')
+        worker = min(alive, key=lambda w: self._active[w])
+        seq = self._seq
+        self._seq += 1
+        self._active[worker] += 1
+        self.progress['running'] += 1
+
+        def release():
+            self._active[worker] -= 1
+            self.progress['running'] -= 1
+            self._rebalance()
+            if on_downloaded:
+                on_downloaded()
+        future = asyncio.get_running_loop().create_future()
+        self._futures[seq] = future
+        self._releases[seq] = release
+        self._pending[worker].add(seq)
+        self._rebalance()
+        self._commands[worker].put(('job', seq, name, url))
+        try:
+            return await future
+        finally:
+            self._futures.pop(seq, None)
+            self._release(seq)
+
+    async def _download(self, name: str, url: str, resume: Optional[Resume], release: Callable[[], Any]) -> tuple[str, bool]:
+        # segments are recorded in resume of this process by events of workers
+        return await self.download(name, url, release)
+
+    def _finished(self, name: str, status: str):
+        self.progress[status] += 1
+
+    async def run(self, jobs: Iterable[tuple[str, str]], resume: Optional[Resume] = None, on_done: Optional[Callable[[str, str, Any], Any]] = None):
+        """
+        Run all :param:`jobs` in workers, see :meth:`JobRunner.run`.
+
+        :param resume: Track success, failure and current of jobs by url in this process.
+        """
+        self.start()
+        self._resume = resume
+        try:
+            await super().run(jobs, resume, on_done)
+        finally:
+            self._resume = None
+        logger.info(
+            f'sharded batch finished, {len(self.results)} succeeded, {len(self.errors)} failed')
+        if self.on_progress:
+            self.on_progress(dict(self.progress))
+
+    async def close(self):
+        """
+        Stop workers after their running jobs, and merge their metrics.
+        """
+        if not self._procs or self._closing:
+            return
+        self._closing = True
+        for commands in self._commands:
+            commands.put(('stop',))
+        loop = asyncio.get_running_loop()
+        for proc in self._procs:
+            await loop.run_in_executor(None, proc.join)
+        if self._reader:
+            await self._reader
+        if self._listener:
+            self._listener.stop()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
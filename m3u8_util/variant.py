@@ -0,0 +1,94 @@
+import os
+from typing import Iterable, Literal, Optional
+from urllib.parse import urlsplit
+
+import m3u8
+
+VariantPolicy = Literal['max_bandwidth', 'max_resolution', 'bandwidth']
+
+
+def _bandwidth(variant: m3u8.Playlist) -> int:
+    info = variant.stream_info
+    return info.bandwidth or info.average_bandwidth or 0
+
+
+def _height(variant: m3u8.Playlist) -> int:
+    resolution = variant.stream_info.resolution
+    return resolution[1] if resolution else 0
+
+
+def select_variant(playlist: m3u8.M3U8, policy: VariantPolicy = 'max_bandwidth', max_height: Optional[int] = None, max_bandwidth: Optional[int] = None) -> m3u8.Playlist:
+    """
+    Select a variant stream of master :param:`playlist`.
+
+    :param policy: `max_bandwidth`: the highest bandwidth.
+        `max_resolution`: the highest resolution not above :param:`max_height`, the lowest bandwidth of them.
+        `bandwidth`: the highest bandwidth not above :param:`max_bandwidth`.
+        The lowest one is selected if none matches.
+    :param max_height: Max height of resolution, such as `720`, for `max_resolution`. None for no limit.
+    :param max_bandwidth: Bandwidth budget in bits/s for `bandwidth`.
+    """
+    variants = list(playlist.playlists)
+    if not variants:
+        raise ValueError('no variant stream in master playlist.')
+    lowest = min(variants, key=lambda v: (_bandwidth(v), _height(v)))
+    if policy == 'max_bandwidth':
+        return max(variants, key=lambda v: (_bandwidth(v), _height(v)))
+    if policy == 'max_resolution':
+        matched = [v for v in variants if max_height is None or _height(v) <= max_height]
+        if not matched:
+            return lowest
+        height = max(_height(v) for v in matched)
+        return min([v for v in matched if _height(v) == height], key=_bandwidth)
+    if policy == 'bandwidth':
+        if max_bandwidth is None:
+            raise ValueError('max_bandwidth must be set for bandwidth policy.')
+        matched = [v for v in variants if _bandwidth(v) <= max_bandwidth]
+        return max(matched, key=lambda v: (_bandwidth(v), _height(v))) if matched else lowest
+    raise ValueError(f'unknown variant policy {policy}')
+
+
+def select_renditions(variant: m3u8.Playlist, types: Iterable[str] = ('AUDIO', 'SUBTITLES'), languages: Optional[Iterable[str]] = None) -> list[m3u8.Media]:
+    """
+    Select `EXT-X-MEDIA` renditions with separate playlists of :param:`variant`.
+
+    :param types: Rendition types, such as `AUDIO`, `SUBTITLES`.
+    :param languages: Select renditions of these languages. None to select the default (or the first) one of each type.
+    """
+    langs = set(languages) if languages is not None else None
+    selected: list[m3u8.Media] = []
+    for t in types:
+        media = [m for m in variant.media if m.type == t and m.uri]
+        if not media:
+            continue
+        if langs is not None:
+            selected += [m for m in media if m.language in langs]
+        else:
+            selected.append(next((m for m in media if m.default == 'YES'), media[0]))
+    return selected
+
+
+RAW_AUDIO = ('.aac', '.ac3', '.ec3', '.mp3')
+"""Extensions of elementary audio streams, which are saved as is."""
+FMP4 = ('.m4s', '.m4a', '.m4v', '.mp4', '.cmfa', '.cmfv')
+"""Extensions of fragmented MP4 segments."""
+
+
+def rendition_ext(media_type: str, playlist: m3u8.M3U8) -> str:
+    """
+    Extension of output of a rendition, by the container of segments in its media :param:`playlist`,
+    because renditions are not remuxed. Defaults to `.ts`.
+
+    :param media_type: Rendition type, such as `AUDIO`, `SUBTITLES`.
+    """
+    if media_type == 'SUBTITLES':
+        return '.vtt'
+    seg = playlist.segments[0] if playlist.segments else None
+    if seg is None:
+        return '.ts'
+    ext = os.path.splitext(urlsplit(seg.uri).path)[1].lower()
+    if ext in RAW_AUDIO:
+        return ext
+    if ext in FMP4 or seg.init_section is not None:
+        return '.m4a' if media_type == 'AUDIO' else '.mp4'
+    return '.ts'
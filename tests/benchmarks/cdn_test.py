@@ -0,0 +1,56 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from benchmarks.cdn import CDNProcess, FakeCDN
+from download.asynchttp import AsyncHTTP
+from download.retry import RetryPolicy
+from m3u8_util.m3u8 import download
+
+
+class FakeCDNTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dirs = [os.path.join(self.tmp.name, d) for d in ('m3u8', 'tmp', 'videos')]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_master(self):
+        async with FakeCDN(5, 1000, variants=(100, 200)) as cdn:
+            fn, _ = await download(cdn.url('master.m3u8'), 'v', *self.dirs)
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), cdn.video)
+        self.assertEqual(cdn.requests, 5)
+        self.assertNotEqual(cdn.content(0), cdn.content(1))
+
+    async def test_range(self):
+        async with FakeCDN(1, 1000) as cdn, AsyncHTTP() as client:
+            data = await client.async_read(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), {'Range': 'bytes=600-'})
+        self.assertEqual(data, cdn.content(0)[600:])
+
+    async def test_errors(self):
+        async with FakeCDN(1, 1000, error_rate=1) as cdn, AsyncHTTP(policy=RetryPolicy(base=0, breaker=False)) as client:
+            with self.assertRaises(IOError):
+                await client.async_read(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), retry=2)
+        self.assertEqual(cdn.errors, 2)
+
+    async def test_drop_resumed(self):
+        fn = os.path.join(self.tmp.name, '0.ts')
+        async with FakeCDN(1, 256*1024, drop_rate=0.5, seed=1) as cdn, AsyncHTTP(policy=RetryPolicy(base=0, breaker=False)) as client:
+            await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), fn, retry=10, chunk_size=1024)
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), cdn.content(0))
+
+    async def test_bandwidth(self):
+        async with FakeCDN(1, 128*1024, bandwidth=1024*1024, latency=0.05) as cdn, AsyncHTTP() as client:
+            start = asyncio.get_running_loop().time()
+            await client.async_read(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'))
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - start, 0.15)
+
+    async def test_process(self):
+        with CDNProcess(segments=2, size=100) as cdn:
+            async with AsyncHTTP() as client:
+                data = await client.async_read(0, asyncio.Semaphore(1), cdn.url('v0/1.ts'))
+        self.assertEqual(len(data), 100)
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from benchmarks.cdn import FakeCDN
+from benchmarks.session_bench import CountingServer
+from download.asynchttp import AdaptiveSemaphore, AsyncHTTP
+
+
+class FlakyServer:
+    """
+    Server of one resource which drops the connection after :param:`drop` bytes on first request.
+    """
+
+    def __init__(self, size: int, drop: int, ranges: bool = True) -> None:
+        self.body = os.urandom(size)
+        self.drop = drop
+        self.ranges = ranges
+        self.requests: list[str] = []
+        app = web.Application()
+        app.router.add_get('/seg.ts', self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        rng = request.headers.get('Range', '')
+        self.requests.append(rng)
+        start = int(rng[6:-1]) if rng and self.ranges else 0
+        response = web.StreamResponse(status=206 if start else 200, headers={'ETag': '"v1"'})
+        response.content_length = len(self.body) - start
+        if start:
+            response.headers['Content-Range'] = f'bytes {start}-{len(self.body)-1}/{len(self.body)}'
+        await response.prepare(request)
+        if len(self.requests) == 1:
+            await response.write(self.body[:self.drop])
+            await asyncio.sleep(0.1)
+            request.transport.close()
+            return response
+        await response.write(self.body[start:])
+        await response.write_eof()
+        return response
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.server.close()
+
+
+class AsyncHTTPTests(IsolatedAsyncioTestCase):
+    async def test_session_reused(self):
+        async with CountingServer(1024) as server, AsyncHTTP() as client:
+            with tempfile.TemporaryDirectory() as tmp:
+                urls = [server.url(f'{i}.ts') for i in range(20)]
+                fns = [os.path.join(tmp, f'{i}.ts') for i in range(20)]
+                await client.async_downloads(2, urls, fns)
+                session = client.session
+                await client.async_downloads(2, urls, fns)
+                self.assertIs(session, client.session)
+                self.assertLessEqual(server.connections, 2)
+                self.assertTrue(all(os.path.getsize(fn) == 1024 for fn in fns))
+
+    async def test_close(self):
+        client = AsyncHTTP()
+        session = client.session
+        await client.close()
+        self.assertTrue(session.closed)
+        self.assertIsNot(session, client.session)
+        await client.close()
+
+    async def test_download_resume(self):
+        for ranges in [True, False]:
+            async with FlakyServer(4096, 1000, ranges) as server, AsyncHTTP() as client:
+                with tempfile.TemporaryDirectory() as tmp:
+                    fn = os.path.join(tmp, 'seg.ts')
+                    url = str(server.server.make_url('/seg.ts'))
+                    await client.async_download(0, asyncio.Semaphore(1), url, fn, chunk_size=100)
+                    with open(fn, 'rb') as f:
+                        self.assertEqual(f.read(), server.body)
+                    self.assertEqual(server.requests, ['', 'bytes=1000-'])
+                    self.assertTrue(await AsyncHTTP.is_complete(fn, url))
+                    await client.async_download(0, asyncio.Semaphore(1), url, fn, chunk_size=100)
+                    self.assertEqual(len(server.requests), 2)
+
+    async def test_resume_restart(self):
+        async with FlakyServer(4096, 1000) as server, AsyncHTTP(write_buffer=512) as client:
+            with tempfile.TemporaryDirectory() as tmp:
+                fn = os.path.join(tmp, 'seg.ts')
+                url = str(server.server.make_url('/seg.ts'))
+                with self.assertRaises(IOError):
+                    await client.async_download(0, asyncio.Semaphore(1), url, fn, chunk_size=100, retry=1)
+                # more than the write buffer is on disk, so it is recorded to be resumed
+                self.assertEqual((await AsyncHTTP.read_meta(fn))['length'], 4096)
+                await client.async_download(0, asyncio.Semaphore(1), url, fn, chunk_size=100)
+                with open(fn, 'rb') as f:
+                    self.assertEqual(f.read(), server.body)
+                self.assertEqual(server.requests, ['', 'bytes=1000-'])
+
+    async def test_sidecar_io(self):
+        async with CountingServer(1024) as server, AsyncHTTP() as client:
+            with tempfile.TemporaryDirectory() as tmp, \
+                    mock.patch.object(AsyncHTTP, '_load_meta', wraps=AsyncHTTP._load_meta) as load, \
+                    mock.patch.object(AsyncHTTP, '_dump_meta', wraps=AsyncHTTP._dump_meta) as dump:
+                fn = os.path.join(tmp, '0.ts')
+                await client.async_download(0, asyncio.Semaphore(1), server.url('0.ts'), fn)
+                # a new small download only records its completion
+                self.assertEqual((load.call_count, dump.call_count), (0, 1))
+                await client.async_download(0, asyncio.Semaphore(1), server.url('0.ts'), fn)
+                self.assertEqual((load.call_count, dump.call_count), (1, 1))
+
+    async def test_not_retryable(self):
+        count = 0
+
+        async def handle(_: web.Request) -> web.Response:
+            nonlocal count
+            count += 1
+            raise web.HTTPNotFound()
+        app = web.Application()
+        app.router.add_get('/{name}', handle)
+        async with TestServer(app) as server, AsyncHTTP() as client:
+            with self.assertRaises(IOError):
+                await client.async_read(0, asyncio.Semaphore(1), str(server.make_url('/0.ts')), retry=3)
+            self.assertEqual(count, 1)
+
+
+class PartsTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, '0.ts')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_parts(self):
+        async with FakeCDN(1, 64*1024, bandwidth=1024*1024) as cdn, AsyncHTTP() as client:
+            await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), self.fn, parts=4, part_size=8*1024)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), cdn.content(0))
+        # the first response is the first part, 3 other parts on their own connections
+        self.assertEqual(cdn.requests, 4)
+        self.assertGreaterEqual(len(cdn.peers), 4)
+        meta = await AsyncHTTP.read_meta(self.fn)
+        self.assertTrue(meta['complete'])
+        self.assertEqual(len(meta['parts']), 4)
+
+    async def test_parts_resume(self):
+        async with FakeCDN(1, 64*1024) as cdn, AsyncHTTP() as client:
+            url = cdn.url('v0/0.ts')
+            with open(self.fn, 'wb') as f:
+                f.write(cdn.content(0)[:32*1024] + b'\0' * 32*1024)
+            await AsyncHTTP.write_meta(self.fn, {'url': url, 'length': 64*1024, 'etag': '"0"', 'complete': False,
+                                                 'parts': [[0, 16*1024-1], [16*1024, 32*1024-1]]})
+            await client.async_download(0, asyncio.Semaphore(1), url, self.fn, parts=4, part_size=8*1024)
+            # the length is in the sidecar, only the rest of parts is requested
+            self.assertEqual(cdn.requests, 2)
+            self.assertEqual(cdn.bytes_sent, 32*1024)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), cdn.content(0))
+
+    async def test_parts_unsupported(self):
+        async with FakeCDN(1, 64*1024, ranges=False) as cdn, AsyncHTTP() as client:
+            await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), self.fn, parts=4, part_size=8*1024)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), cdn.content(0))
+        self.assertEqual(cdn.requests, 1)
+
+    async def test_small(self):
+        async with FakeCDN(1, 10*1024) as cdn, AsyncHTTP() as client:
+            await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), self.fn, parts=4, part_size=8*1024)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), cdn.content(0))
+        self.assertEqual(cdn.requests, 1)
+        self.assertFalse('parts' in await AsyncHTTP.read_meta(self.fn))
+
+    async def test_byte_range(self):
+        async with FakeCDN(1, 1000) as cdn, AsyncHTTP() as client:
+            await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), self.fn, byte_range=(100, 399))
+            with open(self.fn, 'rb') as f:
+                self.assertEqual(f.read(), cdn.content(0)[100:400])
+            await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), self.fn, byte_range=(100, 399))
+            self.assertEqual(cdn.requests, 1)
+            # another range of the same url is not treated as completed
+            await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/0.ts'), self.fn, byte_range=(400, 499))
+            with open(self.fn, 'rb') as f:
+                self.assertEqual(f.read(), cdn.content(0)[400:500])
+
+
+class AdaptiveSemaphoreTests(IsolatedAsyncioTestCase):
+    async def test_increase(self):
+        sem = AdaptiveSemaphore(2, 1, 4)
+        for _ in range(10):
+            async with sem:
+                async with sem:
+                    sem.success(1024, 0.01)
+                    sem.success(1024, 0.01)
+        self.assertEqual(sem.limit, 4)
+
+    async def test_decrease(self):
+        sem = AdaptiveSemaphore(8, 2, 16)
+        sem.failure(503)
+        self.assertEqual(sem.limit, 4)
+        sem.failure(503)
+        self.assertEqual(sem.limit, 4)
+        for _ in range(4):
+            sem.success(1024, 0.01)
+        sem.failure()
+        self.assertEqual(sem.limit, 2)
+
+    async def test_limit(self):
+        sem = AdaptiveSemaphore(1)
+        await sem.acquire()
+        waiter = asyncio.ensure_future(sem.acquire())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        sem.release()
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(sem.in_flight, 1)
+
+    async def test_retry_after(self):
+        sem = AdaptiveSemaphore(4)
+        sem.failure(429, 0.2)
+        start = asyncio.get_running_loop().time()
+        async with sem:
+            self.assertGreaterEqual(
+                asyncio.get_running_loop().time() - start, 0.15)
+
+    async def test_downloads_throttled(self):
+        count = 0
+
+        async def handle(_: web.Request) -> web.Response:
+            nonlocal count
+            count += 1
+            if count % 5 == 0:
+                return web.Response(status=503, headers={'Retry-After': '0'})
+            return web.Response(body=b'0'*1024)
+        app = web.Application()
+        app.router.add_get('/{name}', handle)
+        async with TestServer(app) as server, AsyncHTTP() as client:
+            with tempfile.TemporaryDirectory() as tmp:
+                urls = [str(server.make_url(f'/{i}.ts')) for i in range(40)]
+                fns = [os.path.join(tmp, f'{i}.ts') for i in range(40)]
+                await client.async_downloads(4, urls, fns, adaptive=True, max_sem=8)
+                self.assertTrue(all(os.path.getsize(fn) == 1024 for fn in fns))
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from benchmarks.cdn import FakeCDN
+from download.asynchttp import AsyncHTTP
+from download.cache import SegmentCache
+from m3u8_util.m3u8 import download
+
+
+class SegmentCacheTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, data: bytes) -> str:
+        fn = os.path.join(self.tmp.name, name)
+        with open(fn, 'wb') as f:
+            f.write(data)
+        return fn
+
+    async def test_materialize(self):
+        with SegmentCache(self.cache_dir) as cache:
+            self.assertFalse(await cache.materialize('http://a/0.ts', os.path.join(self.tmp.name, 'x.ts')))
+            await cache.store('http://a/0.ts', self.write('0.ts', b'abc'))
+            fn = os.path.join(self.tmp.name, 'y.ts')
+            self.assertTrue(await cache.materialize('http://a/0.ts', fn))
+            self.assertTrue(await AsyncHTTP.is_complete(fn, 'http://a/0.ts'))
+            self.assertEqual(os.stat(fn).st_ino, os.stat(cache.lookup('http://a/0.ts')).st_ino)
+            self.assertEqual((cache.hits, cache.misses, cache.stored), (1, 1, 1))
+        with SegmentCache(self.cache_dir) as cache:
+            self.assertEqual(cache.size, 3)
+            self.assertIsNotNone(cache.lookup('http://a/0.ts'))
+
+    async def test_dedup(self):
+        with SegmentCache(self.cache_dir) as cache:
+            await cache.store('http://a/0.ts', self.write('0.ts', b'abc'))
+            await cache.store('http://b/intro.ts', self.write('1.ts', b'abc'))
+            self.assertEqual((cache.stored, cache.deduped, cache.size), (1, 1, 3))
+            self.assertEqual(cache.lookup('http://a/0.ts'), cache.lookup('http://b/intro.ts'))
+
+    async def test_evict_lru(self):
+        with SegmentCache(self.cache_dir, max_size=250) as cache:
+            await cache.store('a', self.write('a', b'a' * 100))
+            await asyncio.sleep(0.01)
+            await cache.store('b', self.write('b', b'b' * 100))
+            await asyncio.sleep(0.01)
+            cache.lookup('a')
+            await cache.store('c', self.write('c', b'c' * 100))
+            self.assertIsNone(cache.lookup('b'))
+            self.assertIsNotNone(cache.lookup('a'))
+            self.assertIsNotNone(cache.lookup('c'))
+            self.assertEqual((cache.evicted, cache.size), (1, 200))
+
+    async def test_download_shared(self):
+        dirs = [os.path.join(self.tmp.name, d) for d in ('m3u8', 'tmp', 'videos')]
+        async with FakeCDN(5, 1000) as cdn:
+            with SegmentCache(self.cache_dir) as cache:
+                for name in ['a', 'b']:
+                    fn, _ = await download(cdn.url(), name, *dirs, cache=cache)
+                    with open(fn, 'rb') as f:
+                        self.assertEqual(f.read(), cdn.video)
+                self.assertEqual(cdn.requests, 5)
+                self.assertEqual((cache.hits, cache.misses, cache.stored), (5, 5, 5))
+                # overwriting a materialized segment must not change the cached content
+                fn = os.path.join(self.tmp.name, '0.ts')
+                await cache.materialize(cdn.url('v0/0.ts'), fn)
+                async with AsyncHTTP() as client:
+                    await client.async_download(0, asyncio.Semaphore(1), cdn.url('v0/1.ts'), fn)
+                with open(cache.lookup(cdn.url('v0/0.ts')), 'rb') as f:
+                    self.assertEqual(f.read(), cdn.content(0))
+
+    async def test_shared(self):
+        with SegmentCache(self.cache_dir, max_size=250) as a, SegmentCache(self.cache_dir, max_size=250) as b:
+            await a.store('a', self.write('a', b'a' * 100))
+            self.assertIsNotNone(a.lookup('a'))
+            # a hit does not hold the write lock
+            self.assertFalse(a.conn.in_transaction)
+            await b.store('b', self.write('b', b'b' * 100))
+            # size stored by the other is counted
+            await a.store('c', self.write('c', b'c' * 100))
+            self.assertEqual((a.evicted, a.size), (1, 200))
+            self.assertIsNone(b.lookup('a'))
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from download.jobstore import DONE, FAILED, JobStore
+
+
+class JobStoreTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmp.name, 'jobs.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_run(self):
+        calls = []
+
+        async def callback(key: str) -> bool:
+            calls.append(key)
+            await asyncio.sleep(0.01 if key == 'a' else 0)
+            return key != 'b'
+
+        async with JobStore(self.db) as store:
+            await asyncio.gather(*[store.run(k, callback) for k in 'abc'])
+            await store.segment('a', 0, 100)
+            await store.segment('a', 1, 50)
+            self.assertEqual(store.current, 'c')
+        async with JobStore(self.db) as store:
+            self.assertEqual(store.current, 'c')
+            self.assertEqual(store.status('a'), DONE)
+            self.assertEqual(store.status('b'), FAILED)
+            self.assertIsNone(store.status('d'))
+            self.assertEqual(store.segments('a'), {0: 100, 1: 50})
+            self.assertEqual(store.job('a')['bytes'], 150)
+            # reported again when skipped on restart or downloaded again after a failed check
+            await store.segment('a', 0, 100)
+            await store.segment('a', 1, 60)
+            self.assertEqual(store.job('a')['bytes'], 160)
+            await asyncio.gather(*[store.run(k, callback) for k in 'abc'])
+            self.assertEqual(store.job('b')['attempts'], 2)
+        self.assertEqual(calls, ['a', 'b', 'c', 'b'])
+
+    async def test_interrupted(self):
+        async with JobStore(self.db, batch_size=1) as store:
+            await store._on_start('a')
+        async with JobStore(self.db) as store:
+            self.assertEqual(store.status('a'), FAILED)
+
+    async def test_import_logs(self):
+        logs = [os.path.join(self.tmp.name, fn)
+                for fn in ['downloaded.log', 'errors.log', 'current.log']]
+        for fn, text in zip(logs, ['a\nb\n', 'b\nc\n', 'b']):
+            with open(fn, 'w', encoding='utf-8') as f:
+                f.write(text)
+        async with JobStore(self.db) as store:
+            self.assertEqual(store.import_logs(*logs), 4)
+            self.assertEqual(store.import_logs(*logs), 0)
+            self.assertEqual(sorted(store.keys(DONE)), ['a', 'b'])
+            self.assertEqual(store.keys(FAILED), ['c'])
+        async with JobStore(self.db) as store:
+            self.assertEqual(store.current, 'b')
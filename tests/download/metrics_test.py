@@ -0,0 +1,107 @@
+import asyncio
+import json
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from benchmarks.session_bench import CountingServer
+from download.asynchttp import AsyncHTTP
+from download.metrics import Metrics
+from download.resume import Resume
+from m3u8_util.m3u8 import download
+from tests.download.asynchttp_test import FlakyServer
+from tests.m3u8_util.aiom3u8_test import HLSServer
+
+
+class MetricsTests(TestCase):
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.inc('requests_total', host='a', status=200)
+        metrics.inc('requests_total', 2, host='a', status=200)
+        metrics.gauge('in_flight', 3)
+        metrics.observe('ttfb_seconds', 0.5, host='a"b')
+        metrics.observe('ttfb_seconds', 1.5, host='a"b')
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE m3u8_requests_total counter\n', text)
+        self.assertIn('m3u8_requests_total{host="a",status="200"} 3\n', text)
+        self.assertIn('m3u8_in_flight 3\n', text)
+        self.assertIn('m3u8_ttfb_seconds_count{host="a\\"b"} 2\n', text)
+        self.assertIn('m3u8_ttfb_seconds_sum{host="a\\"b"} 2\n', text)
+        self.assertIn('m3u8_ttfb_seconds_max{host="a\\"b"} 1.5\n', text)
+
+    def test_video(self):
+        metrics = Metrics()
+        with metrics.bind('v'):
+            with metrics.stage('segments'):
+                metrics.segment(4)
+                metrics.body('a', 100, 0.1)
+            metrics.retry('a')
+        metrics.segment()
+        summary = metrics.videos['v']
+        self.assertEqual(summary['segments'], 1)
+        self.assertEqual(summary['bytes'], 100)
+        self.assertEqual(summary['retries'], 1)
+        self.assertEqual(summary['concurrency'], 4)
+        self.assertIn('segments', summary['stages'])
+        self.assertEqual(metrics.counters[('segments_total', ())], 2)
+        self.assertIn('v: 1 segments', metrics.report())
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'metrics.json')
+            metrics.save(fn)
+            with open(fn) as f:
+                data = json.load(f)
+            self.assertEqual(data['videos']['v']['bytes'], 100)
+            self.assertNotIn('start', data['videos']['v'])
+
+
+class InstrumentationTests(IsolatedAsyncioTestCase):
+    async def test_trace(self):
+        metrics = Metrics()
+        async with CountingServer(1024) as server, AsyncHTTP(metrics=metrics) as client:
+            with tempfile.TemporaryDirectory() as tmp:
+                await client.async_downloads(1, [server.url(f'{i}.ts') for i in range(3)], [os.path.join(tmp, f'{i}.ts') for i in range(3)])
+        host = '127.0.0.1'
+        self.assertEqual(metrics.counters[('requests_total', (('host', host), ('status', '200')))], 3)
+        self.assertEqual(metrics.counters[('bytes_total', (('host', host),))], 3072)
+        self.assertEqual(metrics.timings[('ttfb_seconds', (('host', host),))][0], 3)
+        self.assertEqual(metrics.timings[('connect_seconds', (('host', host),))][0], 1)
+        self.assertEqual(metrics.timings[('write_seconds', (('host', host),))][0], 3)
+        self.assertEqual(metrics.counters[('connections_reused_total', (('host', host),))], 2)
+
+    async def test_retries(self):
+        metrics = Metrics()
+        async with FlakyServer(1000, 100) as server, AsyncHTTP(metrics=metrics) as client:
+            with tempfile.TemporaryDirectory() as tmp:
+                with metrics.bind('v'):
+                    await client.async_download(0, asyncio.Semaphore(1), str(server.server.make_url('/seg.ts')), os.path.join(tmp, 'seg.ts'), chunk_size=100)
+        self.assertEqual(metrics.counters[('retries_total', (('host', '127.0.0.1'),))], 1)
+        self.assertEqual(metrics.videos['v']['retries'], 1)
+
+    async def test_video_summary(self):
+        metrics = Metrics()
+        with tempfile.TemporaryDirectory() as tmp:
+            dirs = [os.path.join(tmp, d) for d in ('m3u8', 'tmp', 'videos')]
+            async with HLSServer(5, 100) as server, AsyncHTTP(metrics=metrics) as client:
+                await download(server.url('index.m3u8'), 'v', *dirs, asynchttp=client)
+                await download(server.url('index.m3u8'), 'w', *dirs, asynchttp=client, stream=True)
+        for name in ['v', 'w']:
+            summary = metrics.videos[name]
+            self.assertEqual(summary['segments'], 5)
+            self.assertGreaterEqual(summary['bytes'], 500)
+            self.assertGreater(summary['elapsed'], 0)
+        self.assertEqual(set(metrics.videos['v']['stages']), {'segments', 'keys', 'combine'})
+        self.assertEqual(set(metrics.videos['w']['stages']), {'segments'})
+
+    async def test_resume(self):
+        metrics = Metrics()
+        with tempfile.TemporaryDirectory() as tmp:
+            logs = [os.path.join(tmp, fn) for fn in ['s.log', 'e.log', 'c.log']]
+            async with Resume(*logs, skips=['c'], metrics=metrics) as resume:
+                async def callback(key):
+                    return key == 'a'
+                for key in ['a', 'b', 'c']:
+                    await resume.run(key, callback)
+        self.assertEqual(metrics.counters[('jobs_total', (('status', 'done'),))], 1)
+        self.assertEqual(metrics.counters[('jobs_total', (('status', 'failed'),))], 1)
+        self.assertEqual(metrics.counters[('jobs_total', (('status', 'skipped'),))], 1)
+        self.assertEqual(metrics.timings[('job_seconds', (('status', 'done'),))][0], 1)
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import tempfile
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+
+from benchmarks.cdn import FakeCDN
+from download.mirror import Mirrors
+from m3u8_util.m3u8 import AioM3U8
+
+
+class FailingCDN(FakeCDN):
+    """
+    Segment :param:`index` is not found for its first :param:`fail` requests.
+    """
+
+    def __init__(self, *args, index: int = 3, fail: int = 1, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.index = index
+        self.fail = fail
+
+    async def segment(self, request: web.Request) -> web.StreamResponse:
+        if int(request.match_info['index']) == self.index and self.fail:
+            self.fail -= 1
+            raise web.HTTPNotFound()
+        return await super().segment(request)
+
+
+class MirrorsTests(IsolatedAsyncioTestCase):
+    def test_pick_weighted(self):
+        mirrors = Mirrors(['a', 'b'], seed=0)
+        mirrors.record('a', 1000, 1)
+        mirrors.record('b', 9000, 1)
+        picks = [mirrors.pick() for _ in range(1000)]
+        self.assertGreater(picks.count('b'), 800)
+        self.assertEqual(mirrors.pick(['b']), 'a')
+        self.assertIsNone(mirrors.pick(['a', 'b']))
+
+    def test_hedge_delay(self):
+        mirrors = Mirrors(['a', 'b'], percentile=0.9, min_samples=10)
+        for i in range(9):
+            mirrors.record('a', 1, i + 1)
+        self.assertIsNone(mirrors.hedge_delay())
+        mirrors.record('a', 1, 10)
+        mirrors.fetches = 10
+        self.assertEqual(mirrors.hedge_delay(), 9)
+        mirrors.hedges = 1
+        self.assertIsNone(mirrors.hedge_delay())
+        self.assertIsNone(Mirrors(['a'], min_samples=0).hedge_delay())
+
+    async def test_hedge(self):
+        mirrors = Mirrors(['slow', 'fast'], min_samples=3, max_hedge=1, seed=0)
+        for _ in range(3):
+            mirrors.record('slow', 1, 0.05)
+        mirrors.throughput['fast'] = 1e-9
+        cancelled, cleaned = [], []
+
+        async def fetch(base: str) -> bytes:
+            try:
+                await asyncio.sleep(10 if base == 'slow' else 0.01)
+            except asyncio.CancelledError:
+                cancelled.append(base)
+                raise
+            return base.encode()
+        start = time.monotonic()
+        self.assertEqual(await mirrors.fetch(fetch, cleanup=cleaned.append), b'fast')
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(cancelled, ['slow'])
+        self.assertEqual(cleaned, ['slow'])
+        self.assertEqual((mirrors.hedges, mirrors.hedge_wins), (1, 1))
+
+    async def test_fail_over(self):
+        mirrors = Mirrors(['bad', 'good'], seed=0)
+        mirrors.throughput['good'] = 1e-9
+
+        async def fetch(base: str) -> bytes:
+            if base == 'bad':
+                raise IOError(base)
+            return b'ok'
+        self.assertEqual(await mirrors.fetch(fetch), b'ok')
+        with self.assertRaises(IOError):
+            await Mirrors(['bad']).fetch(fetch)
+
+    async def test_download(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            async with FakeCDN(20, 1000, latency=0.3) as slow, FakeCDN(20, 1000) as fast:
+                for stream in [False, True]:
+                    output = os.path.join(tmp, f'{stream}.ts')
+                    start = time.monotonic()
+                    await AioM3U8.download(os.path.join(tmp, 'index.m3u8'), slow.url('v0/'), output, slow.url(), os.path.join(tmp, str(stream)),
+                                           concurrency=2, stream=stream, mirrors=[fast.url('v0/')])
+                    self.assertLess(time.monotonic() - start, 2)
+                    with open(output, 'rb') as f:
+                        self.assertEqual(f.read(), fast.video)
+                    self.assertEqual(os.listdir(os.path.join(tmp, str(stream))), [])
+            self.assertGreater(fast.requests, slow.requests)
+
+    async def test_download_failed_on_all(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            async with FailingCDN(10, 1000) as a, FailingCDN(10, 1000) as b:
+                output = os.path.join(tmp, 'out.ts')
+                # the segment is downloaded again by check_segs, the others are kept
+                await AioM3U8.download(os.path.join(tmp, 'index.m3u8'), a.url('v0/'), output, a.url(), os.path.join(tmp, 'tmp'),
+                                       concurrency=2, mirrors=[b.url('v0/')])
+                with open(output, 'rb') as f:
+                    self.assertEqual(f.read(), a.video)
+                self.assertEqual((a.fail, b.fail), (0, 0))
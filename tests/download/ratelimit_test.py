@@ -0,0 +1,77 @@
+import asyncio
+import os
+import tempfile
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from benchmarks.session_bench import CountingServer
+from download.asynchttp import AsyncHTTP
+from download.ratelimit import RateLimiter, TokenBucket
+
+
+class TokenBucketTests(TestCase):
+    def test_unlimited(self):
+        bucket = TokenBucket()
+        self.assertEqual(bucket.delay(1 << 40), 0)
+
+    def test_debt(self):
+        bucket = TokenBucket(1000, burst=1)
+        self.assertEqual(bucket.delay(1000), 0)
+        self.assertAlmostEqual(bucket.delay(500), 0.5, delta=0.01)
+        self.assertAlmostEqual(bucket.delay(500), 1.0, delta=0.01)
+
+    def test_change_rate(self):
+        bucket = TokenBucket(1000, burst=1)
+        bucket.delay(3000)
+        bucket.rate = 2000
+        self.assertEqual(bucket.delay(2000), 0)
+        bucket.rate = None
+        self.assertEqual(bucket.delay(1 << 40), 0)
+        with self.assertRaises(ValueError):
+            bucket.rate = 0
+
+
+class RateLimiterTests(IsolatedAsyncioTestCase):
+    def test_hosts(self):
+        limiter = RateLimiter(hosts={'a.com': 100})
+        self.assertIsNone(limiter.host('http://b.com/x.ts'))
+        self.assertEqual(limiter.host('http://a.com/x.ts').rate, 100)
+        limiter.host_bandwidth = 200
+        self.assertEqual(limiter.host('http://b.com/x.ts').rate, 200)
+        self.assertEqual(limiter.host('http://a.com/x.ts').rate, 100)
+        limiter.set_host('a.com', None)
+        self.assertIsNone(limiter.host('http://a.com/x.ts').rate)
+
+    async def test_requests(self):
+        limiter = RateLimiter(requests=20, burst=0.1)
+        start = time.monotonic()
+        for _ in range(6):
+            await limiter.request('http://a.com/x.ts')
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    async def test_download_bandwidth(self):
+        size, count = 64*1024, 8
+        limiter = RateLimiter(bandwidth=1024*1024, burst=0.1)
+        async with CountingServer(size) as server, AsyncHTTP(limiter=limiter) as client:
+            with tempfile.TemporaryDirectory() as tmp:
+                urls = [server.url(f'{i}.ts') for i in range(count)]
+                fns = [os.path.join(tmp, f'{i}.ts') for i in range(count)]
+                start = time.monotonic()
+                await client.async_downloads(4, urls, fns)
+                elapsed = time.monotonic() - start
+                self.assertTrue(all(os.path.getsize(fn) == size for fn in fns))
+        # 512KB at 1MB/s with 0.1s burst
+        self.assertGreaterEqual(elapsed, 0.35)
+
+    async def test_download_runtime_change(self):
+        size = 256*1024
+        limiter = RateLimiter(bandwidth=size / 10, burst=0.01)
+        async with CountingServer(size) as server, AsyncHTTP(limiter=limiter) as client:
+            with tempfile.TemporaryDirectory() as tmp:
+                async def unlimit():
+                    await asyncio.sleep(0.2)
+                    limiter.bandwidth = None
+                start = time.monotonic()
+                await asyncio.gather(unlimit(), client.async_downloads(
+                    1, [server.url(f'{i}.ts') for i in range(20)], [os.path.join(tmp, f'{i}.ts') for i in range(20)]))
+        self.assertLess(time.monotonic() - start, 5)
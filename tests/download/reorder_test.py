@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from download.reorder import ReorderWriter
+
+
+class ReorderWriterTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.tmp.name, 'out.ts')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_in_order(self):
+        async with ReorderWriter(self.output, self.tmp.name, 4, 4) as writer:
+            for i in [2, 1, 3]:
+                await writer.put(i, bytes([i])*2)
+            self.assertEqual(writer.next, 0)
+            self.assertEqual(writer.spills, 1)
+            await writer.put(0, b'\x00\x00')
+            self.assertEqual(writer.next, 4)
+            self.assertEqual(writer.buffered, 0)
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), b'\x00\x00\x01\x01\x02\x02\x03\x03')
+        self.assertEqual(os.listdir(self.tmp.name), ['out.ts'])
+
+    async def test_missing(self):
+        with self.assertRaises(IOError):
+            async with ReorderWriter(self.output, self.tmp.name, 4, 3) as writer:
+                await writer.put(0, b'0')
+                await writer.put(2, b'2')
+        self.assertTrue(ReorderWriter.is_partial(self.output))
+
+    async def test_resume(self):
+        with self.assertRaises(RuntimeError):
+            async with ReorderWriter(self.output, self.tmp.name, total=3, resume=True) as writer:
+                await writer.put(0, b'00')
+                await writer.put(2, b'22')
+                raise RuntimeError()
+        with open(self.output, 'ab') as f:
+            f.write(b'garbage')
+        async with ReorderWriter(self.output, self.tmp.name, total=3, resume=True) as writer:
+            self.assertEqual(writer.next, 1)
+            await writer.put(1, b'11')
+            await writer.put(2, b'22')
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), b'001122')
+        self.assertFalse(ReorderWriter.is_partial(self.output))
+
+    async def test_duplicated(self):
+        async with ReorderWriter(self.output, self.tmp.name) as writer:
+            await writer.put(0, b'0')
+            with self.assertRaises(ValueError):
+                await writer.put(0, b'0')
+
+    async def test_checkpoint(self):
+        fn = ReorderWriter.progress_fn(self.output)
+        with self.assertRaises(RuntimeError):
+            async with ReorderWriter(self.output, self.tmp.name, total=4, resume=True, write_buffer=4) as writer:
+                await writer.put(0, b'00')
+                # buffered in the writer, not recorded yet
+                with open(fn) as f:
+                    self.assertEqual(json.load(f)['next'], 0)
+                await writer.put(1, b'11')
+                with open(fn) as f:
+                    self.assertEqual(json.load(f), {'next': 2, 'written': 4, 'total': 4})
+                await writer.put(2, b'22')
+                raise RuntimeError()
+        # the rest is recorded when closed
+        with open(fn) as f:
+            self.assertEqual(json.load(f)['next'], 3)
+        async with ReorderWriter(self.output, self.tmp.name, total=4, resume=True, write_buffer=4) as writer:
+            self.assertEqual(writer.next, 3)
+            await writer.put(3, b'33')
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), b'00112233')
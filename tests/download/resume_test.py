@@ -0,0 +1,67 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from download.resume import Resume
+
+
+class ResumeTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.logs = [os.path.join(self.tmp.name, fn)
+                     for fn in ['downloaded.log', 'errors.log', 'current.log']]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, fn: str) -> list[str]:
+        with open(fn, encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    async def test_out_of_order(self):
+        delays = {'a': 0.05, 'b': 0.01, 'c': 0.03, 'd': 0.0}
+
+        async def callback(key: str) -> bool:
+            await asyncio.sleep(delays[key])
+            return key != 'c'
+
+        async with Resume(*self.logs) as resume:
+            await asyncio.gather(*[resume.run(k, callback) for k in delays])
+            self.assertEqual(resume.current, 'd')
+        suc, err, cur = [self.read(fn) for fn in self.logs]
+        self.assertEqual(sorted(suc), ['a', 'b', 'd'])
+        self.assertEqual(err, ['c'])
+        self.assertEqual(cur, ['d'])
+
+    async def test_current_waits_for_earlier(self):
+        release = asyncio.Event()
+
+        async def callback(key: str) -> bool:
+            if key == 'a':
+                await release.wait()
+            return True
+
+        async with Resume(*self.logs) as resume:
+            slow = asyncio.ensure_future(resume.run('a', callback))
+            await asyncio.sleep(0)
+            await resume.run('b', callback)
+            self.assertEqual(resume.current, '')
+            release.set()
+            await slow
+            self.assertEqual(resume.current, 'b')
+
+    async def test_current_written_last(self):
+        class SlowResume(Resume):
+            async def _set_current(self, cur: str):
+                # the first write finishes after later ones started
+                await asyncio.sleep(0.05 if cur == 'a' else 0)
+                await super()._set_current(cur)
+
+        async def callback(key: str) -> bool:
+            await asyncio.sleep(0.01 if key == 'b' else 0)
+            return True
+
+        async with SlowResume(*self.logs) as resume:
+            await asyncio.gather(*[resume.run(k, callback) for k in 'ab'])
+        self.assertEqual(self.read(self.logs[2]), ['b'])
@@ -0,0 +1,63 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+import aiohttp
+
+from download.retry import CircuitBreaker, RetryPolicy
+
+
+class RetryPolicyTests(IsolatedAsyncioTestCase):
+    def test_backoff(self):
+        policy = RetryPolicy(base=1, cap=5, jitter=False)
+        self.assertEqual([policy.backoff(i) for i in range(5)], [1, 2, 4, 5, 5])
+        policy = RetryPolicy(base=1, cap=5)
+        self.assertTrue(all(0 <= policy.backoff(i) <= 5 for i in range(10)))
+
+    def test_retryable(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.retryable(503))
+        self.assertTrue(policy.retryable(429))
+        self.assertFalse(policy.retryable(404))
+        self.assertTrue(policy.retryable(exc=aiohttp.ClientConnectionError()))
+        self.assertTrue(policy.retryable(exc=asyncio.TimeoutError()))
+        self.assertFalse(policy.retryable(exc=ValueError()))
+
+    async def test_breaker_per_host(self):
+        policy = RetryPolicy(min_requests=2, cooldown=0.1)
+        for _ in range(2):
+            policy.failure('http://a.com/1.ts', 503)
+        self.assertEqual(policy.get_breaker('http://a.com/2.ts').state, CircuitBreaker.OPEN)
+        self.assertEqual(policy.get_breaker('http://b.com/1.ts').state, CircuitBreaker.CLOSED)
+        policy.failure('http://a.com/1.ts', 404)
+        self.assertEqual(policy.get_breaker('http://a.com/2.ts').state, CircuitBreaker.OPEN)
+
+
+class CircuitBreakerTests(IsolatedAsyncioTestCase):
+    async def test_probe(self):
+        breaker = CircuitBreaker(threshold=0.5, window=4, min_requests=4, cooldown=0.1)
+        for ok in [True, False, True, False]:
+            breaker.record(ok)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await breaker.acquire()
+        self.assertGreaterEqual(loop.time() - start, 0.09)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # others wait for the probe
+        waiter = asyncio.ensure_future(breaker.acquire())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        breaker.record(True)
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    async def test_probe_failed(self):
+        breaker = CircuitBreaker(min_requests=1, cooldown=0.05)
+        breaker.record(False)
+        await breaker.acquire()
+        breaker.record(False)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await breaker.acquire()
+        self.assertGreaterEqual(loop.time() - start, 0.09)
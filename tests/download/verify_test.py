@@ -0,0 +1,70 @@
+import hashlib
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from download.verify import TS_PACKET, Manifest, Verifier, VerifyError
+
+
+def ts(packets: int) -> bytes:
+    return b''.join(b'\x47' + os.urandom(TS_PACKET - 1) for _ in range(packets))
+
+
+class VerifierTests(TestCase):
+    def test_ts(self):
+        data = ts(10)
+        v = Verifier(True, 'sha256')
+        for i in range(0, len(data), 100):
+            v.update(data[i:i+100])
+        self.assertEqual(v.finalize(len(data)), {'sha256': hashlib.sha256(data).hexdigest()})
+
+    def test_not_ts(self):
+        v = Verifier(True)
+        with self.assertRaises(VerifyError):
+            v.update(b'<html>error</html>')
+        data = bytearray(ts(4))
+        data[2 * TS_PACKET] = 0
+        v = Verifier(True)
+        v.update(bytes(data[:300]))
+        with self.assertRaisesRegex(VerifyError, str(2 * TS_PACKET)):
+            v.update(bytes(data[300:]))
+
+    def test_truncated(self):
+        data = ts(4)
+        v = Verifier(True)
+        v.update(data[:-10])
+        with self.assertRaises(VerifyError):
+            v.finalize()
+        v = Verifier()
+        v.update(data[:-10])
+        with self.assertRaises(VerifyError):
+            v.finalize(len(data))
+
+    def test_out_of_order(self):
+        data = ts(4)
+        v = Verifier(True, 'sha256')
+        v.update(data[400:], 400)
+        v.update(data[:400], 0)
+        self.assertEqual(v.finalize(len(data)), {})
+        v = Verifier(True, 'sha256')
+        v.skip(400)
+        v.update(data[400:])
+        self.assertEqual(v.finalize(len(data)), {})
+
+
+class ManifestTests(IsolatedAsyncioTestCase):
+    async def test_check(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, '0.ts')
+            manifest = Manifest(os.path.join(tmp, 'v.manifest.json'))
+            self.assertFalse(manifest.check('0.ts', fn))
+            with open(fn, 'wb') as f:
+                f.write(b'abc')
+            self.assertTrue(manifest.check('0.ts', fn))
+            manifest.add('0.ts', 3, sha256='x')
+            await manifest.save()
+            manifest = Manifest(manifest.file_name)
+            self.assertEqual(manifest.get('0.ts'), {'size': 3, 'sha256': 'x'})
+            with open(fn, 'ab') as f:
+                f.write(b'd')
+            self.assertFalse(manifest.check('0.ts', fn))
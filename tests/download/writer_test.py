@@ -0,0 +1,70 @@
+import errno
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+
+from download.retry import RetryPolicy
+from download.writer import FileWriter, check_free_space
+
+
+class FileWriterTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.dir.name, 'seg.ts')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_coalesce(self):
+        data = os.urandom(10000)
+        async with FileWriter(self.fn, length=len(data), buffer_size=4096) as writer:
+            for i in range(0, len(data), 100):
+                await writer.write(data[i:i+100])
+            self.assertEqual(writer.end, len(data))
+        self.assertEqual(writer.position, len(data))
+        # two full buffers and the rest when closed
+        self.assertEqual(writer.writes, 3)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    async def test_resume(self):
+        with open(self.fn, 'wb') as f:
+            f.write(b'a' * 100)
+        async with FileWriter(self.fn, 100, 100) as writer:
+            await writer.write(b'b' * 100)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 100 + b'b' * 100)
+
+    async def test_reserve_keep_size(self):
+        writer = FileWriter(self.fn, length=1024*1024)
+        await writer.open()
+        # reserved blocks do not change size, which is the resume offset
+        self.assertEqual(os.path.getsize(self.fn), 0)
+        await writer.write(b'x' * 10)
+        await writer.close()
+        self.assertEqual(os.path.getsize(self.fn), 10)
+
+    async def test_flush_when_failed(self):
+        with self.assertRaises(IOError):
+            async with FileWriter(self.fn) as writer:
+                await writer.write(b'x' * 10)
+                raise IOError('connection lost')
+        self.assertEqual(os.path.getsize(self.fn), 10)
+
+    async def test_fsync(self):
+        for policy, count in [('never', 0), ('close', 1), ('flush', 3)]:
+            with mock.patch('download.writer.os.fsync') as fsync:
+                async with FileWriter(self.fn, buffer_size=10, fsync=policy) as writer:  # type: ignore
+                    await writer.write(b'x' * 10)
+                    await writer.write(b'x' * 10)
+                self.assertEqual(fsync.call_count, count, policy)
+
+
+class FreeSpaceTests(TestCase):
+    def test_check(self):
+        with tempfile.TemporaryDirectory() as d:
+            check_free_space(d, 1024)
+            with self.assertRaises(IOError) as ctx:
+                check_free_space(d, 1 << 62)
+            self.assertEqual(ctx.exception.errno, errno.ENOSPC)
+            self.assertFalse(RetryPolicy().retryable(exc=ctx.exception))
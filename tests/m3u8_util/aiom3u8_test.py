@@ -0,0 +1,333 @@
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+import m3u8
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from download.retry import RetryPolicy
+from download.verify import TS_PACKET
+from m3u8_util.m3u8 import AioM3U8, download
+
+
+class HLSServer:
+    """
+    Local server of a media playlist `index.m3u8` with :param:`count` segments.
+    """
+
+    def __init__(self, count: int = 10, size: int = 1024) -> None:
+        self.segments = {f'{i}.ts': os.urandom(size) for i in range(count)}
+        app = web.Application()
+        app.router.add_get('/index.m3u8', self.playlist)
+        app.router.add_get('/{name}', self.segment)
+        self.server = TestServer(app)
+
+    async def playlist(self, _: web.Request) -> web.Response:
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:1']
+        for name in self.segments:
+            lines += ['#EXTINF:1.0,', name]
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines))
+
+    async def segment(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        if name not in self.segments:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.segments[name])
+
+    @property
+    def content(self) -> bytes:
+        return b''.join(self.segments.values())
+
+    def url(self, path: str = '') -> str:
+        return str(self.server.make_url(f'/{path}'))
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.server.close()
+
+
+class LiveServer(HLSServer):
+    """
+    Live playlist with a sliding window of :param:`window` segments, which moves one segment each reload
+    and ends when it reaches the last segment if :param:`end`.
+    """
+
+    def __init__(self, count: int = 8, size: int = 1024, window: int = 3, end: bool = True) -> None:
+        super().__init__(count, size)
+        self.window = window
+        self.end = end
+        self.reloads = 0
+        self.requested: list[str] = []
+
+    async def playlist(self, _: web.Request) -> web.Response:
+        names = list(self.segments)
+        first = min(self.reloads, len(names) - self.window)
+        self.reloads += 1
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:1', f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        for name in names[first:first+self.window]:
+            lines += ['#EXTINF:1.0,', name]
+        if self.end and first + self.window == len(names):
+            lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines))
+
+    async def segment(self, request: web.Request) -> web.Response:
+        self.requested.append(request.match_info['name'])
+        return await super().segment(request)
+
+
+class ByteRangeServer(HLSServer):
+    """
+    Media playlist of :param:`count` `EXT-X-BYTERANGE` segments in one `all.ts`.
+    """
+
+    def __init__(self, count: int = 10, size: int = 1024) -> None:
+        super().__init__(count, size)
+        self.ranges: list[str] = []
+
+    async def playlist(self, _: web.Request) -> web.Response:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:4', '#EXT-X-TARGETDURATION:1']
+        offset = 0
+        for i, data in enumerate(self.segments.values()):
+            # the first one has an explicit offset, others continue from the previous one
+            lines += ['#EXTINF:1.0,', f'#EXT-X-BYTERANGE:{len(data)}@{offset}' if not i else f'#EXT-X-BYTERANGE:{len(data)}', 'all.ts']
+            offset += len(data)
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines))
+
+    async def segment(self, request: web.Request) -> web.Response:
+        rng = request.headers['Range']
+        self.ranges.append(rng)
+        start, _, end = rng[6:].partition('-')
+        content = self.content
+        return web.Response(body=content[int(start):int(end)+1], status=206,
+                            headers={'Content-Range': f'bytes {start}-{end}/{len(content)}'})
+
+
+class TSServer(HLSServer):
+    """
+    Segments of MPEG-TS packets. Each of :param:`broken` is served as an error page with 200 for its first count requests.
+    """
+
+    def __init__(self, count: int = 10, packets: int = 8, broken: dict[str, int] = {}) -> None:
+        super().__init__(count)
+        self.segments = {name: b''.join(b'\x47' + os.urandom(TS_PACKET - 1) for _ in range(packets))
+                         for name in self.segments}
+        self.broken = dict(broken)
+        self.requested: list[str] = []
+
+    async def segment(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        self.requested.append(name)
+        if self.broken.get(name):
+            self.broken[name] -= 1
+            return web.Response(text='<html>busy</html>', content_type='text/html')
+        return await super().segment(request)
+
+
+class QueryServer(HLSServer):
+    """
+    Playlist in `/v/index.m3u8`, whose segments have query strings, and the even ones are absolute uris.
+    """
+
+    def __init__(self, count: int = 6, size: int = 1024) -> None:
+        super().__init__(count, size)
+        app = web.Application()
+        app.router.add_get('/v/index.m3u8', self.playlist)
+        app.router.add_get('/v/seg.ts', self.segment)
+        self.server = TestServer(app)
+
+    async def playlist(self, _: web.Request) -> web.Response:
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:1']
+        for i in range(len(self.segments)):
+            lines += ['#EXTINF:1.0,', self.url(f'v/seg.ts?n={i}') if i % 2 == 0 else f'seg.ts?n={i}']
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines))
+
+    async def segment(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.segments[f'{request.query["n"]}.ts'])
+
+
+class FMP4Server(HLSServer):
+    """
+    fMP4 segments with `EXT-X-MAP`, which changes at :param:`switch` and changes back at the segment after it.
+    """
+
+    def __init__(self, count: int = 6, size: int = 1024, switch: int = 3) -> None:
+        super().__init__(count, size)
+        self.segments = {f'{i}.m4s': data for i, data in enumerate(self.segments.values())}
+        self.segments.update({'init.mp4': os.urandom(100), 'init2.mp4': os.urandom(100)})
+        self.switch = switch
+        self.requested: list[str] = []
+
+    def init(self, index: int) -> str:
+        return 'init2.mp4' if index == self.switch else 'init.mp4'
+
+    async def playlist(self, _: web.Request) -> web.Response:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-TARGETDURATION:1']
+        for i in range(len(self.segments) - 2):
+            if not i or self.init(i) != self.init(i - 1):
+                lines.append(f'#EXT-X-MAP:URI="{self.init(i)}"')
+            lines += ['#EXTINF:1.0,', f'{i}.m4s']
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines))
+
+    async def segment(self, request: web.Request) -> web.Response:
+        self.requested.append(request.match_info['name'])
+        return await super().segment(request)
+
+    @property
+    def content(self) -> bytes:
+        content = b''
+        for i in range(len(self.segments) - 2):
+            if not i or self.init(i) != self.init(i - 1):
+                content += self.segments[self.init(i)]
+            content += self.segments[f'{i}.m4s']
+        return content
+
+
+class AioM3U8Tests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.m3u8_fn = os.path.join(self.tmp.name, 'index.m3u8')
+        self.output = os.path.join(self.tmp.name, 'out.ts')
+        self.tmp_dir = os.path.join(self.tmp.name, 'tmp')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_download(self):
+        async with HLSServer() as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir)
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+
+    async def test_download_stream(self):
+        async with HLSServer() as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir, stream=True, adaptive=True)
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+            self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    async def test_live(self):
+        async with LiveServer() as server:
+            md = AioM3U8(self.m3u8_fn, self.tmp_dir)
+            await md.live_segs(server.url('index.m3u8'), server.url(), self.output, poll=0.01)
+            await md.close()
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+            self.assertEqual(sorted(server.requested), sorted(server.segments))
+
+    async def test_live_duration(self):
+        async with LiveServer(100, end=False) as server:
+            md = AioM3U8(self.m3u8_fn, self.tmp_dir)
+            await md.live_segs(server.url('index.m3u8'), server.url(), self.output, duration=0.2, poll=0.05)
+            await md.close()
+            self.assertGreater(server.reloads, 1)
+            self.assertLess(server.reloads, 20)
+            self.assertEqual(len(server.requested), server.reloads + 2)
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), b''.join(
+                    server.segments[n] for n in sorted(server.requested, key=lambda n: int(n[:-3]))))
+
+    async def test_byte_range(self):
+        async with ByteRangeServer() as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir, coalesce=4096)
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+            self.assertEqual(server.ranges, ['bytes=0-4095', 'bytes=4096-8191', 'bytes=8192-10239'])
+            self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    async def test_byte_range_stream(self):
+        async with ByteRangeServer() as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir, stream=True)
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+            self.assertEqual(len(server.ranges), 10)
+
+    async def test_verify(self):
+        async with TSServer(broken={'3.ts': 1}) as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir,
+                                   verify=True, digest='sha256', policy=RetryPolicy(base=0, breaker=False))
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+            self.assertEqual(server.requested.count('3.ts'), 2)
+        manifest = AioM3U8(self.m3u8_fn, self.tmp_dir).manifest
+        self.assertEqual(len(manifest.entries), 11)
+        self.assertEqual(manifest.get('out.ts'), {'size': len(server.content)})
+        self.assertIn('sha256', manifest.get('0.ts'))
+
+    async def test_refetch(self):
+        async with TSServer(broken={'3.ts': 3}) as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir,
+                                   verify=True, policy=RetryPolicy(base=0, breaker=False))
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+            self.assertEqual(server.requested.count('3.ts'), 4)
+            self.assertEqual(server.requested.count('4.ts'), 1)
+
+    async def test_combine_missing(self):
+        async with TSServer() as server:
+            md = AioM3U8(self.m3u8_fn, self.tmp_dir)
+            await md.download_m3u8(server.url('index.m3u8'))
+            await md.download_segs(server.url())
+            await md.close()
+        os.remove(os.path.join(self.tmp_dir, '5.ts'))
+        self.assertEqual(await md.check_segs(), [5])
+        with self.assertRaises(IOError):
+            md.combine_segs(self.output)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, '0.ts')))
+
+    async def test_resolve(self):
+        async with QueryServer() as server:
+            dirs = [os.path.join(self.tmp.name, d) for d in ('m3u8', 'tmp', 'videos')]
+            # the old base url regex took everything before the last slash in query
+            fn, _ = await download(server.url('v/index.m3u8?from=a/b.m3u8'), 'v', *dirs)
+            with open(fn, 'rb') as f:
+                self.assertEqual(f.read(), server.content)
+
+    async def test_playlist_cached(self):
+        async with HLSServer() as server:
+            md = AioM3U8(self.m3u8_fn, self.tmp_dir)
+            await md.download_m3u8(server.url('index.m3u8'))
+            await md.close()
+        playlist = await md.load_playlist()
+        os.remove(self.m3u8_fn)
+        self.assertIs(await md.load_playlist(), playlist)
+        self.assertIs(md._layout(playlist), md._layout(playlist))
+        self.assertEqual(len(playlist.segments), 10)
+
+    async def test_free_space(self):
+        async with ByteRangeServer() as server:
+            md = AioM3U8(self.m3u8_fn, self.tmp_dir)
+            await md.download_m3u8(server.url('index.m3u8'))
+            await md.close()
+            self.assertEqual(md.estimate_size(await md.load_playlist()), len(server.content))
+            with self.assertRaises(IOError):
+                await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir, min_free=1 << 62)
+            self.assertEqual(server.ranges, [])
+            self.assertFalse(os.path.exists(self.output))
+
+    async def test_init_section(self):
+        for mode in [{}, {'stream': True}, {'live': True}]:
+            async with FMP4Server() as server:
+                await AioM3U8.download(self.m3u8_fn, server.url(), self.output, server.url('index.m3u8'), self.tmp_dir, **mode)
+                with open(self.output, 'rb') as f:
+                    self.assertEqual(f.read(), server.content, mode)
+                # written again when it changes back, but requested once
+                self.assertEqual(server.requested.count('init.mp4'), 1)
+                self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_init_section_layout(self):
+        playlist = m3u8.loads('\n'.join(['#EXTM3U', '#EXT-X-MAP:URI="all.mp4",BYTERANGE="100@0"',
+                                         '#EXT-X-BYTERANGE:50@100', '#EXTINF:1,', 'all.mp4', '#EXT-X-BYTERANGE:50', '#EXTINF:1,', 'all.mp4']))
+        downloads, pieces, inits = AioM3U8(self.m3u8_fn, self.tmp_dir)._layout(playlist)
+        fn = os.path.join(self.tmp_dir, 'all.mp4.0')
+        # the section is coalesced with the segments after it
+        self.assertEqual(downloads, [('all.mp4', fn, (0, 199), [0, 1])])
+        self.assertEqual(pieces, [(fn, 100, 50), (fn, 150, 50)])
+        self.assertEqual(inits, {0: (fn, 0, 100)})
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from download.jobstore import DONE, JobStore
+from download.resume import Resume
+from m3u8_util.batch import BatchDownloader
+from m3u8_util.mux import Muxer
+from tests.m3u8_util.aiom3u8_test import HLSServer
+
+
+class BatchDownloaderTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dirs = {k: os.path.join(self.tmp.name, k)
+                     for k in ['m3u8_dir', 'tmp_dir', 'videos_dir']}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_run(self):
+        async with HLSServer(5) as server:
+            jobs = [(f'v{i}', server.url('index.m3u8')) for i in range(6)]
+            jobs.append(('missing', server.url('missing.m3u8')))
+            done = []
+            async with BatchDownloader(3, 6, stream=True, retry=1, **self.dirs) as batch:
+                self.assertEqual(batch.concurrency, 2)
+                await batch.run(jobs, on_done=lambda name, *_: done.append(name))
+            self.assertEqual(sorted(batch.results), [f'v{i}' for i in range(6)])
+            self.assertEqual(list(batch.errors), ['missing'])
+            self.assertEqual(sorted(done), sorted(n for n, _ in jobs))
+            for fn, downloaded in batch.results.values():
+                self.assertTrue(downloaded)
+                with open(fn, 'rb') as f:
+                    self.assertEqual(f.read(), server.content)
+
+    async def test_resume(self):
+        logs = [os.path.join(self.tmp.name, fn)
+                for fn in ['downloaded.log', 'errors.log', 'current.log']]
+        async with HLSServer(5) as server:
+            jobs = [('a', server.url('index.m3u8?a')), ('b', server.url('missing.m3u8')),
+                    ('c', server.url('index.m3u8?c'))]
+            async with BatchDownloader(3, retry=1, **self.dirs) as batch, Resume(*logs) as resume:
+                await batch.run(jobs, resume)
+        with open(logs[0]) as f:
+            self.assertEqual(sorted(f.read().split()), [jobs[0][1], jobs[2][1]])
+        with open(logs[1]) as f:
+            self.assertEqual(f.read().split(), [jobs[1][1]])
+        with open(logs[2]) as f:
+            self.assertEqual(f.read(), jobs[2][1])
+
+    async def test_job_store(self):
+        async with HLSServer(5) as server:
+            jobs = [('a', server.url('index.m3u8?a')), ('b', server.url('index.m3u8?b'))]
+            async with BatchDownloader(2, **self.dirs) as batch, JobStore(os.path.join(self.tmp.name, 'jobs.db')) as store:
+                await batch.run(jobs, store)
+                for _, url in jobs:
+                    self.assertEqual(store.status(url), DONE)
+                    self.assertEqual(sorted(store.segments(url)), list(range(5)))
+                    self.assertEqual(store.job(url)['bytes'], len(server.content))
+
+    async def test_mux_overlaps_downloads(self):
+        started = asyncio.Event()
+
+        class WaitMuxer(Muxer):
+            """The first video is muxed only after the second one finished downloading."""
+            count = 0
+
+            async def mux(self, chunks, output):
+                self.count += 1
+                if self.count == 1:
+                    await asyncio.wait_for(started.wait(), 5)
+                else:
+                    started.set()
+                return await super().mux(chunks, output)
+        async with HLSServer(5) as server:
+            jobs = [('a', server.url('index.m3u8?a')), ('b', server.url('index.m3u8?b'))]
+            async with BatchDownloader(1, container=WaitMuxer(), **self.dirs) as batch:
+                await batch.run(jobs)
+        self.assertEqual(sorted(batch.results), ['a', 'b'])
+        self.assertEqual(batch.errors, {})
@@ -0,0 +1,101 @@
+import os
+import tempfile
+from collections import Counter
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+import m3u8
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from m3u8_util.crypto import Decryptor, segment_iv
+from m3u8_util.m3u8 import AioM3U8
+
+
+def encrypt(key: bytes, iv: bytes, data: bytes) -> bytes:
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+
+class EncryptedServer:
+    """
+    Playlist of :param:`count` segments from media sequence :param:`sequence`, encrypted by two keys.
+    Segments of the second key use an explicit IV.
+    """
+
+    def __init__(self, count: int = 6, sequence: int = 10) -> None:
+        self.keys = {'k1.bin': os.urandom(16), 'k2.bin': os.urandom(16)}
+        self.iv = os.urandom(16)
+        self.plain = [os.urandom(1000 + i*333) for i in range(count)]
+        self.requested: Counter[str] = Counter()
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:1', f'#EXT-X-MEDIA-SEQUENCE:{sequence}',
+                 '#EXT-X-KEY:METHOD=AES-128,URI="k1.bin"']
+        self.segments = {}
+        for i, data in enumerate(self.plain):
+            if i == count // 2:
+                lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="k2.bin",IV=0x{self.iv.hex()}')
+            if i < count // 2:
+                self.segments[f'{i}.ts'] = encrypt(self.keys['k1.bin'], (sequence+i).to_bytes(16, 'big'), data)
+            else:
+                self.segments[f'{i}.ts'] = encrypt(self.keys['k2.bin'], self.iv, data)
+            lines += ['#EXTINF:1.0,', f'{i}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        self.playlist = '\n'.join(lines)
+        app = web.Application()
+        app.router.add_get('/{name}', self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        self.requested[name] += 1
+        if name == 'index.m3u8':
+            return web.Response(text=self.playlist)
+        return web.Response(body={**self.keys, **self.segments}[name])
+
+    def url(self, path: str = '') -> str:
+        return str(self.server.make_url(f'/{path}'))
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.server.close()
+
+
+class DecryptorTests(TestCase):
+    def test_segment_iv(self):
+        key = m3u8.Key('AES-128', '', 'k.bin')
+        self.assertEqual(segment_iv(key, 1), b'\x00'*15 + b'\x01')
+        key = m3u8.Key('AES-128', '', 'k.bin', iv='0x0102')
+        self.assertEqual(segment_iv(key, 1), b'\x00'*14 + b'\x01\x02')
+
+    def test_chunks(self):
+        key, iv, data = os.urandom(16), os.urandom(16), os.urandom(5000)
+        encrypted = encrypt(key, iv, data)
+        decryptor = Decryptor(key, iv)
+        out = b''.join(decryptor.update(encrypted[i:i+7])
+                       for i in range(0, len(encrypted), 7))
+        self.assertEqual(out + decryptor.finalize(), data)
+        with self.assertRaises(ValueError):
+            Decryptor(b'short', iv)
+
+    def test_unsupported(self):
+        self.assertIsNone(AioM3U8._key(m3u8.Key('NONE', '')))
+        with self.assertRaisesRegex(ValueError, 'SAMPLE-AES'):
+            AioM3U8._key(m3u8.Key('SAMPLE-AES', '', 'k.bin'))
+
+
+class AioM3U8DecryptTests(IsolatedAsyncioTestCase):
+    async def test_download(self):
+        for stream in [False, True]:
+            with tempfile.TemporaryDirectory() as tmp:
+                output = os.path.join(tmp, 'out.ts')
+                async with EncryptedServer() as server:
+                    await AioM3U8.download(os.path.join(tmp, 'index.m3u8'), server.url(), output, server.url('index.m3u8'), os.path.join(tmp, 'tmp'), stream=stream)
+                    self.assertEqual(server.requested['k1.bin'], 1)
+                    self.assertEqual(server.requested['k2.bin'], 1)
+                with open(output, 'rb') as f:
+                    self.assertEqual(f.read(), b''.join(server.plain))
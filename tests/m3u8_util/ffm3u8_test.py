@@ -1,28 +1,169 @@
+import asyncio
 import os
+import stat
+import sys
 import tempfile
-from unittest import TestCase
-
-from m3u8_util.m3u8 import FFM3U8
-
-
-class FFM3U8Tests(TestCase):
-    def test_download_success(self):
-        URL = "https://t20.cdn2020.com/video/m3u8/2022/12/06/c26392d0/index.m3u8"
-        _, FN = tempfile.mkstemp(prefix='m3u8', suffix='.ts')
-        FFM3U8.download(URL, FN)
-        size = os.path.getsize(FN)
-        self.assertTrue(size)
-
-    def test_download_fail(self):
-        URL = "https://example.com/unexist.m3u8"
-        _, FN = tempfile.mkstemp(prefix='m3u8', suffix='.ts')
-        with self.assertRaises(RuntimeError) as ex:
-            FFM3U8.download(URL, FN)
-        print(ex)
-
-    def test_download_override_n(self):
-        URL = "https://t20.cdn2020.com/video/m3u8/2022/12/06/c26392d0/index.m3u8"
-        _, FN = tempfile.mkstemp(prefix='m3u8', suffix='.ts')
-        with self.assertRaises(RuntimeError) as ex:
-            FFM3U8.download(URL, FN, override=False)
-        print(ex)
+from unittest import IsolatedAsyncioTestCase
+
+from m3u8_util.ffmpeg import FFmpegPool, parse_progress
+from m3u8_util.m3u8 import FFM3U8, download
+from tests.m3u8_util.aiom3u8_test import HLSServer
+
+STUB = '''#!{python}
+"""Stub of ffmpeg which downloads a media playlist with `-i` to the last argument."""
+import os, sys, time, urllib.request
+from urllib.parse import urljoin
+
+args = sys.argv[1:]
+url, output = args[args.index('-i') + 1], args[-1]
+headers = {{}}
+if '-headers' in args:
+    for line in args[args.index('-headers') + 1].split('\\r\\n'):
+        if line:
+            k, _, v = line.partition(': ')
+            headers[k] = v
+if os.environ.get('STUB_PID'):
+    with open(os.environ['STUB_PID'], 'w') as f:
+        f.write(str(os.getpid()))
+time.sleep(float(os.environ.get('STUB_SLEEP', 0)))
+if '-n' in args and os.path.exists(output):
+    sys.exit(1)
+if url == 'pipe:0':
+    data = sys.stdin.buffer.read()
+    with open(output, 'wb') as f:
+        f.write(b'MUX' + data)
+    print(f'total_size={{len(data)}}\\nprogress=end', flush=True)
+    sys.exit(0)
+try:
+    def get(u):
+        return urllib.request.urlopen(urllib.request.Request(u, headers=headers)).read()
+    names = [l for l in get(url).decode().splitlines() if l and not l.startswith('#')]
+    size = 0
+    with open(output, 'wb') as f:
+        for i, name in enumerate(names):
+            data = get(urljoin(url, name))
+            size += len(data)
+            f.write(data)
+            print(f'frame={{i}}\\ntotal_size={{size}}\\nout_time_us={{i * 1000000}}\\nspeed=1.0x\\nprogress=continue', flush=True)
+except Exception as e:
+    print(e, file=sys.stderr)
+    sys.exit(1)
+print(f'total_size={{size}}\\nprogress=end', flush=True)
+'''
+
+
+def write_stub(dir: str) -> str:
+    """
+    Write the stub of ffmpeg to :param:`dir`. It writes `MUX` and the data piped to `pipe:0`.
+    """
+    ffmpeg = os.path.join(dir, 'ffmpeg')
+    with open(ffmpeg, 'w') as f:
+        f.write(STUB.format(python=sys.executable))
+    os.chmod(ffmpeg, os.stat(ffmpeg).st_mode | stat.S_IEXEC)
+    return ffmpeg
+
+
+class FFM3U8Tests(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.ffmpeg = write_stub(self.dir.name)
+        self.output = os.path.join(self.dir.name, 'video.ts')
+        os.environ.pop('STUB_SLEEP', None)
+        os.environ.pop('STUB_PID', None)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    async def test_download_success(self):
+        progress = []
+        async with HLSServer(5) as server:
+            pool = FFmpegPool(ffmpeg=self.ffmpeg)
+            fn = await FFM3U8.download(server.url('index.m3u8'), self.output, pool=pool, on_progress=progress.append)
+        self.assertEqual(fn, self.output)
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), server.content)
+        self.assertEqual(len(progress), 6)
+        self.assertEqual(progress[-1]['progress'], 'end')
+        self.assertEqual(progress[-1]['total_size'], len(server.content))
+        self.assertEqual(progress[2]['out_time_us'], 2000000)
+
+    async def test_download_headers(self):
+        seen = []
+
+        class RefererServer(HLSServer):
+            async def playlist(self, request):
+                seen.append(request.headers.get('Referer'))
+                return await super().playlist(request)
+
+            async def segment(self, request):
+                seen.append(request.headers.get('Referer'))
+                return await super().segment(request)
+        async with RefererServer(2) as server:
+            await FFM3U8.download(server.url('index.m3u8'), self.output, {'Referer': 'https://example.com/'}, pool=FFmpegPool(ffmpeg=self.ffmpeg))
+        self.assertEqual(seen, ['https://example.com/'] * 3)
+
+    async def test_download_fail(self):
+        async with HLSServer(2) as server:
+            with self.assertRaises(IOError):
+                await FFM3U8.download(server.url('unexist.m3u8'), self.output, retry=2, pool=FFmpegPool(ffmpeg=self.ffmpeg))
+
+    async def test_download_override_n(self):
+        open(self.output, 'wb').close()
+        async with HLSServer(2) as server:
+            with self.assertRaises(IOError):
+                await FFM3U8.download(server.url('index.m3u8'), self.output, override=False, retry=1, pool=FFmpegPool(ffmpeg=self.ffmpeg))
+
+    async def test_invalid_args(self):
+        with self.assertRaises(ValueError):
+            await FFM3U8.download('ftp://example.com/index.m3u8', self.output)
+        with self.assertRaises(ValueError):
+            await FFM3U8.download('https://example.com/index.m3u8', '')
+
+    async def test_pool_bounded(self):
+        os.environ['STUB_SLEEP'] = '0.3'
+        pool = FFmpegPool(2, ffmpeg=self.ffmpeg)
+        peak = 0
+
+        async def watch():
+            nonlocal peak
+            while True:
+                peak = max(peak, pool.running)
+                await asyncio.sleep(0.01)
+        watcher = asyncio.ensure_future(watch())
+        async with HLSServer(2) as server:
+            await asyncio.gather(*[FFM3U8.download(server.url('index.m3u8'), os.path.join(self.dir.name, f'{i}.ts'), pool=pool) for i in range(5)])
+        watcher.cancel()
+        self.assertEqual(peak, 2)
+        self.assertEqual(pool.running, 0)
+
+    async def test_cancel_terminates(self):
+        os.environ['STUB_SLEEP'] = '30'
+        os.environ['STUB_PID'] = os.path.join(self.dir.name, 'pid')
+        pool = FFmpegPool(ffmpeg=self.ffmpeg, terminate_timeout=1)
+        task = asyncio.ensure_future(FFM3U8.download(
+            'http://127.0.0.1:1/index.m3u8', self.output, pool=pool))
+        while not os.path.exists(os.environ['STUB_PID']) or not os.path.getsize(os.environ['STUB_PID']):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        with open(os.environ['STUB_PID']) as f:
+            pid = int(f.read())
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+        self.assertEqual(pool.running, 0)
+
+    async def test_download_ff_mode(self):
+        async with HLSServer(3) as server:
+            fn, downloaded = await download(server.url('index.m3u8'), 'video', *[os.path.join(self.dir.name, d) for d in ('m3u8', 'tmp', 'videos')], mode='ff', ffpool=FFmpegPool(ffmpeg=self.ffmpeg))
+        self.assertTrue(downloaded)
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), server.content)
+
+    def test_parse_progress(self):
+        progress = parse_progress(
+            {'total_size': '2000', 'out_time_ms': 'N/A', 'speed': '2x', 'progress': 'continue'}, 2.0)
+        self.assertEqual(progress['total_size'], 2000)
+        self.assertIsNone(progress['out_time_ms'])
+        self.assertEqual(progress['speed'], '2x')
+        self.assertEqual(progress['throughput'], 1000)
@@ -0,0 +1,92 @@
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from m3u8_util.ffmpeg import FFmpegPool
+from m3u8_util.m3u8 import AioM3U8, download
+from m3u8_util.mux import MP4Muxer, Muxer, get_muxer
+from tests.m3u8_util.aiom3u8_test import HLSServer
+from tests.m3u8_util.ffm3u8_test import write_stub
+
+
+async def chunks(*items: bytes):
+    for item in items:
+        yield item
+
+
+class MuxerTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pool = FFmpegPool(ffmpeg=write_stub(self.tmp.name))
+        self.m3u8_fn = os.path.join(self.tmp.name, 'index.m3u8')
+        self.tmp_dir = os.path.join(self.tmp.name, 'tmp')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_muxer(self):
+        self.assertIs(type(get_muxer('ts')), Muxer)
+        muxer = get_muxer('mp4', self.pool)
+        self.assertIsInstance(muxer, MP4Muxer)
+        self.assertIs(muxer.pool, self.pool)
+        self.assertIs(get_muxer(muxer), muxer)
+        with self.assertRaises(ValueError):
+            get_muxer('mkv')
+
+    async def test_passthrough(self):
+        output = os.path.join(self.tmp.name, 'out.ts')
+        await Muxer().mux(chunks(b'ab', b'cd'), output)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'abcd')
+
+    async def test_mp4(self):
+        output = os.path.join(self.tmp.name, 'out.mp4')
+        await MP4Muxer(self.pool).mux(chunks(b'ab', b'cd'), output)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'MUXabcd')
+
+    async def test_mp4_fail(self):
+        with self.assertRaises(IOError):
+            await MP4Muxer(FFmpegPool(ffmpeg='false')).mux(chunks(b'ab'), os.path.join(self.tmp.name, 'out.mp4'))
+
+    async def test_download_piped(self):
+        output = os.path.join(self.tmp.name, 'out.mp4')
+        downloaded = []
+        async with HLSServer() as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), output, server.url('index.m3u8'), self.tmp_dir,
+                                   muxer=MP4Muxer(self.pool), on_downloaded=lambda: downloaded.append(os.listdir(self.tmp_dir)))
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'MUX' + server.content)
+        self.assertEqual(len([fn for fn in downloaded[0] if fn.endswith('.ts')]), 10)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'out.ts')))
+
+    async def test_download_mux_fail(self):
+        output = os.path.join(self.tmp.name, 'out.mp4')
+        async with HLSServer() as server:
+            with self.assertRaises(IOError):
+                await AioM3U8.download(self.m3u8_fn, server.url(), output, server.url('index.m3u8'), self.tmp_dir,
+                                       muxer=MP4Muxer(FFmpegPool(ffmpeg='false')))
+            # segments are kept for the retry
+            self.assertEqual(len([fn for fn in os.listdir(self.tmp_dir) if fn.endswith('.ts')]), 10)
+            await AioM3U8.download(self.m3u8_fn, server.url(), output, '', self.tmp_dir, muxer=MP4Muxer(self.pool))
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'MUX' + server.content)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    async def test_download_stream(self):
+        output = os.path.join(self.tmp.name, 'out.mp4')
+        async with HLSServer() as server:
+            await AioM3U8.download(self.m3u8_fn, server.url(), output, server.url('index.m3u8'), self.tmp_dir,
+                                   stream=True, muxer=MP4Muxer(self.pool))
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'MUX' + server.content)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'out.ts')))
+
+    async def test_download_container(self):
+        dirs = [os.path.join(self.tmp.name, d) for d in ('m3u8', 'tmp', 'videos')]
+        async with HLSServer(3) as server:
+            fn, _ = await download(server.url('index.m3u8'), 'video', *dirs, container='mp4', ffpool=self.pool)
+        self.assertEqual(fn, os.path.join(dirs[2], 'video.mp4'))
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), b'MUX' + server.content)
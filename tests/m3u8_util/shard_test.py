@@ -0,0 +1,79 @@
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from download.jobstore import DONE, FAILED, JobStore
+from download.metrics import Metrics
+from download.ratelimit import RateLimiter
+from download.resume import Resume
+from m3u8_util.shard import ShardedDownloader, _share
+from tests.m3u8_util.aiom3u8_test import HLSServer
+
+
+class ShareTests(TestCase):
+    def test_share(self):
+        limits = RateLimiter(1000, 100, {'a.com': 10}, 50)
+        limiter = RateLimiter()
+        _share(limiter, limits, 0.25)
+        self.assertEqual(limiter.bandwidth, 250)
+        self.assertEqual(limiter.requests, 12.5)
+        self.assertEqual(limiter.host_bandwidth, 25)
+        self.assertEqual(limiter.hosts, {'a.com': 2.5})
+        _share(limiter, RateLimiter(), 0.5)
+        self.assertIsNone(limiter.bandwidth)
+
+
+class ShardedDownloaderTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dirs = {k: os.path.join(self.tmp.name, k)
+                     for k in ['m3u8_dir', 'tmp_dir', 'videos_dir']}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_run(self):
+        logs = [os.path.join(self.tmp.name, fn)
+                for fn in ['downloaded.log', 'errors.log', 'current.log']]
+        async with HLSServer(5) as server:
+            jobs = [(f'v{i}', server.url(f'index.m3u8?v{i}')) for i in range(4)]
+            jobs.insert(2, ('missing', server.url('missing.m3u8')))
+            metrics = Metrics()
+            progress = []
+            async with ShardedDownloader(2, 4, 8, retry=1, limiter=RateLimiter(10*1024*1024), metrics=metrics,
+                                         on_progress=progress.append, **self.dirs) as shards, Resume(*logs) as resume:
+                await shards.run(jobs, resume)
+            self.assertEqual(sorted(shards.results), [f'v{i}' for i in range(4)])
+            self.assertEqual(list(shards.errors), ['missing'])
+            for fn, downloaded in shards.results.values():
+                self.assertTrue(downloaded)
+                with open(fn, 'rb') as f:
+                    self.assertEqual(f.read(), server.content)
+        # all events are handled when closed, and the end state has been reported
+        end = {'done': 4, 'failed': 1, 'skipped': 0, 'running': 0, 'segments': 20, 'bytes': 4 * len(server.content)}
+        self.assertEqual(shards.progress, end)
+        self.assertIn(end, progress)
+        self.assertEqual(sorted(metrics.videos), sorted(name for name, _ in jobs))
+        # only the coordinator writes log files
+        with open(logs[0]) as f:
+            self.assertEqual(sorted(f.read().split()), sorted(url for name, url in jobs if name != 'missing'))
+        with open(logs[1]) as f:
+            self.assertEqual(f.read().split(), [jobs[2][1]])
+        self.assertEqual(resume.current, jobs[-1][1])
+        with open(logs[2]) as f:
+            self.assertEqual(f.read(), jobs[-1][1])
+
+    async def test_job_store(self):
+        db = os.path.join(self.tmp.name, 'jobs.db')
+        async with HLSServer(5) as server:
+            jobs = [('a', server.url('index.m3u8?a')), ('b', server.url('missing.m3u8'))]
+            async with ShardedDownloader(2, 2, retry=1, **self.dirs) as shards, JobStore(db) as store:
+                await shards.run(jobs, store)
+                self.assertEqual(store.status(jobs[0][1]), DONE)
+                self.assertEqual(store.status(jobs[1][1]), FAILED)
+                self.assertEqual(sorted(store.segments(jobs[0][1])), list(range(5)))
+            # done keys are skipped by the coordinator
+            async with ShardedDownloader(1, **self.dirs) as shards, JobStore(db) as store:
+                await shards.run(jobs[:1], store)
+            self.assertEqual(shards.progress['skipped'], 1)
+            self.assertEqual(shards.results, {})
@@ -0,0 +1,85 @@
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+import m3u8
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from m3u8_util.m3u8 import download
+from m3u8_util.variant import rendition_ext, select_renditions, select_variant
+
+MASTER = '''#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="English",LANGUAGE="en",DEFAULT=YES,URI="audio/en.m3u8"
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="French",LANGUAGE="fr",DEFAULT=NO,URI="audio/fr.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,AUDIO="aud"
+360/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION=1280x720,AUDIO="aud"
+720/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=1500000,RESOLUTION=1280x720,AUDIO="aud"
+720l/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=8000000,RESOLUTION=3840x2160,AUDIO="aud"
+2160/index.m3u8
+'''
+
+
+class SelectVariantTests(TestCase):
+    def setUp(self):
+        self.playlist = m3u8.loads(MASTER)
+
+    def test_max_bandwidth(self):
+        self.assertEqual(select_variant(self.playlist).uri, '2160/index.m3u8')
+
+    def test_max_resolution(self):
+        self.assertEqual(select_variant(self.playlist, 'max_resolution', 1080).uri, '720l/index.m3u8')
+        self.assertEqual(select_variant(self.playlist, 'max_resolution').uri, '2160/index.m3u8')
+        self.assertEqual(select_variant(self.playlist, 'max_resolution', 100).uri, '360/index.m3u8')
+
+    def test_bandwidth(self):
+        self.assertEqual(select_variant(self.playlist, 'bandwidth', max_bandwidth=1800000).uri, '720l/index.m3u8')
+        self.assertEqual(select_variant(self.playlist, 'bandwidth', max_bandwidth=1).uri, '360/index.m3u8')
+        with self.assertRaises(ValueError):
+            select_variant(self.playlist, 'bandwidth')
+
+    def test_renditions(self):
+        variant = select_variant(self.playlist)
+        self.assertEqual([m.uri for m in select_renditions(variant)], ['audio/en.m3u8'])
+        self.assertEqual([m.uri for m in select_renditions(variant, languages=['en', 'fr'])],
+                         ['audio/en.m3u8', 'audio/fr.m3u8'])
+        self.assertEqual(select_renditions(variant, ['SUBTITLES']), [])
+
+    def test_rendition_ext(self):
+        def media(*lines: str) -> m3u8.M3U8:
+            return m3u8.loads('\n'.join(['#EXTM3U', '#EXT-X-TARGETDURATION:1', *lines, '#EXT-X-ENDLIST']))
+        self.assertEqual(rendition_ext('AUDIO', media('#EXTINF:1,', 'a/0.aac?t=1')), '.aac')
+        self.assertEqual(rendition_ext('AUDIO', media('#EXT-X-MAP:URI="init.mp4"', '#EXTINF:1,', '0.m4s')), '.m4a')
+        self.assertEqual(rendition_ext('VIDEO', media('#EXTINF:1,', '0.m4s')), '.mp4')
+        self.assertEqual(rendition_ext('AUDIO', media('#EXTINF:1,', '0.ts')), '.ts')
+        self.assertEqual(rendition_ext('SUBTITLES', media('#EXTINF:1,', '0.webvtt')), '.vtt')
+
+
+class MasterDownloadTests(IsolatedAsyncioTestCase):
+    async def test_download(self):
+        requested = []
+
+        async def handle(request: web.Request) -> web.Response:
+            path = request.match_info['path']
+            requested.append(path)
+            if path == 'master.m3u8':
+                return web.Response(text=MASTER)
+            if path.endswith('.m3u8'):
+                ext = 'aac' if path.startswith('audio/') else 'ts'
+                return web.Response(text=f'#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXTINF:1,\n0.{ext}\n#EXTINF:1,\n1.{ext}\n#EXT-X-ENDLIST')
+            return web.Response(text=path)
+        app = web.Application()
+        app.router.add_get('/{path:.*}', handle)
+        with tempfile.TemporaryDirectory() as tmp:
+            async with TestServer(app) as server:
+                fn, downloaded = await download(str(server.make_url('/master.m3u8')), 'v', *[os.path.join(tmp, d) for d in ['m3u8', 'tmp', 'videos']],
+                                                stream=True, variant='max_resolution', max_height=720)
+            self.assertTrue(downloaded)
+            with open(fn) as f:
+                self.assertEqual(f.read(), '720l/0.ts720l/1.ts')
+            with open(os.path.join(tmp, 'videos', 'v.audio.en.aac')) as f:
+                self.assertEqual(f.read(), 'audio/0.aacaudio/1.aac')
+            self.assertNotIn('2160/index.m3u8', requested)